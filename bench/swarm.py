@@ -0,0 +1,255 @@
+"""
+Loopback swarm benchmark.
+
+Generates a synthetic torrent, seeds it from N in-process peers behind
+links with configurable latency and bandwidth, downloads it with `Client`
+and reports throughput, time to completion, CPU time per GB and peak RSS.
+Nothing leaves the machine, so the numbers can be compared between runs.
+
+    python -m bench.swarm --size 256M --piece-length 256K --seeds 4 --latency 20 --bandwidth 50M
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+import bencodepy
+
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.client import Client
+from torrent.ratelimit import TokenBucket
+from torrent.server import PeerServer
+
+RELAY_CHUNK = 2 ** 16
+
+
+@dataclass
+class Report:
+    size: int
+    piece_length: int
+    seeds: int
+    latency_ms: float
+    bandwidth: int
+    seconds: float
+    throughput: float
+    cpu_seconds_per_gb: float
+    peak_rss: int
+    verified: bool
+
+
+def parse_size(value: str) -> int:
+    """
+    Parses sizes like 512K, 64M or 1G.
+    """
+    units = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    value = value.strip().upper()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def make_torrent(directory: str, size: int, piece_length: int, seed: int = 0, name: str = 'bench.bin',
+                 announce: Optional[bytes] = b'http://localhost/announce') -> str:
+    """
+    Writes `size` bytes of reproducible random data to `directory`/seed/`name`
+    and a torrent for them, trackerless if `announce` is None.
+
+    Returns: the path of the torrent file
+    """
+    rng = random.Random(seed)
+    data_path = os.path.join(directory, 'seed', name)
+    os.makedirs(os.path.dirname(data_path), exist_ok=True)
+    pieces = []
+    with open(data_path, 'wb') as f:
+        for offset in range(0, size, piece_length):
+            piece = rng.randbytes(min(piece_length, size - offset))
+            f.write(piece)
+            pieces.append(hashlib.sha1(piece).digest())
+    metainfo = {b'info': {b'name': name.encode(), b'length': size, b'piece length': piece_length,
+                          b'pieces': b''.join(pieces)}}
+    if announce is not None:
+        metainfo[b'announce'] = announce
+    torrent_path = os.path.join(directory, os.path.splitext(name)[0] + '.torrent')
+    with open(torrent_path, 'wb') as f:
+        f.write(bencodepy.encode(metainfo))
+    return torrent_path
+
+
+class Link:
+    """
+    TCP relay in front of a seed adding one-way latency and a bandwidth
+    limit in each direction, like a slow network between two peers.
+    """
+
+    def __init__(self, target_port: int, latency: float = 0.0, bandwidth: int = 0):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.port = None
+        self.server = None
+        self.relays = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._relay, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def _relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.relays.add(task)
+        try:
+            target_reader, target_writer = await asyncio.open_connection('127.0.0.1', self.target_port)
+            await asyncio.gather(self._pipe(reader, target_writer), self._pipe(target_reader, writer),
+                                 return_exceptions=True)
+        except (OSError, asyncio.CancelledError):
+            writer.close()
+        finally:
+            self.relays.discard(task)
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        bucket = TokenBucket(self.bandwidth)
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    break
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+
+        delivery = asyncio.create_task(deliver())
+        try:
+            while True:
+                data = await reader.read(RELAY_CHUNK)
+                if not data:
+                    break
+                await bucket.consume(len(data))
+                queue.put_nowait((time.monotonic() + self.latency, data))
+        finally:
+            queue.put_nowait((0.0, None))
+            await asyncio.gather(delivery, return_exceptions=True)
+            writer.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for task in self.relays:
+            task.cancel()
+
+
+async def run(size: int, piece_length: int, seeds: int = 4, latency: float = 0.0, bandwidth: int = 0,
+              directory: Optional[str] = None) -> Report:
+    """
+    Runs one download through the loopback swarm.
+
+    `latency` is the one-way delay in seconds and `bandwidth` the limit in
+    bytes per second of each seed's link, 0 meaning unlimited.
+    """
+    own_directory = directory is None
+    directory = directory or tempfile.mkdtemp(prefix='p2p-bench-')
+    torrent_path = make_torrent(directory, size, piece_length)
+    seed_clients: List[Client] = []
+    servers: List[PeerServer] = []
+    links: List[Link] = []
+    leech = None
+    try:
+        for _ in range(seeds):
+            seed = Client([], Torrent(torrent_path), path=os.path.join(directory, 'seed'))
+            await seed.check()
+            server = PeerServer(port=0, host='127.0.0.1')
+            await server.start()
+            await seed.listen(server)
+            link = Link(server.port, latency, bandwidth)
+            await link.start()
+            seed_clients.append(seed)
+            servers.append(server)
+            links.append(link)
+
+        peers = [Peer('127.0.0.1', link.port, f'seed-{i}'.encode()) for i, link in enumerate(links)]
+        leech = Client(peers, Torrent(torrent_path), path=os.path.join(directory, 'leech'))
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu_start = usage.ru_utime + usage.ru_stime
+        start = time.monotonic()
+        await leech.connect()
+        await leech.download()
+        seconds = time.monotonic() - start
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = usage.ru_utime + usage.ru_stime - cpu_start
+        await leech.save_resume()
+        verified = leech.scheduler.is_complete and _same_file(os.path.join(directory, 'seed', 'bench.bin'),
+                                                             os.path.join(directory, 'leech', 'bench.bin'))
+        return Report(
+            size=size,
+            piece_length=piece_length,
+            seeds=seeds,
+            latency_ms=latency * 1000,
+            bandwidth=bandwidth,
+            seconds=seconds,
+            throughput=size / seconds,
+            cpu_seconds_per_gb=cpu / (size / 2 ** 30),
+            # Kilobytes on Linux
+            peak_rss=usage.ru_maxrss * 1024,
+            verified=verified,
+        )
+    finally:
+        if leech is not None:
+            leech.close()
+        for seed, server, link in zip(seed_clients, servers, links):
+            seed.close()
+            server.close()
+            link.close()
+        await asyncio.sleep(0)
+        if own_directory:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _same_file(a: str, b: str) -> bool:
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            chunk_a, chunk_b = fa.read(2 ** 20), fb.read(2 ** 20)
+            if chunk_a != chunk_b:
+                return False
+            if not chunk_a:
+                return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download a synthetic torrent from in-process seeds.')
+    parser.add_argument('--size', default='64M', help='torrent size, e.g. 512K, 64M, 1G')
+    parser.add_argument('--piece-length', default='256K')
+    parser.add_argument('--seeds', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='one-way latency of each link in ms')
+    parser.add_argument('--bandwidth', default='0', help='bandwidth of each link per second, 0 for unlimited')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print one JSON report per line')
+    args = parser.parse_args()
+
+    for name in list(logging.root.manager.loggerDict):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    for _ in range(args.runs):
+        report = asyncio.run(run(parse_size(args.size), parse_size(args.piece_length), args.seeds,
+                                 args.latency / 1000, parse_size(args.bandwidth)))
+        if args.json:
+            print(json.dumps(asdict(report)))
+        else:
+            print(f'{report.size / 2 ** 20:.0f} MiB from {report.seeds} seeds in {report.seconds:.2f} s: '
+                  f'{report.throughput / 2 ** 20:.1f} MiB/s, {report.cpu_seconds_per_gb:.2f} CPU s/GiB, '
+                  f'peak RSS {report.peak_rss / 2 ** 20:.0f} MiB, verified={report.verified}')
+
+
+if __name__ == '__main__':
+    main()
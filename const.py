@@ -9,9 +9,128 @@ CHUNK_SIZE = 8192
 
 PROTOCOL = b'BitTorrent protocol'
 PROTOCOL_LEN = len(PROTOCOL)
-PEER_CONNECT_TIMEOUT = 50
+HANDSHAKE_LEN = 1 + PROTOCOL_LEN + 8 + 20 + 20
+# Seconds to open a connection and exchange handshakes
+PEER_CONNECT_TIMEOUT = 10
+# A keep-alive is sent to peers we have not written to for a while, and
+# peers which stay silent for longer than the idle timeout are dropped
+KEEP_ALIVE_INTERVAL = 60
+PEER_IDLE_TIMEOUT = 180
+# Reserved handshake bits: byte 5, 0x10 is the Extension Protocol (BEP 10)
+# and byte 7, 0x04 the Fast Extension (BEP 6)
+RESERVED = bytes(5) + b'\x10\x00\x04'
+EXTENSION_PROTOCOL_BYTE, EXTENSION_PROTOCOL_BIT = 5, 0x10
+FAST_EXTENSION_BYTE, FAST_EXTENSION_BIT = 7, 0x04
+# Ids peers must use for the extension messages they send us, see BEP 10
+EXTENSION_IDS = {b'ut_metadata': 1, b'ut_pex': 2}
+# Pieces a choked peer may still request from us, see BEP 6
+ALLOWED_FAST_COUNT = 10
+REQUEST_TIMEOUT = 30
+# BEP 9: the info dictionary is exchanged in pieces of 16 KiB, bigger ones
+# than MAX_METADATA_SIZE are refused
+METADATA_PIECE_SIZE = 2 ** 14
+MAX_METADATA_SIZE = 2 ** 24
+# Peers asked for metadata at once, and seconds to wait for one of its pieces
+METADATA_PEERS = 8
+METADATA_REQUEST_TIMEOUT = 10
 
 BLOCK_SIZE = 2 ** 14
+# Larger requests from peers are refused
+MAX_REQUEST_LENGTH = 2 ** 17
+# Peers announcing a longer message, besides a bitfield as long as the
+# torrent needs, are dropped: a piece message is the largest one
+MAX_MESSAGE_LENGTH = 9 + MAX_REQUEST_LENGTH
+# Bounds of the number of outstanding block requests per peer
+REQUEST_QUEUE_INITIAL = 16
+REQUEST_QUEUE_MIN = 2
+REQUEST_QUEUE_MAX = 256
+
+# Size of the reusable receive buffer of each peer connection
+RECEIVE_BUFFER_SIZE = 2 ** 18
+
+# Memory used to assemble in-flight pieces before they are written out
+PIECE_BUFFER_MEMORY = 64 * 2 ** 20
+
+# Memory used to cache pieces read for uploading
+READ_CACHE_SIZE = 32 * 2 ** 20
+
+# Peers sending this many pieces which fail their hash check are dropped
+MAX_HASH_FAILURES = 3
+
+# Number of file descriptors kept open by the storage
+MAX_OPEN_FILES = 64
+
+# Seconds between two saves of the resume data
+RESUME_SAVE_INTERVAL = 30
+
+TRACKER_TIMEOUT = 15
+# Used when trackers don't say how often to announce, and as a lower bound
+DEFAULT_ANNOUNCE_INTERVAL = 1800
+MIN_ANNOUNCE_INTERVAL = 60
+# BEP 15: a request is retransmitted after 15 * 2 ^ n seconds, and a
+# connection ID may be reused for one minute
+UDP_TRACKER_TIMEOUT = 15
+UDP_TRACKER_RETRIES = 2
+UDP_CONNECTION_ID_LIFETIME = 60
+# Connections kept open by the HTTP session shared by all trackers
+HTTP_TRACKER_CONNECTIONS = 100
+HTTP_TRACKER_CONNECTIONS_PER_HOST = 4
+
+LISTEN_PORT = 6881
+# Peer connections open at once across all the torrents of a session
+MAX_CONNECTIONS = 500
+# Peer connections of one torrent, and how many of them may be connecting at once
+MAX_PEERS = 50
+MAX_HALF_OPEN = 16
+# Failed peers are retried after CONNECT_BACKOFF * 2 ^ failures seconds, and
+# forgotten after MAX_CONNECT_FAILURES attempts
+CONNECT_BACKOFF = 15
+MAX_CONNECT_FAILURES = 5
+# Number of peers we upload to at once, including the optimistic unchoke
+UPLOAD_SLOTS = 4
+CHOKE_INTERVAL = 10
+# The optimistic unchoke moves on every this many choke intervals
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+# Requests queued by a peer beyond this are dropped
+UPLOAD_QUEUE_MAX = 256
+
+# Peer Exchange (BEP 11): seconds between two messages to or from a peer,
+# and peers added or dropped in one message at most
+PEX_INTERVAL = 60
+PEX_MAX_PEERS = 50
+# Flags of the added peers: a seed, and a peer accepting connections
+PEX_SEED_FLAG = 0x02
+PEX_REACHABLE_FLAG = 0x10
+
+# Mainline DHT (BEP 5): nodes per bucket, queries in flight during a lookup
+# and seconds to wait for a reply
+DHT_K = 8
+DHT_ALPHA = 3
+DHT_QUERY_TIMEOUT = 2
+# Nodes failing this many queries in a row are replaced
+DHT_MAX_FAILURES = 3
+# Buckets untouched for this long are refreshed with a random lookup
+DHT_REFRESH_INTERVAL = 15 * 60
+# Tokens handed out to get_peers callers stay valid for up to two of these
+DHT_TOKEN_LIFETIME = 5 * 60
+# Peers announced to us are kept for this long, and at most this many are
+# returned by one get_peers reply
+DHT_PEER_LIFETIME = 30 * 60
+DHT_MAX_VALUES = 50
+# Seconds between two announces of a torrent to the DHT
+DHT_ANNOUNCE_INTERVAL = 15 * 60
+DHT_BOOTSTRAP_NODES = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881),
+                       ('router.utorrent.com', 6881)]
+
+# Streaming: bytes after the playhead given a deadline, seconds between the
+# deadlines of two consecutive pieces, and how close to its deadline a piece
+# gets requested from several peers at once
+STREAM_READAHEAD = 2 ** 23
+STREAM_DEADLINE_STEP = 0.5
+STREAM_URGENT_TIME = 1.0
+STREAM_PORT = 8000
+# Bytes read from disk at once when serving a file over HTTP
+STREAM_CHUNK_SIZE = 2 ** 18
 
 DOWNLOAD_PATH = f'{os.getenv("HOME")}/Downloads/p2p'
 
@@ -27,8 +146,31 @@ class PeerMessage(Enum):
     piece = 7
     cancel = 8
     port = 9
+    # BEP 6 Fast Extension
+    suggest_piece = 13
+    have_all = 14
+    have_none = 15
+    reject_request = 16
+    allowed_fast = 17
+    # BEP 10 Extension Protocol
+    extended = 20
+
+
+class MetadataMessage(Enum):
+    request = 0
+    data = 1
+    reject = 2
 
 
 class ActionType(Enum):
     connect = 0
     announce = 1
+    scrape = 2
+    error = 3
+
+
+class AnnounceEvent(Enum):
+    none = 0
+    completed = 1
+    started = 2
+    stopped = 3
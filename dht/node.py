@@ -0,0 +1,345 @@
+import asyncio
+import hashlib
+import os
+import random
+import socket
+import time
+from asyncio import DatagramProtocol
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import bencodepy
+
+from const import DHT_ALPHA, DHT_BOOTSTRAP_NODES, DHT_K, DHT_MAX_VALUES, DHT_PEER_LIFETIME, DHT_QUERY_TIMEOUT, \
+    DHT_TOKEN_LIFETIME
+from dht.routing import ID_LENGTH, NodeInfo, RoutingTable, distance, pack_nodes, unpack_nodes
+from log import get_logger
+from models.peer import Peer, from_bytes
+from torrent.bencode import BencodeError, decode
+
+log = get_logger(__name__)
+
+Addr = Tuple[str, int]
+
+
+class DHTError(Exception):
+    pass
+
+
+class DHTNode(DatagramProtocol):
+    """
+    A node of the mainline DHT (BEP 5), used to find peers without trackers.
+
+    It answers the queries of other nodes and runs iterative lookups: the
+    DHT_ALPHA closest nodes not queried yet are asked in parallel, and their
+    answers bring closer nodes until the DHT_K closest have all replied. The
+    routing table is saved to `state_path` on close, so that the next start
+    bootstraps from the nodes it knew instead of the public routers.
+    """
+
+    def __init__(self, port: int = 0, host: str = '0.0.0.0', state_path: Optional[str] = None,
+                 bootstrap_nodes: Iterable[Addr] = DHT_BOOTSTRAP_NODES):
+        self.host = host
+        self.port = port
+        self.state_path = state_path
+        self.bootstrap_nodes = list(bootstrap_nodes)
+        saved_id, self._saved_nodes = self._load_state()
+        self.node_id = saved_id or os.urandom(ID_LENGTH)
+        self.table = RoutingTable(self.node_id)
+        self.transport = None
+        self.transactions: Dict[bytes, Tuple[asyncio.Future, Addr]] = {}
+        # Peers announced to us, per info hash, with their expiry time
+        self.peers: Dict[bytes, Dict[Addr, float]] = {}
+        self._secrets = [os.urandom(8), os.urandom(8)]
+        self._maintenance_task = None
+        # Set once the first bootstrap is over, successful or not
+        self.ready = asyncio.Event()
+        self._handlers = {
+            b'ping': self._handle_ping,
+            b'find_node': self._handle_find_node,
+            b'get_peers': self._handle_get_peers,
+            b'announce_peer': self._handle_announce_peer,
+        }
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(self.host, self.port))
+        self.port = self.transport.get_extra_info('sockname')[1]
+        self._maintenance_task = asyncio.create_task(self._maintain())
+        log.info(f'DHT node {self.node_id.hex()} listening on port {self.port}')
+
+    async def bootstrap(self, addrs: Optional[Iterable[Addr]] = None):
+        """
+        Fills the routing table by looking ourselves up, starting from the
+        nodes saved last time or else from `addrs`, the bootstrap routers.
+        """
+        try:
+            for node in self._saved_nodes:
+                self.table.add(node)
+            self._saved_nodes = []
+            if len(self.table):
+                await self.find_node(self.node_id)
+            if len(self.table) < DHT_K:
+                routers = await self._resolve(self.bootstrap_nodes if addrs is None else addrs)
+                responses = await asyncio.gather(*(self._query(addr, 'find_node', {b'target': self.node_id})
+                                                   for addr in routers), return_exceptions=True)
+                for response in responses:
+                    if isinstance(response, dict):
+                        for node in unpack_nodes(response.get(b'nodes', b'')):
+                            self.table.add(node)
+                await self.find_node(self.node_id)
+            log.info(f'DHT bootstrapped with {len(self.table)} nodes.')
+        finally:
+            self.ready.set()
+
+    async def _resolve(self, addrs: Iterable[Addr]) -> List[Addr]:
+        loop = asyncio.get_running_loop()
+        resolved = []
+        for host, port in addrs:
+            try:
+                infos = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            except OSError as e:
+                log.warning(f'Could not resolve DHT node {host}: {e!r}')
+                continue
+            resolved.append(infos[0][4])
+        return resolved
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for future, _ in self.transactions.values():
+            if not future.done():
+                future.set_exception(ConnectionError('DHT socket closed'))
+        self.transactions.clear()
+
+    def error_received(self, exc):
+        log.debug(f'DHT socket error: {exc!r}')
+
+    def datagram_received(self, data: bytes, addr: Addr):
+        try:
+            message = decode(data)
+        except BencodeError:
+            log.debug(f'Dropping malformed DHT message from {addr}')
+            return
+        if not isinstance(message, dict):
+            return
+        kind = message.get(b'y')
+        if kind == b'q':
+            self._handle_query(message, addr)
+        elif kind in (b'r', b'e'):
+            self._handle_reply(message, addr)
+
+    def _handle_reply(self, message: Dict[bytes, Any], addr: Addr):
+        transaction = self.transactions.get(message.get(b't'))
+        if transaction is None or transaction[0].done() or transaction[1] != addr:
+            return
+        future, _ = transaction
+        if message[b'y'] == b'e':
+            future.set_exception(DHTError(repr(message.get(b'e'))))
+            return
+        response = message.get(b'r')
+        if not isinstance(response, dict) or len(response.get(b'id', b'')) != ID_LENGTH:
+            future.set_exception(DHTError('Invalid reply'))
+            return
+        self.table.add(NodeInfo(response[b'id'], addr))
+        future.set_result(response)
+
+    def _send(self, message: Dict[bytes, Any], addr: Addr):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(bencodepy.encode(message), addr)
+
+    def _new_transaction(self) -> bytes:
+        while True:
+            tid = os.urandom(2)
+            if tid not in self.transactions:
+                return tid
+
+    async def _query(self, addr: Addr, method: str, args: Dict[bytes, Any]) -> Dict[bytes, Any]:
+        """
+        Returns: the reply of the node at `addr`
+        """
+        tid = self._new_transaction()
+        future = asyncio.get_running_loop().create_future()
+        self.transactions[tid] = future, addr
+        try:
+            self._send({b't': tid, b'y': b'q', b'q': method.encode(), b'a': {b'id': self.node_id, **args}}, addr)
+            return await asyncio.wait_for(future, timeout=DHT_QUERY_TIMEOUT)
+        finally:
+            del self.transactions[tid]
+
+    async def _query_node(self, node: NodeInfo, method: str, args: Dict[bytes, Any]) -> Optional[Dict[bytes, Any]]:
+        try:
+            return await self._query(node.addr, method, args)
+        except (asyncio.TimeoutError, DHTError, ConnectionError) as e:
+            log.debug(f'DHT {method} to {node} failed: {e!r}')
+            self.table.failed(node.id)
+            return None
+
+    def _handle_query(self, message: Dict[bytes, Any], addr: Addr):
+        tid, method, args = message.get(b't'), message.get(b'q'), message.get(b'a')
+        if not isinstance(tid, bytes):
+            return
+        if not isinstance(args, dict) or len(args.get(b'id', b'')) != ID_LENGTH:
+            self._send({b't': tid, b'y': b'e', b'e': [203, b'Protocol error']}, addr)
+            return
+        self.table.add(NodeInfo(args[b'id'], addr))
+        handler = self._handlers.get(method)
+        if handler is None:
+            self._send({b't': tid, b'y': b'e', b'e': [204, b'Method unknown']}, addr)
+            return
+        try:
+            response = handler(args, addr)
+        except DHTError as e:
+            self._send({b't': tid, b'y': b'e', b'e': [203, str(e).encode()]}, addr)
+            return
+        except (KeyError, TypeError, ValueError):
+            self._send({b't': tid, b'y': b'e', b'e': [203, b'Protocol error']}, addr)
+            return
+        self._send({b't': tid, b'y': b'r', b'r': {b'id': self.node_id, **response}}, addr)
+
+    def _handle_ping(self, args: Dict[bytes, Any], addr: Addr) -> Dict[bytes, Any]:
+        return {}
+
+    def _handle_find_node(self, args: Dict[bytes, Any], addr: Addr) -> Dict[bytes, Any]:
+        return {b'nodes': pack_nodes(self.table.closest(args[b'target']))}
+
+    def _handle_get_peers(self, args: Dict[bytes, Any], addr: Addr) -> Dict[bytes, Any]:
+        info_hash = args[b'info_hash']
+        response = {b'token': self._token(addr[0], self._secrets[0]),
+                    b'nodes': pack_nodes(self.table.closest(info_hash))}
+        now = time.monotonic()
+        peers = [peer for peer, expires in self.peers.get(info_hash, {}).items() if expires > now]
+        if peers:
+            response[b'values'] = [socket.inet_aton(ip) + port.to_bytes(2, 'big')
+                                   for ip, port in random.sample(peers, min(len(peers), DHT_MAX_VALUES))]
+        return response
+
+    def _handle_announce_peer(self, args: Dict[bytes, Any], addr: Addr) -> Dict[bytes, Any]:
+        if not self._is_valid_token(addr[0], args[b'token']):
+            raise DHTError('Bad token')
+        port = addr[1] if args.get(b'implied_port') else args[b'port']
+        if not isinstance(port, int) or not 0 < port < 65536:
+            raise DHTError('Invalid port')
+        self.peers.setdefault(args[b'info_hash'], {})[(addr[0], port)] = time.monotonic() + DHT_PEER_LIFETIME
+        return {}
+
+    def _token(self, ip: str, secret: bytes) -> bytes:
+        return hashlib.sha1(secret + ip.encode()).digest()[:8]
+
+    def _is_valid_token(self, ip: str, token: bytes) -> bool:
+        return any(token == self._token(ip, secret) for secret in self._secrets)
+
+    async def _lookup(self, target: bytes, method: str,
+                      args: Dict[bytes, Any]) -> Tuple[List[Tuple[NodeInfo, Dict[bytes, Any]]], List[Peer]]:
+        """
+        Iteratively queries the nodes closest to `target`.
+
+        Returns: the DHT_K closest nodes which replied with their reply,
+        closest first, and the peers found on the way
+        """
+        known = {node.id: node for node in self.table.closest(target)}
+        queried = set()
+        replies: Dict[bytes, Tuple[NodeInfo, Dict[bytes, Any]]] = {}
+        peers: Dict[Addr, Peer] = {}
+        pending: Dict[asyncio.Task, NodeInfo] = {}
+        try:
+            while True:
+                closest = sorted(known.values(), key=lambda n: distance(n.id, target))[:DHT_K]
+                for node in [n for n in closest if n.id not in queried][:DHT_ALPHA - len(pending)]:
+                    queried.add(node.id)
+                    pending[asyncio.create_task(self._query_node(node, method, args))] = node
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node = pending.pop(task)
+                    response = task.result()
+                    if response is None:
+                        del known[node.id]
+                        continue
+                    replies[node.id] = node, response
+                    for found in unpack_nodes(response.get(b'nodes', b'')):
+                        if found.id != self.node_id:
+                            known.setdefault(found.id, found)
+                    for peer in from_bytes(b''.join(value for value in response.get(b'values', [])
+                                                    if len(value) == 6)):
+                        peers.setdefault((peer.ip, peer.port), peer)
+        finally:
+            for task in pending:
+                task.cancel()
+        closest = sorted(replies.values(), key=lambda reply: distance(reply[0].id, target))[:DHT_K]
+        return closest, list(peers.values())
+
+    async def find_node(self, target: bytes) -> List[NodeInfo]:
+        closest, _ = await self._lookup(target, 'find_node', {b'target': target})
+        return [node for node, _ in closest]
+
+    async def get_peers(self, info_hash: bytes) -> List[Peer]:
+        """
+        Returns: the peers of a torrent found in the DHT
+        """
+        _, peers = await self._lookup(info_hash, 'get_peers', {b'info_hash': info_hash})
+        log.info(f'DHT returned {len(peers)} peers for {info_hash.hex()}')
+        return peers
+
+    async def announce_peer(self, info_hash: bytes, port: int) -> List[Peer]:
+        """
+        Looks up the peers of a torrent, then tells the closest nodes that we
+        download it too, on `port`.
+
+        Returns: the peers found in the DHT
+        """
+        closest, peers = await self._lookup(info_hash, 'get_peers', {b'info_hash': info_hash})
+        announces = [self._query_node(node, 'announce_peer', {b'info_hash': info_hash, b'port': port,
+                                                              b'token': response[b'token']})
+                     for node, response in closest if b'token' in response]
+        results = await asyncio.gather(*announces)
+        log.info(f'Announced {info_hash.hex()} to {sum(r is not None for r in results)} DHT nodes, '
+                 f'found {len(peers)} peers.')
+        return peers
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(DHT_TOKEN_LIFETIME)
+            # Tokens of the previous period stay valid for one more period
+            self._secrets = [os.urandom(8), self._secrets[0]]
+            now = time.monotonic()
+            for info_hash in list(self.peers):
+                self.peers[info_hash] = {peer: expires for peer, expires in self.peers[info_hash].items()
+                                         if expires > now}
+                if not self.peers[info_hash]:
+                    del self.peers[info_hash]
+            for bucket in self.table.stale_buckets():
+                await self.find_node(bucket.random_id())
+            self.save_state()
+
+    def _load_state(self) -> Tuple[Optional[bytes], List[NodeInfo]]:
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return None, []
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = decode(f.read())
+            return state[b'id'], unpack_nodes(state[b'nodes'])
+        except (OSError, BencodeError, KeyError, TypeError) as e:
+            log.warning(f'Ignoring DHT state {self.state_path}: {e!r}')
+            return None, []
+
+    def save_state(self):
+        if self.state_path is None:
+            return
+        state = bencodepy.encode({b'id': self.node_id, b'nodes': pack_nodes(self.table.nodes())})
+        tmp_path = f'{self.state_path}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(state)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            log.warning(f'Could not save DHT state to {self.state_path}: {e!r}')
+
+    def close(self):
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        self.save_state()
+        if self.transport is not None:
+            self.transport.close()
@@ -0,0 +1,176 @@
+import os
+import socket
+import struct
+import time
+from bisect import bisect_right
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from const import DHT_K, DHT_MAX_FAILURES, DHT_REFRESH_INTERVAL
+
+ID_LENGTH = 20
+ID_SPACE = 2 ** 160
+COMPACT_NODE = struct.Struct('!20s4sH')
+
+
+def distance(a: bytes, b: bytes) -> int:
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+
+class NodeInfo:
+    __slots__ = ('id', 'addr', 'last_seen', 'failures')
+
+    def __init__(self, node_id: bytes, addr: Tuple[str, int]):
+        self.id = node_id
+        self.addr = addr
+        self.last_seen = 0.0
+        self.failures = 0
+
+    @property
+    def is_bad(self) -> bool:
+        return self.failures >= DHT_MAX_FAILURES
+
+    def __repr__(self):
+        return f'NodeInfo(id={self.id.hex()[:8]}, addr={self.addr[0]}:{self.addr[1]})'
+
+
+def pack_nodes(nodes: Iterable[NodeInfo]) -> bytes:
+    """
+    Returns: the nodes in compact node info format, 26 bytes each
+    """
+    return b''.join(COMPACT_NODE.pack(node.id, socket.inet_aton(node.addr[0]), node.addr[1]) for node in nodes)
+
+
+def unpack_nodes(data: bytes) -> List[NodeInfo]:
+    nodes = []
+    for offset in range(0, len(data) - COMPACT_NODE.size + 1, COMPACT_NODE.size):
+        node_id, ip, port = COMPACT_NODE.unpack_from(data, offset)
+        if port:
+            nodes.append(NodeInfo(node_id, (socket.inet_ntoa(ip), port)))
+    return nodes
+
+
+class KBucket:
+    """
+    Nodes whose id falls in [lo, hi), least recently seen first.
+
+    Nodes met while the bucket is full wait in a replacement cache, and take
+    the place of the first node that goes bad.
+    """
+
+    def __init__(self, lo: int, hi: int):
+        self.lo = lo
+        self.hi = hi
+        self.nodes: Dict[bytes, NodeInfo] = {}
+        self.replacements: Dict[bytes, NodeInfo] = {}
+        self.last_changed = time.monotonic()
+
+    def covers(self, node_id: bytes) -> bool:
+        return self.lo <= int.from_bytes(node_id, 'big') < self.hi
+
+    def random_id(self) -> bytes:
+        value = self.lo + int.from_bytes(os.urandom(ID_LENGTH), 'big') % (self.hi - self.lo)
+        return value.to_bytes(ID_LENGTH, 'big')
+
+
+class RoutingTable:
+    """
+    Kademlia routing table of the nodes we know, in buckets of DHT_K.
+
+    Only the bucket covering our own id is split when full, so the table
+    knows many nodes close to us and a few in each far away region.
+    """
+
+    def __init__(self, node_id: bytes, k: int = DHT_K):
+        self.node_id = node_id
+        self.k = k
+        self.buckets = [KBucket(0, ID_SPACE)]
+
+    def __len__(self) -> int:
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def _bucket(self, node_id: bytes) -> KBucket:
+        value = int.from_bytes(node_id, 'big')
+        index = bisect_right([bucket.lo for bucket in self.buckets], value) - 1
+        return self.buckets[index]
+
+    def get(self, node_id: bytes) -> Optional[NodeInfo]:
+        return self._bucket(node_id).nodes.get(node_id)
+
+    def add(self, node: NodeInfo) -> bool:
+        """
+        Records that a node answered or queried us.
+
+        Returns: whether the node is in the table
+        """
+        if node.id == self.node_id or len(node.id) != ID_LENGTH:
+            return False
+        bucket = self._bucket(node.id)
+        known = bucket.nodes.pop(node.id, None)
+        if known is not None:
+            # Move it to the end, it is the most recently seen now
+            known.addr = node.addr
+            known.failures = 0
+            node = known
+        node.last_seen = time.monotonic()
+        if known is not None or len(bucket.nodes) < self.k:
+            bucket.nodes[node.id] = node
+            bucket.last_changed = node.last_seen
+            return True
+        if bucket.covers(self.node_id) and bucket.hi - bucket.lo > self.k:
+            self._split(bucket)
+            return self.add(node)
+        bad = next((n for n in bucket.nodes.values() if n.is_bad), None)
+        if bad is not None:
+            del bucket.nodes[bad.id]
+            bucket.nodes[node.id] = node
+            bucket.last_changed = node.last_seen
+            return True
+        bucket.replacements.pop(node.id, None)
+        bucket.replacements[node.id] = node
+        if len(bucket.replacements) > self.k:
+            del bucket.replacements[next(iter(bucket.replacements))]
+        return False
+
+    def _split(self, bucket: KBucket):
+        middle = (bucket.lo + bucket.hi) // 2
+        low, high = KBucket(bucket.lo, middle), KBucket(middle, bucket.hi)
+        for node in bucket.nodes.values():
+            (low if low.covers(node.id) else high).nodes[node.id] = node
+        for node in bucket.replacements.values():
+            (low if low.covers(node.id) else high).replacements[node.id] = node
+        index = self.buckets.index(bucket)
+        self.buckets[index:index + 1] = [low, high]
+
+    def failed(self, node_id: bytes):
+        """
+        Records a query the node did not answer. Bad nodes make room for the
+        most recently seen replacement.
+        """
+        bucket = self._bucket(node_id)
+        node = bucket.nodes.get(node_id)
+        if node is None:
+            return
+        node.failures += 1
+        if node.is_bad and bucket.replacements:
+            del bucket.nodes[node_id]
+            replacement = bucket.replacements.pop(next(reversed(bucket.replacements)))
+            bucket.nodes[replacement.id] = replacement
+            bucket.last_changed = time.monotonic()
+
+    def closest(self, target: bytes, count: Optional[int] = None) -> List[NodeInfo]:
+        """
+        Returns: the good nodes closest to `target`, closest first
+        """
+        nodes = [node for bucket in self.buckets for node in bucket.nodes.values() if not node.is_bad]
+        nodes.sort(key=lambda node: distance(node.id, target))
+        return nodes[:count or self.k]
+
+    def nodes(self) -> List[NodeInfo]:
+        return [node for bucket in self.buckets for node in bucket.nodes.values()]
+
+    def stale_buckets(self) -> List[KBucket]:
+        """
+        Returns: the buckets nothing happened in for DHT_REFRESH_INTERVAL
+        """
+        deadline = time.monotonic() - DHT_REFRESH_INTERVAL
+        return [bucket for bucket in self.buckets if bucket.last_changed < deadline]
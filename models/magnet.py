@@ -0,0 +1,46 @@
+import base64
+from dataclasses import dataclass, field
+from typing import List, Optional
+from urllib.parse import parse_qsl, urlparse
+
+from models.peer import Peer
+
+
+@dataclass
+class Magnet:
+    info_hash: bytes
+    name: Optional[str] = None
+    # One tier per tracker, as BEP 9 asks
+    trackers: List[str] = field(default_factory=list)
+    peers: List[Peer] = field(default_factory=list)
+
+
+def parse_magnet(uri: str) -> Magnet:
+    """
+    Parses a BitTorrent v1 magnet link, whose info hash is hex or base32
+    encoded.
+
+    Returns: the info hash and the hints of the link
+    """
+    parsed = urlparse(uri)
+    if parsed.scheme != 'magnet':
+        raise ValueError(f'Not a magnet link: {uri}')
+    info_hash, name, trackers, peers = None, None, [], []
+    for key, value in parse_qsl(parsed.query):
+        if key == 'xt' and value.startswith('urn:btih:'):
+            encoded = value[len('urn:btih:'):]
+            if len(encoded) == 40:
+                info_hash = bytes.fromhex(encoded)
+            elif len(encoded) == 32:
+                info_hash = base64.b32decode(encoded.upper())
+        elif key == 'dn':
+            name = value
+        elif key == 'tr':
+            trackers.append(value)
+        elif key == 'x.pe':
+            host, _, port = value.rpartition(':')
+            if host and port.isdigit():
+                peers.append(Peer(host.strip('[]'), int(port)))
+    if info_hash is None:
+        raise ValueError(f'Magnet link without a BitTorrent info hash: {uri}')
+    return Magnet(info_hash, name, trackers, peers)
@@ -29,8 +29,9 @@ def from_bytes(peer_info: bytes) -> List[Peer]:
     # Split the string in pieces of length 6 bytes, where the first
     # 4 characters is the IP the last 2 is the TCP port.
     _peers = [peer_info[i:i + 6] for i in range(0, len(peer_info), 6)]
-    for i, peer in enumerate(_peers):
+    for peer in _peers:
         ip, port = struct.unpack('!4sH', peer)
         ip = socket.inet_ntoa(ip)
-        peers.append(Peer(ip=ip, port=port, peer_id=i.to_bytes(2, byteorder='big')))
+        # The compact form is unique per peer, unlike its position in the list
+        peers.append(Peer(ip=ip, port=port, peer_id=bytes(peer)))
     return peers
@@ -1,92 +1,166 @@
 import hashlib
+import os
+import random
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-import bencodepy
-
-from const import PIECE_SHA_LENGTH
+from const import PIECE_SHA_LENGTH, LISTEN_PORT
 from log import get_logger
-from models.piece import DownloadInfo, Piece
+from models.magnet import Magnet
+from models.piece import DownloadInfo
+from torrent.bencode import Decoder
 from util import bytes_to_str, generate_id
-import asyncio
+
 log = get_logger(__name__)
 
 
 @dataclass
 class File:
     length: int
+    # Relative to the download directory, with the torrent's directories
     path: str
 
 
+def file_path(components: List[bytes]) -> str:
+    """
+    Joins the path of a file in a multi-file torrent, dropping the components
+    which would let it escape the download directory.
+
+    Returns: the relative path of the file
+    """
+    parts = []
+    for component in components:
+        part = bytes_to_str(component).replace('/', '_').replace(os.sep, '_')
+        if part not in ('', '.', '..'):
+            parts.append(part)
+    return os.path.join(*parts) if parts else '_'
+
+
 @dataclass
 class Torrent:
     peer_id: str
     length: int
     file_length: int
-    announce: str
-    announce_list: List[str]
+    # None for trackerless torrents, found through the DHT only
+    announce: Optional[str]
+    # Tiers of tracker URLs, see BEP 12
+    announce_list: List[List[str]]
     piece_length: int
     dir: str
     filename: str
     files: List[File]
     info_hash: bytes
     download_info: DownloadInfo
-    uploaded: str
-    downloaded: str
-    left: str
-    port: str
+    uploaded: int
+    downloaded: int
+    left: int
+    port: int
     compact: str
-    pieces: List[Piece]
+    # The concatenated SHA1 of the pieces, a view into the .torrent file
+    piece_hashes: memoryview
     files: List[File]
+    # The info dictionary as encoded in the .torrent file, served to peers
+    # which start from a magnet link; None until it is known
+    metadata: Optional[memoryview]
 
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: Optional[str] = None):
         self.peer_id = generate_id()
         self.filepath = filepath
         self.length = 0
-        self._loop = asyncio.get_event_loop()
-        self.decode()
+        self.metadata = None
+        self.download_info = None
+        if filepath is not None:
+            self.decode()
+        # Transfer statistics reported to the trackers
+        self.uploaded = 0
+        self.downloaded = 0
+        self.left = self.length
+        self.port = LISTEN_PORT
 
     def decode(self):
         with open(self.filepath, 'rb') as f:
-            torrent = bencodepy.decode(f.read())
-        self.announce = bytes_to_str(torrent[b'announce'])
+            decoder = Decoder(f.read(), spans=[(b'info',)], views=[(b'info', b'pieces')])
+        torrent = decoder.decode()
+        self.announce = bytes_to_str(torrent[b'announce']) if b'announce' in torrent else None
         announce_list = []
         if b'announce-list' in torrent:
-            for _url in torrent[b'announce-list']:
-                # noinspection PyTypeChecker
-                url = bytes_to_str(_url[0])
-                if url.startswith('udp') or url.startswith('http'):
-                    announce_list.append(url)
-        self.announce_list = announce_list
+            for _tier in torrent[b'announce-list']:
+                tier = [bytes_to_str(url) for url in _tier]
+                tier = [url for url in tier if url.startswith('udp') or url.startswith('http')]
+                if tier:
+                    # BEP 12 asks for the trackers of a tier to be shuffled once
+                    random.shuffle(tier)
+                    announce_list.append(tier)
+        self.announce_list = announce_list or ([[self.announce]] if self.announce else [])
         info = torrent[b'info']
-        self.info_hash = hashlib.sha1(bencodepy.bencode(info)).digest()
+        # Hash the info dictionary as it is encoded in the file, re-encoding
+        # would normalize it and change the hash of non-canonical torrents
+        self.metadata = decoder.raw((b'info',))
+        self.info_hash = hashlib.sha1(self.metadata).digest()
         self.decode_info(info)
 
+    @classmethod
+    def from_magnet(cls, magnet: Magnet) -> 'Torrent':
+        """
+        A torrent known by its info hash only, until `set_metadata` is given
+        the info dictionary fetched from peers.
+        """
+        torrent = cls()
+        torrent.info_hash = magnet.info_hash
+        torrent.filename = magnet.name
+        torrent.announce = magnet.trackers[0] if magnet.trackers else None
+        torrent.announce_list = [[url] for url in magnet.trackers if url.startswith(('udp', 'http'))]
+        # The size is unknown, but trackers may hold seeds back from peers
+        # reporting nothing left to download
+        torrent.left = 1
+        return torrent
+
+    @property
+    def has_metadata(self) -> bool:
+        return self.metadata is not None
+
+    def set_metadata(self, metadata: bytes):
+        """
+        Completes a torrent created from a magnet link.
+        """
+        if hashlib.sha1(metadata).digest() != self.info_hash:
+            raise ValueError('Metadata does not match the info hash')
+        decoder = Decoder(metadata, views=[(b'pieces',)])
+        self.decode_info(decoder.decode())
+        self.metadata = decoder.view
+        self.left = self.length
+
     def decode_info(self, info: Dict[bytes, Any]):
         self.piece_length = info[b'piece length']
-        self.file_length = info[b'length']
-        pieces = info[b'pieces']
-        i = 0
-        self.pieces = []
-        while i < len(pieces):
-            self.pieces.append(Piece(pieces[i:i + PIECE_SHA_LENGTH], self.piece_length, set()))
-            i += 20
-        self.pieces[-1].is_last = True
-        piece_count = len(self.pieces)
-        self.download_info = DownloadInfo(piece_count, self.pieces)
+        self.piece_hashes = info[b'pieces']
         if b'files' not in info:
             # Single file mode
             log.info('Single file mode...')
-            self.files = [File(info[b'length'], bytes_to_str(info[b'name']))]
+            self.filename = file_path([info[b'name']])
+            self.files = [File(info[b'length'], self.filename)]
             self.length = sum([file.length for file in self.files])
-            self.filename = bytes_to_str(info[b'name'])
             log.info(f'Org File Name={self.filename}')
         else:
             log.info('Multiple files mode...')
-            self.files = [File(file[b'length'], file[b'path'][-1].decode('utf-8')) for file in info[b'files']]
+            # Files live under a directory named after the torrent
+            self.files = [File(file[b'length'], file_path([info[b'name'], *file[b'path']])) for file in info[b'files']]
             self.length = sum([file.length for file in self.files])
+        self.file_length = self.length
+        piece_count = len(self.piece_hashes) // PIECE_SHA_LENGTH
+        self.download_info = DownloadInfo(piece_count, self.piece_length, self.length)
+
+    def piece_hash(self, index: int) -> memoryview:
+        return self.piece_hashes[index * PIECE_SHA_LENGTH:(index + 1) * PIECE_SHA_LENGTH]
+
+    def piece_size(self, index: int) -> int:
+        """
+        Length of a piece, the last one being usually shorter.
+        """
+        return self.download_info.piece_size(index)
 
     def __repr__(self):
+        if not self.has_metadata:
+            return f'announce={self.announce} info_hash={self.info_hash.hex()} (no metadata yet)'
         torrent_info = f'announce={self.announce} piece_length={self.piece_length} piece_count={self.download_info.piece_count}'
         # if self.filename:
         #     torrent_info += f' filename={self.filename}'
@@ -0,0 +1,35 @@
+import tempfile
+import unittest
+
+from bench.swarm import make_torrent, parse_size, run
+from models.torrent import Torrent
+
+
+class BenchmarkTests(unittest.IsolatedAsyncioTestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size('512K'), 512 * 2 ** 10)
+        self.assertEqual(parse_size('1.5M'), 3 * 2 ** 19)
+        self.assertEqual(parse_size('1000'), 1000)
+
+    def test_make_torrent(self):
+        with tempfile.TemporaryDirectory() as directory:
+            torrent = Torrent(make_torrent(directory, 2 ** 16 + 1, 2 ** 14))
+            self.assertEqual(torrent.length, 2 ** 16 + 1)
+            self.assertEqual(torrent.download_info.piece_count, 5)
+
+    async def test_swarm(self):
+        report = await run(2 ** 20, 2 ** 16, seeds=2, latency=0.005)
+        self.assertTrue(report.verified)
+        self.assertEqual(report.size, 2 ** 20)
+        self.assertGreater(report.throughput, 0)
+        self.assertGreater(report.peak_rss, 0)
+
+    async def test_link_bandwidth(self):
+        report = await run(2 ** 20, 2 ** 16, seeds=1, bandwidth=2 ** 19)
+        self.assertTrue(report.verified)
+        # The first second worth of tokens is a burst, the rest is shaped
+        self.assertLess(report.throughput, 1.5 * 2 ** 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import bencodepy
+
+from models.torrent import Torrent
+from torrent.bencode import BencodeError, Decoder, decode
+
+
+class BencodeTests(unittest.TestCase):
+    def test_decode(self):
+        for value in [0, -42, b'', b'spam', [], {}, [1, [b'a', [2]]], {b'a': {b'b': [1, {}]}, b'c': b'd'}]:
+            self.assertEqual(decode(bencodepy.encode(value)), value)
+
+    def test_spans_and_views(self):
+        data = b'd4:infod6:pieces4:abcd4:namei3ee3:fooi1ee'
+        decoder = Decoder(data, spans=[(b'info',)], views=[(b'info', b'pieces')])
+        value = decoder.decode()
+        self.assertEqual(bytes(decoder.raw((b'info',))), b'd6:pieces4:abcd4:namei3ee')
+        pieces = value[b'info'][b'pieces']
+        self.assertIsInstance(pieces, memoryview)
+        self.assertEqual(pieces, b'abcd')
+        self.assertEqual(value[b'foo'], 1)
+
+    def test_paths_start_at_the_top_level(self):
+        # Nested info and pieces keys come first, but are not the ones wanted
+        data = b'd1:ad4:infoi1e6:pieces1:xe4:infod1:bd6:pieces1:ye6:pieces4:abcdee'
+        decoder = Decoder(data, spans=[(b'info',)], views=[(b'info', b'pieces')])
+        value = decoder.decode()
+        self.assertEqual(bytes(decoder.raw((b'info',))), b'd1:bd6:pieces1:ye6:pieces4:abcde')
+        self.assertIsInstance(value[b'info'][b'pieces'], memoryview)
+        self.assertIsInstance(value[b'info'][b'b'][b'pieces'], bytes)
+        self.assertIsInstance(value[b'a'][b'pieces'], bytes)
+
+    def test_invalid(self):
+        for data in [b'', b'i1', b'5:ab', b'di1ei2ee', b'd1:ae', b'l', b'i1ei2e', b'x', b'e', b'ia:e',
+                     b'i+1e', b'i1_0e', b'ie', b'i-e', b'i e', b'1_0:aaaaaaaaaa']:
+            with self.assertRaises(BencodeError, msg=data):
+                decode(data)
+
+    def test_padded_integers(self):
+        self.assertEqual([5, 0, 0], decode(b'li05ei-0ei00ee'))
+        self.assertEqual(b'a', decode(b'01:a'))
+
+    def test_non_canonical_info_hash(self):
+        # A padded integer or unsorted keys would be normalized by re-encoding
+        for info in [b'd6:lengthi05e4:name4:test12:piece lengthi16384e6:pieces20:' + bytes(20) + b'e',
+                     b'd4:name4:test6:lengthi5e12:piece lengthi16384e6:pieces20:' + bytes(20) + b'e']:
+            with self.subTest(info=info), tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'test.torrent')
+                with open(path, 'wb') as f:
+                    f.write(b'd8:announce25:http://localhost/announce4:info' + info + b'e')
+                torrent = Torrent(path)
+                self.assertEqual(torrent.info_hash, hashlib.sha1(info).digest())
+                self.assertNotEqual(torrent.info_hash, hashlib.sha1(bencodepy.encode(decode(info))).digest())
+                self.assertEqual(torrent.length, 5)
+                self.assertEqual(torrent.piece_hash(0), bytes(20))
+
+
+if __name__ == '__main__':
+    unittest.main()
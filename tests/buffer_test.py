@@ -0,0 +1,24 @@
+import asyncio
+import unittest
+
+from torrent.buffer import BufferPool
+
+
+class BufferPoolTests(unittest.IsolatedAsyncioTestCase):
+    async def test_memory_cap(self):
+        pool = BufferPool(max_bytes=10)
+        assert pool.has_room(16)
+        pool.acquire(0, 16).write(4, b'abcd')
+        assert pool.get(0).data[4:8] == b'abcd'
+        assert not pool.has_room(1)
+
+        waiter = asyncio.create_task(pool.wait_for_room(8))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        pool.release(0)
+        await asyncio.wait_for(waiter, timeout=1)
+        assert pool.used == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
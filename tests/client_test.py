@@ -1,14 +1,29 @@
+import asyncio
+import tempfile
 import unittest
+from unittest import mock
 
 from log import get_logger
 from models.peer import Peer
 from models.torrent import Torrent
 from torrent.client import Client
 from torrent.tracker import TrackerClient
+from tests.helpers import make_torrent
 
 log = get_logger(__name__)
 
 
+class SlowDHT:
+    def __init__(self):
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.answer = asyncio.Event()
+
+    async def announce_peer(self, info_hash, port):
+        await self.answer.wait()
+        return [Peer('10.0.0.2', 6881)]
+
+
 class ClientTests(unittest.IsolatedAsyncioTestCase):
     async def test_peer_connect(self):
         torrent = Torrent('data/vsomasu_hw3_penpaper.torrent')
@@ -19,6 +34,22 @@ class ClientTests(unittest.IsolatedAsyncioTestCase):
         await client.connect()
         await client.download()
 
+    async def test_dht_peers_added_when_they_come_in(self):
+        with tempfile.TemporaryDirectory() as directory:
+            torrent_path, _ = make_torrent(directory, 2 ** 15, 2 ** 14, announce=None)
+            client = Client([], Torrent(torrent_path), path=directory)
+            client.dht = SlowDHT()
+            try:
+                with mock.patch.object(client.connections, 'start'):
+                    # The lookup is still going, the announce does not wait for it
+                    self.assertEqual([], await asyncio.wait_for(client.announce(), timeout=1))
+                    self.assertEqual({}, client.connections.candidates)
+                    client.dht.answer.set()
+                    await asyncio.sleep(0)
+                    self.assertIn(('10.0.0.2', 6881), client.connections.candidates)
+            finally:
+                client.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,119 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from models.peer import Peer
+from torrent.connections import ConnectionManager, PeerSource
+
+
+class FakePeerClient:
+    def __init__(self, peer, client):
+        self.peer = peer
+        self.client = client
+        self.is_closed = False
+        self.is_banned = False
+        self.pipeline = mock.Mock(rate=0.0)
+
+    async def connect(self):
+        self.client.attempts.append(self.peer.port)
+        self.client.half_open = max(self.client.half_open, self.client.connections.half_open)
+        await asyncio.sleep(0)
+        if self.peer.port in self.client.dead:
+            self.is_closed = True
+        else:
+            self.client.connected.append(self)
+
+    def close(self):
+        self.is_closed = True
+        self.client.connections.closed(self)
+
+
+class FakeClient:
+    def __init__(self, dead=()):
+        self.dead = set(dead)
+        self.attempts = []
+        self.connected = []
+        self.half_open = 0
+        self.connections = None
+
+    def acquire_connection(self):
+        return True
+
+    def create_peer(self, peer):
+        return FakePeerClient(peer, self)
+
+
+class ConnectionManagerTests(unittest.IsolatedAsyncioTestCase):
+    def make_manager(self, dead=(), **kwargs):
+        client = FakeClient(dead)
+        client.connections = ConnectionManager(client, **kwargs)
+        self.addCleanup(client.connections.stop)
+        return client, client.connections
+
+    async def test_half_open_limit(self):
+        client, manager = self.make_manager(max_half_open=3)
+        manager.add([Peer('10.0.0.1', port) for port in range(10)])
+        manager.start()
+        await manager.wait_for_peers()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(10, len(client.connected))
+        self.assertEqual(3, client.half_open)
+
+    async def test_max_peers_and_replacement(self):
+        client, manager = self.make_manager(max_peers=2)
+        manager.add([Peer('10.0.0.1', port) for port in range(4)])
+        manager.start()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(2, len(client.connected))
+        client.connected[0].close()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(3, len(client.connected))
+        self.assertEqual(2, manager.connected)
+
+    async def test_backoff_and_priority(self):
+        client, manager = self.make_manager(dead=[1], max_half_open=1)
+        manager.add([Peer('10.0.0.1', 1)], PeerSource.tracker)
+        manager.add([Peer('10.0.0.1', 2)], PeerSource.dht)
+        manager.add([Peer('10.0.0.1', 3)], PeerSource.manual)
+        manager.start()
+        await manager.wait_for_peers()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        # Most trusted source first, and the failed peer is not retried right away
+        self.assertEqual([3, 1, 2], client.attempts)
+        candidate = manager.candidates[('10.0.0.1', 1)]
+        self.assertEqual(1, candidate.failures)
+        self.assertTrue(manager.is_connecting)
+
+    async def test_gives_up_on_dead_peers(self):
+        client, manager = self.make_manager(dead=[1])
+        manager.add([Peer('10.0.0.1', 1)])
+        with mock.patch('torrent.connections.CONNECT_BACKOFF', 0):
+            manager.start()
+            await manager.wait_for_peers()
+        self.assertEqual(5, len(client.attempts))
+        self.assertFalse(manager.is_connecting)
+        manager.add([Peer('10.0.0.1', 1)])
+        self.assertFalse(manager.is_connecting)
+
+    async def test_stop_cancels_connects(self):
+        client, manager = self.make_manager(max_half_open=2)
+        manager.add([Peer('10.0.0.1', port) for port in range(2)])
+        manager.start()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(2, len(manager._connects))
+        manager.stop()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(set(), manager._connects)
+        self.assertEqual(0, manager.half_open)
+        self.assertEqual([], client.connected)
+        self.assertTrue(all(candidate.peer_client.is_closed for candidate in manager.candidates.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
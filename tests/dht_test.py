@@ -0,0 +1,143 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from const import DHT_K, DHT_MAX_FAILURES
+from dht.node import DHTNode, DHTError
+from dht.routing import NodeInfo, RoutingTable, distance, pack_nodes, unpack_nodes
+from models.torrent import Torrent
+from torrent.session import Session
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+def node_id(value: int) -> bytes:
+    return value.to_bytes(20, 'big')
+
+
+class RoutingTableTests(unittest.TestCase):
+    def test_split_near_own_id(self):
+        table = RoutingTable(node_id(0))
+        for i in range(1, 100):
+            table.add(NodeInfo(node_id(i), ('127.0.0.1', i)))
+        # Nodes close to us all fit, the far ones are bounded per bucket
+        self.assertGreater(len(table.buckets), 1)
+        self.assertTrue(all(len(bucket.nodes) <= DHT_K for bucket in table.buckets))
+        closest = table.closest(node_id(0))
+        self.assertEqual([node.id for node in closest], [node_id(i) for i in range(1, DHT_K + 1)])
+
+    def test_bad_node_replaced(self):
+        table = RoutingTable(node_id(0))
+        far = [node_id((1 << 159) + i) for i in range(DHT_K + 1)]
+        for i, nid in enumerate(far):
+            table.add(NodeInfo(nid, ('127.0.0.1', i + 1)))
+        self.assertIsNone(table.get(far[-1]))
+        for _ in range(DHT_MAX_FAILURES):
+            table.failed(far[0])
+        self.assertIsNone(table.get(far[0]))
+        self.assertIsNotNone(table.get(far[-1]))
+
+    def test_compact_nodes(self):
+        nodes = [NodeInfo(os.urandom(20), ('10.0.0.1', 6881)), NodeInfo(os.urandom(20), ('10.0.0.2', 1))]
+        unpacked = unpack_nodes(pack_nodes(nodes))
+        self.assertEqual([(n.id, n.addr) for n in unpacked], [(n.id, n.addr) for n in nodes])
+
+
+class DHTNodeTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.nodes = []
+        for _ in range(20):
+            node = DHTNode(host='127.0.0.1', bootstrap_nodes=[])
+            await node.start()
+            self.addCleanup(node.close)
+            self.nodes.append(node)
+        router = ('127.0.0.1', self.nodes[0].port)
+        for node in self.nodes[1:]:
+            await node.bootstrap([router])
+
+    async def test_find_node(self):
+        target = os.urandom(20)
+        found = await self.nodes[3].find_node(target)
+        expected = sorted((n.node_id for n in self.nodes if n is not self.nodes[3]),
+                          key=lambda nid: distance(nid, target))[:DHT_K]
+        self.assertEqual([node.id for node in found], expected)
+
+    async def test_announce_and_get_peers(self):
+        info_hash = os.urandom(20)
+        self.assertEqual(await self.nodes[5].announce_peer(info_hash, 6000), [])
+        peers = await self.nodes[12].get_peers(info_hash)
+        self.assertEqual([(peer.ip, peer.port) for peer in peers], [('127.0.0.1', 6000)])
+
+    async def test_bad_token(self):
+        target = self.nodes[1]
+        with self.assertRaises(DHTError):
+            await self.nodes[2]._query(('127.0.0.1', target.port), 'announce_peer',
+                                       {b'info_hash': os.urandom(20), b'port': 1, b'token': b'nope'})
+
+    async def test_invalid_port(self):
+        target, info_hash = self.nodes[1], os.urandom(20)
+        addr = ('127.0.0.1', target.port)
+        token = (await self.nodes[2]._query(addr, 'get_peers', {b'info_hash': info_hash}))[b'token']
+        for port in [0, 65536, -1, b'6881']:
+            with self.subTest(port=port), self.assertRaises(DHTError):
+                await self.nodes[2]._query(addr, 'announce_peer', {b'info_hash': info_hash, b'port': port,
+                                                                  b'token': token})
+        self.assertNotIn(info_hash, target.peers)
+        response = await self.nodes[2]._query(addr, 'get_peers', {b'info_hash': info_hash})
+        self.assertNotIn(b'values', response)
+
+    async def test_saved_table(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state_path = os.path.join(directory, 'dht.state')
+            node = DHTNode(host='127.0.0.1', state_path=state_path, bootstrap_nodes=[])
+            await node.start()
+            await node.bootstrap([('127.0.0.1', self.nodes[0].port)])
+            node.close()
+            restarted = DHTNode(host='127.0.0.1', state_path=state_path, bootstrap_nodes=[])
+            await restarted.start()
+            self.addCleanup(restarted.close)
+            self.assertEqual(restarted.node_id, node.node_id)
+            # No router needed this time
+            await restarted.bootstrap([])
+            self.assertGreaterEqual(len(restarted.table), DHT_K)
+
+
+class TrackerlessTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.torrent_path, self.data = make_torrent(self.dir.name, PIECE_LENGTH * 4, PIECE_LENGTH, announce=None)
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+
+    async def test_peers_from_dht(self):
+        router = DHTNode(host='127.0.0.1', bootstrap_nodes=[])
+        await router.start()
+        self.addCleanup(router.close)
+        torrent = Torrent(self.torrent_path)
+        self.assertEqual(torrent.announce_list, [])
+
+        seed = Session(self.seed_path, port=0, host='127.0.0.1', dht=True)
+        seed.dht.bootstrap_nodes = [('127.0.0.1', router.port)]
+        await seed.start()
+        await seed.add(torrent)
+        while torrent.info_hash not in router.peers:
+            await asyncio.sleep(0.01)
+
+        leech_path = os.path.join(self.dir.name, 'leech')
+        leech = Session(leech_path, port=0, host='127.0.0.1', dht=True)
+        leech.dht.bootstrap_nodes = [('127.0.0.1', router.port)]
+        await leech.start()
+        leech_torrent = Torrent(self.torrent_path)
+        await leech.add(leech_torrent)
+        await leech.wait(leech_torrent.info_hash)
+        self.assertTrue(leech.clients[leech_torrent.info_hash].scheduler.is_complete)
+        await leech.close()
+        await seed.close()
+        with open(os.path.join(leech_path, 'test.bin'), 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.client import Client, PeerClient
+from torrent.server import PeerServer
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+class EndgameTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.torrent_path, self.data = make_torrent(self.dir.name, PIECE_LENGTH * 64, PIECE_LENGTH)
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+
+    async def start_seed(self, upload_rate: int = 0) -> Client:
+        seed = Client([], Torrent(self.torrent_path), path=self.seed_path)
+        await seed.check()
+        seed.set_rate_limits(upload_rate=upload_rate)
+        server = PeerServer(port=0, host='127.0.0.1')
+        await server.start()
+        await seed.listen(server)
+        self.addCleanup(seed.close)
+        return seed
+
+    async def test_slow_peer_does_not_hold_the_last_pieces(self):
+        fast = await self.start_seed()
+        # The slow seed would need about 10 seconds for a single piece
+        slow = await self.start_seed(upload_rate=PIECE_LENGTH // 10)
+        leech = Client([Peer('127.0.0.1', fast.server.port, b'fast'), Peer('127.0.0.1', slow.server.port, b'slow')],
+                       Torrent(self.torrent_path), path=os.path.join(self.dir.name, 'leech'))
+        self.addCleanup(leech.close)
+        with mock.patch.object(PeerClient, 'cancel_request', autospec=True,
+                               side_effect=PeerClient.cancel_request) as cancel_request:
+            await leech.connect()
+            start = time.monotonic()
+            await leech.download()
+        self.assertTrue(leech.scheduler.is_complete)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertTrue(cancel_request.called)
+        with open(os.path.join(self.dir.name, 'leech', 'test.bin'), 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.client import Client
+from torrent.files import FileIndex, FilePriority
+from torrent.server import PeerServer
+from torrent.storage import Storage
+from tests.helpers import piece_hashes, write_torrent
+
+PIECE_LENGTH = 2 ** 14
+# Lengths of the files, none of them ending on a piece boundary
+FILE_LENGTHS = [PIECE_LENGTH * 3 + 100, PIECE_LENGTH * 10 + 200, 0, PIECE_LENGTH * 2 + 300]
+PATHS = [[b'a.bin'], [b'sub', b'dir', b'b.bin'], [b'empty'], [b'..', b'c.bin']]
+
+
+class FilesTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.files = [os.urandom(length) for length in FILE_LENGTHS]
+        self.torrent_path = os.path.join(self.dir.name, 'test.torrent')
+        write_torrent(self.torrent_path, {
+            b'name': b'multi', b'piece length': PIECE_LENGTH,
+            b'pieces': piece_hashes(b''.join(self.files), PIECE_LENGTH),
+            b'files': [{b'length': length, b'path': path} for length, path in zip(FILE_LENGTHS, PATHS)]})
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+        self.leech_path = os.path.join(self.dir.name, 'leech')
+        for path, content in zip(self.paths(self.seed_path), self.files):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    @staticmethod
+    def paths(root: str):
+        return [os.path.join(root, 'multi', 'a.bin'), os.path.join(root, 'multi', 'sub', 'dir', 'b.bin'),
+                os.path.join(root, 'multi', 'empty'), os.path.join(root, 'multi', 'c.bin')]
+
+    def test_paths_are_kept(self):
+        torrent = Torrent(self.torrent_path)
+        assert [file.path for file in torrent.files] == [os.path.relpath(path, 'root') for path in self.paths('root')]
+
+    def test_single_file_name_stays_inside(self):
+        torrent_path = os.path.join(self.dir.name, 'single.torrent')
+        write_torrent(torrent_path, {b'name': b'../x', b'length': 1, b'piece length': PIECE_LENGTH,
+                                     b'pieces': bytes(20)}, announce=None)
+        torrent = Torrent(torrent_path)
+        # The separator is replaced, so the name is a single component
+        self.assertEqual('.._x', torrent.filename)
+        self.assertEqual(['.._x'], [file.path for file in torrent.files])
+
+    def test_piece_priorities(self):
+        index = FileIndex(Torrent(self.torrent_path))
+        assert index.ranges == [range(0, 4), range(3, 14), range(0), range(13, 16)]
+        skip, normal, high = FilePriority.skip, FilePriority.normal, FilePriority.high
+        priorities = index.piece_priorities([high, skip, normal, normal])
+        assert priorities == [high] * 4 + [skip] * 9 + [normal] * 3
+        with self.assertRaises(ValueError):
+            index.piece_priorities([normal])
+
+    async def test_boundary_pieces_go_to_the_partfile(self):
+        torrent = Torrent(self.torrent_path)
+        storage = Storage(torrent, self.leech_path)
+        self.addCleanup(storage.close)
+        storage.skipped = {1}
+        storage.allocate()
+        b_path = self.paths(self.leech_path)[1]
+        self.assertFalse(os.path.exists(b_path))
+        data = b''.join(self.files)
+        # Piece 3 spans a.bin and b.bin, piece 13 b.bin and c.bin
+        for piece in (3, 13):
+            await storage.write(piece * PIECE_LENGTH, data[piece * PIECE_LENGTH:(piece + 1) * PIECE_LENGTH])
+        self.assertFalse(os.path.exists(b_path))
+        self.assertEqual(PIECE_LENGTH + 300, os.path.getsize(storage.part_path))
+        for piece in (3, 13):
+            self.assertEqual(data[piece * PIECE_LENGTH:(piece + 1) * PIECE_LENGTH],
+                             await storage.read(piece * PIECE_LENGTH, PIECE_LENGTH))
+
+        await storage.set_skipped(set())
+        with open(b_path, 'rb') as f:
+            b = f.read()
+        self.assertEqual(self.files[1][:PIECE_LENGTH - 100], b[:PIECE_LENGTH - 100])
+        self.assertEqual(self.files[1][-300:], b[-300:])
+        for piece in (3, 13):
+            self.assertEqual(data[piece * PIECE_LENGTH:(piece + 1) * PIECE_LENGTH],
+                             await storage.read(piece * PIECE_LENGTH, PIECE_LENGTH))
+
+    async def test_skipped_file_is_not_downloaded(self):
+        seed = Client([], Torrent(self.torrent_path), path=self.seed_path)
+        await seed.check()
+        self.assertTrue(seed.scheduler.is_complete)
+        server = PeerServer(port=0, host='127.0.0.1')
+        await server.start()
+        await seed.listen(server)
+        self.addCleanup(seed.close)
+
+        priorities = [FilePriority.normal, FilePriority.skip, FilePriority.normal, FilePriority.high]
+        leech = Client([Peer('127.0.0.1', server.port, b'seed')], Torrent(self.torrent_path), path=self.leech_path,
+                       file_priorities=priorities)
+        self.addCleanup(leech.close)
+        # The pieces of b.bin which do not overlap another file are not left
+        self.assertEqual(6 * PIECE_LENGTH + 600, leech.torrent.left)
+        await leech.connect()
+        await leech.download()
+        self.assertTrue(leech.scheduler.is_complete)
+        # Only the pieces overlapping a.bin or c.bin
+        self.assertEqual(4 + 3, leech.scheduler.downloaded)
+        self.assertEqual(0, leech.torrent.left)
+        paths = self.paths(self.leech_path)
+        self.assertFalse(os.path.exists(paths[1]))
+        for i in (0, 2, 3):
+            with open(paths[i], 'rb') as f:
+                self.assertEqual(self.files[i], f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,17 @@
+import hashlib
+import unittest
+
+from torrent.hasher import PieceHasher
+
+
+class HasherTests(unittest.IsolatedAsyncioTestCase):
+    async def test_verify(self):
+        hasher = PieceHasher()
+        data = b'x' * 2 ** 18
+        assert await hasher.verify(data, hashlib.sha1(data).digest())
+        assert not await hasher.verify(data[1:], hashlib.sha1(data).digest())
+        hasher.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
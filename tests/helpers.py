@@ -0,0 +1,41 @@
+import hashlib
+import os
+from typing import Optional, Tuple
+
+import bencodepy
+
+from bench import swarm
+
+ANNOUNCE = b'http://localhost/announce'
+
+
+def piece_hashes(data: bytes, piece_length: int) -> bytes:
+    """
+    Returns: the concatenated SHA1 of every piece of `data`
+    """
+    return b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+
+
+def write_torrent(path: str, info: dict, announce: Optional[bytes] = ANNOUNCE):
+    """
+    Writes a torrent file for an info dictionary, trackerless if `announce`
+    is None.
+    """
+    metainfo = {b'info': info}
+    if announce is not None:
+        metainfo[b'announce'] = announce
+    with open(path, 'wb') as f:
+        f.write(bencodepy.encode(metainfo))
+
+
+def make_torrent(directory: str, size: int, piece_length: int, name: str = 'test.bin', seed: int = 0,
+                 announce: Optional[bytes] = ANNOUNCE) -> Tuple[str, bytes]:
+    """
+    Writes a single file torrent in `directory`, and its data to
+    `directory`/seed/`name` for a seed to share.
+
+    Returns: the path of the torrent file and the data
+    """
+    torrent_path = swarm.make_torrent(directory, size, piece_length, seed, name, announce)
+    with open(os.path.join(directory, 'seed', name), 'rb') as f:
+        return torrent_path, f.read()
@@ -0,0 +1,52 @@
+import unittest
+from types import SimpleNamespace
+
+import bencodepy
+from aiohttp import web
+
+from const import AnnounceEvent
+from torrent import tracker
+from torrent.tracker import HttpTracker
+
+
+def make_torrent(info_hash):
+    return SimpleNamespace(info_hash=info_hash, peer_id='-PC0001-000000000000', downloaded=0, left=10,
+                           uploaded=0, port=6881)
+
+
+class HttpTrackerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/announce', self.handle_announce)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}/announce'
+
+    async def asyncTearDown(self):
+        await tracker.close_shared_sockets()
+        await self.runner.cleanup()
+
+    async def handle_announce(self, request):
+        self.requests.append((request.query, request.transport.get_extra_info('peername')))
+        peers = [{b'ip': b'10.0.0.%d' % i, b'port': 6881, b'peer id': bytes([i]) * 20} for i in range(200)]
+        return web.Response(body=bencodepy.encode({b'interval': 900, b'peers': peers}))
+
+    async def test_announce(self):
+        response = await HttpTracker(make_torrent(b'a' * 20), self.url).announce(AnnounceEvent.started)
+        self.assertEqual(900, response.interval)
+        self.assertEqual(200, len(response.peers))
+        query, _ = self.requests[0]
+        self.assertEqual('1', query['compact'])
+        self.assertEqual('started', query['event'])
+
+    async def test_connection_reused_across_torrents(self):
+        await HttpTracker(make_torrent(b'a' * 20), self.url).announce()
+        await HttpTracker(make_torrent(b'b' * 20), self.url).announce()
+        self.assertEqual(self.requests[0][1], self.requests[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
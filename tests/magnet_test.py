@@ -0,0 +1,98 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import bencodepy
+
+from const import METADATA_PIECE_SIZE
+from models.magnet import parse_magnet
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.metadata import MetadataError, MetadataFetcher
+from torrent.session import Session
+from tests.helpers import make_torrent, piece_hashes, write_torrent
+
+PIECE_LENGTH = 2 ** 14
+PIECE_COUNT = 8
+
+
+class MagnetTests(unittest.TestCase):
+    def test_parse(self):
+        info_hash = bytes(range(20))
+        magnet = parse_magnet(f'magnet:?xt=urn:btih:{info_hash.hex()}&dn=a%20b'
+                              f'&tr=udp%3A%2F%2Ftracker%3A80&tr=http%3A%2F%2Fother%2Fannounce&x.pe=10.0.0.1%3A6881')
+        self.assertEqual(magnet.info_hash, info_hash)
+        self.assertEqual(magnet.name, 'a b')
+        self.assertEqual(magnet.trackers, ['udp://tracker:80', 'http://other/announce'])
+        self.assertEqual([(p.ip, p.port) for p in magnet.peers], [('10.0.0.1', 6881)])
+        torrent = Torrent.from_magnet(magnet)
+        self.assertFalse(torrent.has_metadata)
+        self.assertEqual(torrent.announce_list, [['udp://tracker:80'], ['http://other/announce']])
+
+    def test_base32(self):
+        self.assertEqual(parse_magnet('magnet:?xt=urn:btih:' + 'A' * 32).info_hash, bytes(20))
+
+    def test_invalid(self):
+        for uri in ['http://example.com', 'magnet:?dn=nothing', 'magnet:?xt=urn:btih:1234']:
+            with self.assertRaises(ValueError):
+                parse_magnet(uri)
+
+
+class MetadataExchangeTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.torrent_path, self.data = make_torrent(self.dir.name, PIECE_LENGTH * PIECE_COUNT, PIECE_LENGTH,
+                                                    announce=None)
+        # A key we don't know of, large enough for the info dictionary to
+        # span several metadata pieces
+        info = {b'name': b'test.bin', b'length': len(self.data), b'piece length': PIECE_LENGTH,
+                b'pieces': piece_hashes(self.data, PIECE_LENGTH), b'x-padding': b'x' * 3 * METADATA_PIECE_SIZE}
+        write_torrent(self.torrent_path, info, announce=None)
+        self.info = bencodepy.encode(info)
+        self.info_hash = hashlib.sha1(self.info).digest()
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+
+    async def start_seeds(self, count: int):
+        seeds = []
+        for _ in range(count):
+            seed = Session(self.seed_path, port=0, host='127.0.0.1')
+            await seed.start()
+            await seed.add(Torrent(self.torrent_path), announce=False)
+            self.addAsyncCleanup(seed.close)
+            seeds.append(seed)
+        return seeds
+
+    async def test_fetch_from_several_peers(self):
+        self.assertGreater(len(self.info), 2 * METADATA_PIECE_SIZE)
+        seeds = await self.start_seeds(3)
+        torrent = Torrent.from_magnet(parse_magnet(f'magnet:?xt=urn:btih:{self.info_hash.hex()}'))
+        fetcher = MetadataFetcher(torrent, [Peer('127.0.0.1', seed.port) for seed in seeds])
+        metadata = await fetcher.fetch()
+        self.assertEqual(metadata, self.info)
+        torrent.set_metadata(metadata)
+        self.assertEqual(torrent.length, len(self.data))
+        self.assertEqual(torrent.download_info.piece_count, PIECE_COUNT)
+
+    async def test_no_peer_has_metadata(self):
+        torrent = Torrent.from_magnet(parse_magnet(f'magnet:?xt=urn:btih:{bytes(20).hex()}'))
+        fetcher = MetadataFetcher(torrent, [Peer('127.0.0.1', 1)])
+        with self.assertRaises(MetadataError):
+            await fetcher.fetch()
+
+    async def test_download_from_magnet(self):
+        seed, = await self.start_seeds(1)
+        leech_path = os.path.join(self.dir.name, 'leech')
+        leech = Session(leech_path, port=0, host='127.0.0.1')
+        await leech.start()
+        self.addAsyncCleanup(leech.close)
+        client = await leech.add_magnet(f'magnet:?xt=urn:btih:{self.info_hash.hex()}&x.pe=127.0.0.1:{seed.port}')
+        await leech.wait(self.info_hash)
+        self.assertTrue(client.scheduler.is_complete)
+        with open(os.path.join(leech_path, 'test.bin'), 'rb') as f:
+            self.assertEqual(self.data, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+import asyncio
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from const import PeerMessage, PROTOCOL, KEEP_ALIVE_INTERVAL, PEER_IDLE_TIMEOUT
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.client import Client, PeerClient, BLOCK_REQUEST, PIECE_HEADER
+from torrent.fast import allowed_fast_set
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 14
+PIECE_COUNT = 16
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+    def is_closing(self):
+        return self.closed
+
+    def messages(self):
+        """
+        Returns: (message id, payload) of what was written, keep-alives as None
+        """
+        messages, pos = [], 0
+        while pos < len(self.data):
+            (length,) = struct.unpack_from('!I', self.data, pos)
+            messages.append((self.data[pos + 4], bytes(self.data[pos + 5:pos + 4 + length])) if length else None)
+            pos += 4 + length
+        self.data.clear()
+        return messages
+
+
+def handshake(info_hash: bytes, reserved: bytes) -> bytes:
+    return struct.pack('>B19s8s20s20s', len(PROTOCOL), PROTOCOL, reserved, info_hash, b'-XX0001-000000000000')
+
+
+class PeerStateTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        torrent_path, _ = make_torrent(self.dir.name, PIECE_LENGTH * PIECE_COUNT, PIECE_LENGTH)
+        self.torrent = Torrent(torrent_path)
+        self.client = Client([], self.torrent, path=self.dir.name)
+        self.addCleanup(self.client.close)
+
+    def connect(self, fast: bool = True, peer_id: bytes = b'peer', port: int = 6881) -> PeerClient:
+        peer_client = PeerClient(Peer('10.0.0.1', port, peer_id), self.client)
+        peer_client.transport = RecordingTransport()
+        peer_client.handshake_received(handshake(self.torrent.info_hash, bytes(7) + (b'\x04' if fast else b'\x00')))
+        self.client.peer_connections[('10.0.0.1', port)] = peer_client
+        return peer_client
+
+    def receive(self, peer_client: PeerClient, message: PeerMessage, payload: bytes = b''):
+        peer_client.message_received(message.value, memoryview(payload))
+
+    def requests(self, peer_client: PeerClient):
+        return [BLOCK_REQUEST.unpack(payload) for message_id, payload in peer_client.transport.messages()
+                if message_id == PeerMessage.request.value]
+
+    async def test_fast_extension_negotiated(self):
+        self.assertTrue(self.connect(fast=True).is_fast)
+        self.assertFalse(self.connect(fast=False).is_fast)
+
+    async def test_connections_keyed_by_address(self):
+        # Both claim the same peer id, neither replaces the other
+        for port in (7001, 7002):
+            protocol = mock.Mock(transport=RecordingTransport())
+            self.client.accept(Peer('10.0.0.2', port, b'peer'), protocol, handshake(self.torrent.info_hash, bytes(8)))
+        self.assertEqual({('10.0.0.2', 7001), ('10.0.0.2', 7002)}, set(self.client.peer_connections))
+        self.client.peer_connections[('10.0.0.2', 7001)].connection_lost(None)
+        self.assertEqual([('10.0.0.2', 7002)], list(self.client.peer_connections))
+
+    async def test_have_all_and_have_none(self):
+        peer_client = self.connect()
+        self.receive(peer_client, PeerMessage.have_all)
+        self.assertTrue(peer_client.bitfield.all())
+        self.assertEqual([1] * PIECE_COUNT, list(self.client.availability.counts))
+        self.receive(peer_client, PeerMessage.have_none)
+        self.assertFalse(peer_client.bitfield.any())
+        self.assertTrue(peer_client.is_bit_field_received)
+        self.assertEqual([0] * PIECE_COUNT, list(self.client.availability.counts))
+
+    async def test_have_all_requires_fast_extension(self):
+        peer_client = self.connect(fast=False)
+        self.receive(peer_client, PeerMessage.have_all)
+        self.assertTrue(peer_client.is_closed)
+
+    async def test_bitfield_of_the_wrong_size(self):
+        for payload in (b'\xff', b'\xff\xff\x00'):
+            peer_client = self.connect()
+            self.receive(peer_client, PeerMessage.bitfield, payload)
+            self.assertTrue(peer_client.is_closed)
+            self.assertEqual([0] * PIECE_COUNT, list(self.client.availability.counts))
+
+    async def test_choke_drops_requests(self):
+        peer_client = self.connect(fast=False)
+        self.receive(peer_client, PeerMessage.bitfield, b'\xf0\x00')
+        self.receive(peer_client, PeerMessage.unchoke)
+        peer_client.scheduler = self.client.scheduler
+        peer_client._fill_pipeline()
+        sent = self.requests(peer_client)
+        self.assertTrue(sent)
+
+        self.receive(peer_client, PeerMessage.choke)
+        self.assertFalse(peer_client.pipeline.outstanding)
+        peer_client._fill_pipeline()
+        self.assertEqual([], self.requests(peer_client))
+
+        # The dropped requests are sent again once unchoked
+        self.receive(peer_client, PeerMessage.unchoke)
+        self.assertEqual(sent, self.requests(peer_client))
+
+    async def test_choked_worker_ends_with_the_download(self):
+        peer_client = self.connect(fast=False)
+        self.receive(peer_client, PeerMessage.bitfield, b'\xff\xff')
+        worker = asyncio.create_task(peer_client.download(self.client.scheduler))
+        await asyncio.sleep(0)
+        self.assertFalse(worker.done())
+        # Every piece arrives from other peers while this one keeps us choked
+        for piece_index in range(PIECE_COUNT):
+            self.client.piece_completed(piece_index)
+        await asyncio.wait_for(worker, timeout=1)
+
+    async def test_failed_write_requeues_the_piece(self):
+        peer_client = self.connect()
+        self.receive(peer_client, PeerMessage.have_all)
+        peer_client.scheduler = scheduler = self.client.scheduler
+        piece_index = scheduler.take(peer_client.bitfield)
+        self.client.buffers.acquire(piece_index, PIECE_LENGTH)
+        with mock.patch.object(self.client.hasher, 'verify', return_value=True), \
+                mock.patch.object(self.client.storage, 'write', side_effect=OSError(28, 'No space left on device')):
+            await peer_client._verify_piece(piece_index)
+        self.assertNotIn(piece_index, scheduler.assigned)
+        self.assertFalse(scheduler.have[piece_index])
+        self.assertIsNone(self.client.buffers.get(piece_index))
+        self.assertEqual(piece_index, scheduler.take(peer_client.bitfield))
+
+    async def test_piece_received_from_another_peer(self):
+        first, second = self.connect(), self.connect(peer_id=b'other', port=6882)
+        for peer_client in (first, second):
+            self.receive(peer_client, PeerMessage.have_all)
+            peer_client.scheduler = self.client.scheduler
+        piece_index = self.client.scheduler.take(first.bitfield)
+        first._queue_piece(piece_index)
+        # The second peer was asked for the same blocks in endgame, and sends them first
+        data = os.urandom(PIECE_LENGTH)
+        with mock.patch.object(self.client.hasher, 'verify', return_value=True):
+            for block in self.torrent.download_info.piece(piece_index).blocks():
+                second.pipeline.sent(block.piece, block.offset)
+                self.receive(second, PeerMessage.piece, PIECE_HEADER.pack(block.piece, block.offset) +
+                             data[block.offset:block.offset + block.length])
+            self.assertEqual(set(), first.active_pieces)
+            await asyncio.gather(*second.verify_tasks)
+        self.assertTrue(self.client.scheduler.have[piece_index])
+        first._release_pieces()
+        self.assertFalse(self.client.scheduler.remaining[piece_index])
+
+    async def test_allowed_fast_while_choked(self):
+        peer_client = self.connect()
+        self.receive(peer_client, PeerMessage.have_all)
+        self.receive(peer_client, PeerMessage.allowed_fast, struct.pack('!I', 2))
+        peer_client.scheduler = self.client.scheduler
+        peer_client._fill_pipeline()
+        self.assertEqual({2}, {piece_index for piece_index, _, _ in self.requests(peer_client)})
+
+    async def test_reject_requeues(self):
+        peer_client = self.connect()
+        self.receive(peer_client, PeerMessage.have_all)
+        self.receive(peer_client, PeerMessage.unchoke)
+        peer_client.scheduler = self.client.scheduler
+        peer_client._fill_pipeline()
+        first = self.requests(peer_client)[0]
+        self.receive(peer_client, PeerMessage.reject_request, BLOCK_REQUEST.pack(*first))
+        self.assertNotIn(first[:2], peer_client.pipeline.outstanding)
+        peer_client._fill_pipeline()
+        self.assertEqual([first], self.requests(peer_client))
+
+    async def test_requests_rejected_while_choking(self):
+        for piece_index in range(PIECE_COUNT):
+            self.client.piece_completed(piece_index)
+        peer_client = self.connect()
+        peer_client._send_bitfield()
+        messages = peer_client.transport.messages()
+        self.assertEqual(PeerMessage.have_all.value, messages[0][0])
+        allowed = {struct.unpack('!I', payload)[0] for message_id, payload in messages[1:]
+                   if message_id == PeerMessage.allowed_fast.value}
+        self.assertEqual(set(allowed_fast_set('10.0.0.1', self.torrent.info_hash, PIECE_COUNT, 10)), allowed)
+
+        refused = next(i for i in range(PIECE_COUNT) if i not in allowed)
+        self.receive(peer_client, PeerMessage.request, BLOCK_REQUEST.pack(refused, 0, PIECE_LENGTH))
+        self.assertEqual([(PeerMessage.reject_request.value, BLOCK_REQUEST.pack(refused, 0, PIECE_LENGTH))],
+                         peer_client.transport.messages())
+
+    async def test_keep_alive_and_idle_timeout(self):
+        peer_client = self.connect()
+        now = peer_client.last_sent
+        self.client.check_idle(now + KEEP_ALIVE_INTERVAL)
+        self.assertEqual([None], peer_client.transport.messages())
+        self.client.check_idle(peer_client.last_received + PEER_IDLE_TIMEOUT)
+        self.assertTrue(peer_client.is_closed)
+
+    async def test_have_restarts_the_worker(self):
+        peer_client = self.connect()
+        peer_client.is_connected = True
+        self.receive(peer_client, PeerMessage.have_none)
+        download = asyncio.create_task(self.client.download())
+        await asyncio.sleep(0)
+        self.assertEqual({}, self.client.downloader._workers)
+
+        self.receive(peer_client, PeerMessage.have, struct.pack('!I', 3))
+        self.assertIn(peer_client, self.client.downloader._workers)
+        self.assertEqual([(PeerMessage.interested.value, b'')], peer_client.transport.messages())
+        # Nothing left to get from the peer once the piece came from elsewhere
+        await asyncio.sleep(0)
+        self.client.scheduler.complete(3)
+        for _ in range(3):
+            await asyncio.sleep(0)
+        self.assertEqual({}, self.client.downloader._workers)
+        self.assertEqual([(PeerMessage.not_interested.value, b'')], peer_client.transport.messages())
+
+        self.client.downloader.stop()
+        await download
+
+    def test_allowed_fast_set(self):
+        # Example from BEP 6
+        info_hash = b'\xaa' * 20
+        self.assertEqual([1059, 431, 808, 1217, 287, 376, 1188], allowed_fast_set('80.4.4.200', info_hash, 1313, 7))
+        self.assertEqual([1059, 431, 808, 1217, 287, 376, 1188, 353, 508],
+                         allowed_fast_set('80.4.4.200', info_hash, 1313, 9))
+
+
+if __name__ == '__main__':
+    unittest.main()
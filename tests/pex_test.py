@@ -0,0 +1,112 @@
+import asyncio
+import os
+import socket
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import bencodepy
+from bitarray import bitarray
+
+from const import PEX_SEED_FLAG
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.connections import PeerSource
+from torrent.pex import PeerExchange, pack_peers
+from torrent.session import Session
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+class PeerExchangeTests(unittest.TestCase):
+    def setUp(self):
+        self.client = SimpleNamespace(peer_connections={}, torrent=SimpleNamespace(port=6881),
+                                      scheduler=SimpleNamespace(is_complete=False), add_peers=mock.Mock())
+        self.pex = PeerExchange(self.client)
+        transport = mock.Mock()
+        transport.get_extra_info.return_value = ('10.0.0.1', 50000)
+        self.sender = mock.Mock(peer=Peer('10.0.0.2', 6881), transport=transport)
+
+    def message(self, *addrs, flags=b''):
+        return {b'added': pack_peers(list(addrs)), b'added.f': flags, b'dropped': b''}
+
+    def test_added_peers_become_candidates(self):
+        self.pex.received(self.sender, self.message(('10.0.0.3', 1000), ('10.0.0.1', 6881)))
+        # Our own address is left out
+        peers, source = self.client.add_peers.call_args[0]
+        self.assertEqual([(p.ip, p.port) for p in peers], [('10.0.0.3', 1000)])
+        self.assertEqual(source, PeerSource.pex)
+
+    def test_flood_ignored(self):
+        self.pex.received(self.sender, self.message(('10.0.0.3', 1000)))
+        self.pex.received(self.sender, self.message(('10.0.0.4', 1000)))
+        self.assertEqual(self.client.add_peers.call_count, 1)
+
+    def test_seeds_skipped_when_seeding(self):
+        self.client.scheduler.is_complete = True
+        self.pex.received(self.sender, self.message(('10.0.0.3', 1000), ('10.0.0.4', 1000),
+                                                    flags=bytes([PEX_SEED_FLAG, 0])))
+        peers, _ = self.client.add_peers.call_args[0]
+        self.assertEqual([(p.ip, p.port) for p in peers], [('10.0.0.4', 1000)])
+
+    def connected(self, ip: str, listen_port: int = 6881):
+        peer_client = mock.Mock(peer=Peer(ip, 1), is_closed=False, listen_port=listen_port, is_outgoing=True,
+                                bitfield=bitarray('10'), extensions={b'ut_pex': 1})
+        self.client.peer_connections[ip] = peer_client
+        return peer_client
+
+    def test_ipv6_peers_sent_apart(self):
+        receiver = self.connected('10.0.0.2')
+        self.connected('2001:db8::1', 7000)
+        self.connected('::ffff:10.0.0.3', 8000)
+        self.connected('not an address')
+        self.pex.send(receiver)
+        (name, payload), _ = receiver.send_extended.call_args
+        message = bencodepy.decode(payload)
+        self.assertEqual(pack_peers([('10.0.0.3', 8000)]), message[b'added'])
+        self.assertEqual(socket.inet_pton(socket.AF_INET6, '2001:db8::1') + (7000).to_bytes(2, 'big'),
+                         message[b'added6'])
+        self.assertEqual(1, len(message[b'added.f']))
+        self.assertEqual(1, len(message[b'added6.f']))
+
+    def test_added6_peers_become_candidates(self):
+        added6 = socket.inet_pton(socket.AF_INET6, '2001:db8::1') + (7000).to_bytes(2, 'big')
+        self.pex.received(self.sender, {b'added': b'', b'added6': added6 + b'\x00'})
+        peers, _ = self.client.add_peers.call_args[0]
+        self.assertEqual([('2001:db8::1', 7000)], [(p.ip, p.port) for p in peers])
+
+
+class SwarmTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.torrent_path, _ = make_torrent(self.dir.name, PIECE_LENGTH * 4, PIECE_LENGTH, announce=None)
+
+    async def start(self, name: str, peers=None) -> Session:
+        session = Session(os.path.join(self.dir.name, name), port=0, host='127.0.0.1')
+        await session.start()
+        self.addAsyncCleanup(session.close)
+        await session.add(Torrent(self.torrent_path), peers, announce=False)
+        return session
+
+    async def test_peers_learnt_from_the_seed(self):
+        seed = await self.start('seed')
+        seed_client, = seed.clients.values()
+        first = await self.start('first', [Peer('127.0.0.1', seed.port)])
+        while not any(pc.listen_port == first.port for pc in seed_client.peer_connections.values()):
+            await asyncio.sleep(0.01)
+
+        second = await self.start('second', [Peer('127.0.0.1', seed.port)])
+        second_client, = second.clients.values()
+        # The seed tells the second peer about the first one as soon as they connect
+        async with asyncio.timeout(5):
+            while ('127.0.0.1', first.port) not in second_client.connections.candidates:
+                await asyncio.sleep(0.01)
+        candidate = second_client.connections.candidates[('127.0.0.1', first.port)]
+        self.assertEqual(candidate.source, PeerSource.pex)
+
+
+if __name__ == '__main__':
+    unittest.main()
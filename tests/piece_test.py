@@ -0,0 +1,34 @@
+import unittest
+
+from const import BLOCK_SIZE
+from models.piece import DownloadInfo, BlockState
+
+
+class DownloadInfoTests(unittest.TestCase):
+    def test_blocks(self):
+        info = DownloadInfo(3, 4 * BLOCK_SIZE, 9 * BLOCK_SIZE + 10)
+        assert info.block_count == 10
+        assert info.piece_block_count(2) == 2
+        assert [block.length for block in info.piece(2).blocks()] == [BLOCK_SIZE, 10]
+
+        assert info.mark_received(2, BLOCK_SIZE)
+        assert not info.mark_received(2, BLOCK_SIZE)
+        assert not info.is_received(2)
+        info.mark_requested(2, 0)
+        assert info.block_state[8] == BlockState.PENDING
+        assert info.mark_received(2, 0)
+        assert info.is_received(2)
+
+        info.reset(2)
+        assert info.received[2] == 0
+        assert info.block_state.tobytes() == bytes(10)
+
+    def test_large_torrent(self):
+        # 50 GB with 256 KiB pieces
+        info = DownloadInfo(200_000, 2 ** 18, 200_000 * 2 ** 18)
+        assert info.block_count == 3_200_000
+        assert len(info.block_state) == 3_200_000
+
+
+if __name__ == '__main__':
+    unittest.main()
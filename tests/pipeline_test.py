@@ -0,0 +1,30 @@
+import unittest
+from unittest import mock
+
+from const import BLOCK_SIZE
+from torrent.pipeline import RequestPipeline
+
+
+class PipelineTests(unittest.TestCase):
+    def test_depth_follows_bandwidth_delay_product(self):
+        pipeline = RequestPipeline(depth=4, min_depth=2, max_depth=100)
+        clock = [0.0]
+        with mock.patch('torrent.pipeline.time.monotonic', side_effect=lambda: clock[0]):
+            pipeline._window_start = 0.0
+            # 50 ms round trip, 64 blocks per second
+            for i in range(64):
+                pipeline.sent(0, i * BLOCK_SIZE)
+                clock[0] += 0.05
+                assert pipeline.received(0, i * BLOCK_SIZE, BLOCK_SIZE)
+                clock[0] -= 0.05 - 1 / 64
+        # 2 * (64 * BLOCK_SIZE/s * 0.05s) / BLOCK_SIZE
+        assert pipeline.depth == 7
+        assert pipeline.free == 7
+
+    def test_unrequested_block(self):
+        pipeline = RequestPipeline()
+        assert not pipeline.received(0, 0, BLOCK_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import struct
+import unittest
+
+from const import HANDSHAKE_LEN
+from torrent.protocol import PeerProtocol
+
+
+class RecordingHandler:
+    def __init__(self):
+        self.handshake = None
+        self.messages = []
+        self.keep_alives = 0
+
+    def handshake_received(self, handshake: bytes):
+        self.handshake = handshake
+
+    def message_received(self, message_id: int, payload: memoryview):
+        self.messages.append((message_id, bytes(payload)))
+
+    def keep_alive_received(self):
+        self.keep_alives += 1
+
+    def connection_lost(self, exc):
+        pass
+
+
+class OpenTransport:
+    def __init__(self):
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class ProtocolTests(unittest.TestCase):
+    def _feed(self, protocol: PeerProtocol, data: bytes, chunk: int):
+        for i in range(0, len(data), chunk):
+            part = data[i:i + chunk]
+            buffer = protocol.get_buffer(len(part))
+            n = min(len(part), len(buffer))
+            buffer[:n] = part[:n]
+            protocol.buffer_updated(n)
+            if n < len(part):
+                self._feed(protocol, part[n:], chunk)
+
+    def test_framing(self):
+        big = bytes(range(256)) * 100
+        stream = b'h' * HANDSHAKE_LEN + \
+            struct.pack('!I', 0) + \
+            struct.pack('!IB', 1, 1) + \
+            struct.pack('!IB', 1 + len(big), 7) + big + \
+            struct.pack('!IBI', 5, 4, 3)
+        for chunk in (1, 7, 1000, len(stream)):
+            handler = RecordingHandler()
+            protocol = PeerProtocol(handler, buffer_size=64)
+            protocol.connection_made(OpenTransport())
+            self._feed(protocol, stream, chunk)
+            assert handler.handshake == b'h' * HANDSHAKE_LEN
+            assert handler.keep_alives == 1
+            assert handler.messages == [(1, b''), (7, big), (4, struct.pack('!I', 3))]
+
+    def test_oversized_message_closes(self):
+        handler = RecordingHandler()
+        protocol = PeerProtocol(handler, buffer_size=128, max_length=1000)
+        transport = OpenTransport()
+        protocol.connection_made(transport)
+        self._feed(protocol, b'h' * HANDSHAKE_LEN + struct.pack('!IB', 2 ** 28, 7) + bytes(100), 1000)
+        assert transport.closed
+        assert handler.messages == []
+        assert len(protocol._buffer) == 128
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from unittest import mock
+
+from torrent.ratelimit import TokenBucket
+
+
+class TokenBucketTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = [0.0]
+        patcher = mock.patch('torrent.ratelimit.time.monotonic', side_effect=lambda: self.clock[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unlimited(self):
+        bucket = TokenBucket()
+        for _ in range(1000):
+            self.assertTrue(bucket.try_consume(2 ** 20))
+        self.assertEqual(0.0, bucket.delay())
+
+    def test_rate(self):
+        bucket = TokenBucket(1000)
+        self.assertTrue(bucket.try_consume(1500))
+        # Overdrawn until the debt is paid back
+        self.assertFalse(bucket.try_consume(1))
+        self.assertAlmostEqual(0.5, bucket.delay(), places=2)
+        self.clock[0] = 0.6
+        self.assertTrue(bucket.try_consume(1))
+
+    def test_burst_is_bounded(self):
+        bucket = TokenBucket(1000)
+        self.clock[0] = 100.0
+        self.assertTrue(bucket.try_consume(1000))
+        self.assertFalse(bucket.try_consume(1))
+
+    def test_chain(self):
+        session = TokenBucket(1000)
+        peers = [TokenBucket(parent=session), TokenBucket(parent=session)]
+        self.assertTrue(peers[0].try_consume(1000))
+        self.assertFalse(peers[1].try_consume(1))
+        self.assertGreater(peers[1].delay(), 0)
+
+    def test_child_limit(self):
+        session = TokenBucket()
+        peer = TokenBucket(100, parent=session)
+        self.assertTrue(peer.try_consume(100))
+        self.assertFalse(peer.try_consume(1))
+
+    def test_set_rate(self):
+        bucket = TokenBucket(1000)
+        bucket.try_consume(5000)
+        self.assertFalse(bucket.try_consume(1))
+        bucket.set_rate(0)
+        self.assertTrue(bucket.try_consume(1))
+        bucket.set_rate(10)
+        self.assertTrue(bucket.try_consume(10))
+        self.assertFalse(bucket.try_consume(1))
+        self.assertLessEqual(bucket.delay(), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
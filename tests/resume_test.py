@@ -0,0 +1,66 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from models.torrent import Torrent
+from torrent.client import Client
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+class ResumeTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.torrent_path, self.data = make_torrent(self.dir.name, PIECE_LENGTH * 4, PIECE_LENGTH)
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+        self.file_path = os.path.join(self.seed_path, 'test.bin')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _client(self) -> Client:
+        return Client([], Torrent(self.torrent_path), path=self.seed_path)
+
+    async def test_resume_without_rehash(self):
+        client = self._client()
+        assert not await client.resume()
+        await client.check()
+        client.close()
+
+        client = self._client()
+        with mock.patch.object(client.hasher, 'verify') as verify:
+            assert await client.resume()
+            verify.assert_not_called()
+        assert client.scheduler.is_complete
+        client.close()
+
+    async def test_saved_on_the_disk_thread(self):
+        client = self._client()
+        await client.check()
+        threads = []
+        with mock.patch.object(client.resume_data, 'save',
+                               side_effect=lambda have: threads.append(threading.current_thread().name)):
+            await client.save_resume()
+            await client.save_resume()
+        client.close()
+        assert len(threads) == 1 and threads[0].startswith('disk')
+
+    async def test_changed_file_is_rehashed(self):
+        client = self._client()
+        await client.check()
+        client.close()
+
+        with open(self.file_path, 'r+b') as f:
+            f.seek(PIECE_LENGTH)
+            f.write(b'corrupt')
+        client = self._client()
+        assert await client.resume()
+        assert client.scheduler.have.to01() == '1011'
+        client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
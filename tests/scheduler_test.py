@@ -0,0 +1,59 @@
+import unittest
+
+from bitarray import bitarray
+
+from models.piece import DownloadInfo
+from torrent.availability import AvailabilityIndex, PickPolicy
+from torrent.scheduler import PieceScheduler
+
+
+class SchedulerTests(unittest.IsolatedAsyncioTestCase):
+    def _scheduler(self, piece_count: int, *bitfields: str) -> PieceScheduler:
+        availability = AvailabilityIndex(piece_count)
+        for bits in bitfields:
+            availability.add_bitfield(bitarray(bits))
+        return PieceScheduler(DownloadInfo(piece_count, 16, 16 * piece_count), availability, PickPolicy.sequential)
+
+    async def test_peers_get_distinct_pieces(self):
+        have = bitarray('111')
+        scheduler = self._scheduler(3, '111', '111')
+        first = await scheduler.next_piece(have)
+        second = await scheduler.next_piece(have)
+        assert (first, second) == (0, 1)
+
+        scheduler.release(first)
+        scheduler.complete(second)
+        assert await scheduler.next_piece(have) == 0
+        assert await scheduler.next_piece(have) == 2
+        assert scheduler.take(have) is None
+
+    async def test_no_work_for_peer(self):
+        scheduler = self._scheduler(2, '10')
+        scheduler.complete(0)
+        assert await scheduler.next_piece(bitarray('10')) is None
+
+
+class AvailabilityTests(unittest.TestCase):
+    def test_rarest_first(self):
+        availability = AvailabilityIndex(3)
+        availability.add_bitfield(bitarray('111'))
+        availability.add_bitfield(bitarray('101'))
+        availability.add_piece(0)
+        assert availability.pick(bitarray('111')) == 1
+
+        availability.remove_bitfield(bitarray('111'))
+        assert availability.counts == [2, 0, 1]
+        assert availability.pick(bitarray('111')) == 2
+
+    def test_withdrawn_pieces_are_not_picked(self):
+        availability = AvailabilityIndex(2)
+        availability.add_bitfield(bitarray('11'))
+        availability.withdraw(0)
+        availability.withdraw(1)
+        assert availability.pick(bitarray('11')) is None
+        availability.restore(1)
+        assert availability.pick(bitarray('11')) == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.client import Client
+from torrent.connections import PeerSource
+from torrent.server import PeerServer
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+class SeedTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.torrent_path, self.data = make_torrent(self.dir.name, PIECE_LENGTH * 5 + 1000, PIECE_LENGTH)
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+        self.leech_path = os.path.join(self.dir.name, 'leech')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def start_client(self, path: str) -> Client:
+        client = Client([], Torrent(self.torrent_path), path=path)
+        self.addCleanup(client.close)
+        server = PeerServer(port=0, host='127.0.0.1')
+        await server.start()
+        self.addCleanup(server.close)
+        await client.listen(server)
+        return client
+
+    async def test_download_from_seed(self):
+        seed = Client([], Torrent(self.torrent_path), path=self.seed_path)
+        await seed.check()
+        assert seed.scheduler.is_complete
+        server = PeerServer(port=0, host='127.0.0.1')
+        await server.start()
+        await seed.listen(server)
+
+        leech = Client([Peer('127.0.0.1', server.port, b'seed')], Torrent(self.torrent_path), path=self.leech_path)
+        await leech.connect()
+        await leech.download()
+        assert leech.scheduler.is_complete
+        assert seed.upload_meter.total == len(self.data)
+
+        leech.close()
+        seed.close()
+        server.close()
+        with open(os.path.join(self.leech_path, 'test.bin'), 'rb') as f:
+            assert f.read() == self.data
+
+    async def test_peer_arriving_during_download(self):
+        seed = await self.start_client(self.seed_path)
+        await seed.check()
+        leech = Client([], Torrent(self.torrent_path), path=self.leech_path)
+        self.addCleanup(leech.close)
+        download = asyncio.create_task(leech.download())
+        await asyncio.sleep(0.1)
+        # Nobody to download from yet, the download waits for peers
+        self.assertFalse(download.done())
+        leech.add_peers([Peer('127.0.0.1', seed.torrent.port)], PeerSource.manual)
+        await asyncio.wait_for(download, timeout=10)
+        self.assertTrue(leech.scheduler.is_complete)
+
+    async def test_seed_connects_without_interest(self):
+        seed = Client([], Torrent(self.torrent_path), path=self.seed_path)
+        self.addCleanup(seed.close)
+        await seed.check()
+        leech = await self.start_client(self.leech_path)
+        seed.add_peers([Peer('127.0.0.1', leech.torrent.port)], PeerSource.manual)
+        await asyncio.wait_for(seed.connections.wait_for_peers(), timeout=10)
+        # The handshakes are enough, the leech does not have to unchoke us
+        self.assertEqual(1, seed.connections.connected)
+        (peer_client,) = seed.peer_connections.values()
+        self.assertTrue(peer_client.is_connected)
+        self.assertFalse(peer_client.is_interested)
+
+    async def test_download_over_accepted_connection(self):
+        seed = Client([], Torrent(self.torrent_path), path=self.seed_path)
+        self.addCleanup(seed.close)
+        await seed.check()
+        leech = await self.start_client(self.leech_path)
+        download = asyncio.create_task(leech.download())
+        # The seed dials the leech, which still downloads over that connection
+        seed.add_peers([Peer('127.0.0.1', leech.torrent.port)], PeerSource.manual)
+        await asyncio.wait_for(download, timeout=10)
+        self.assertTrue(leech.scheduler.is_complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
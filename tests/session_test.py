@@ -0,0 +1,92 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.client import Client
+from torrent.session import Session
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+class SessionTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.seed_path = os.path.join(self.dir.name, 'seed')
+        self.leech_path = os.path.join(self.dir.name, 'leech')
+        self.data = {}
+        self.torrent_paths = []
+        for i, name in enumerate(('a.bin', 'b.bin', 'c.bin')):
+            # Each torrent gets its own data
+            torrent_path, self.data[name] = make_torrent(self.dir.name, PIECE_LENGTH * 4 + 100, PIECE_LENGTH, name, i)
+            self.torrent_paths.append(torrent_path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    async def test_many_torrents_share_one_port(self):
+        seed = Session(self.seed_path, port=0, host='127.0.0.1')
+        await seed.start()
+        for torrent_path in self.torrent_paths:
+            client = await seed.add(Torrent(torrent_path), announce=False)
+            self.assertTrue(client.scheduler.is_complete)
+
+        leech = Session(self.leech_path, port=0, host='127.0.0.1')
+        await leech.start()
+        torrents = [Torrent(torrent_path) for torrent_path in self.torrent_paths]
+        for torrent in torrents:
+            await leech.add(torrent, [Peer('127.0.0.1', seed.port, b'seed')], announce=False)
+        for torrent in torrents:
+            await leech.wait(torrent.info_hash)
+            self.assertTrue(leech.clients[torrent.info_hash].scheduler.is_complete)
+        self.assertEqual(len(torrents), leech.connections)
+
+        await leech.close()
+        await seed.close()
+        self.assertEqual(0, leech.connections)
+        for name, data in self.data.items():
+            with open(os.path.join(self.leech_path, name), 'rb') as f:
+                self.assertEqual(data, f.read())
+
+    async def test_connection_limit(self):
+        seed = Session(self.seed_path, port=0, host='127.0.0.1')
+        await seed.start()
+        for torrent_path in self.torrent_paths:
+            await seed.add(Torrent(torrent_path), announce=False)
+
+        leech = Session(self.leech_path, port=0, host='127.0.0.1', max_connections=1)
+        await leech.start()
+        first, second = Torrent(self.torrent_paths[0]), Torrent(self.torrent_paths[1])
+        await leech.add(first, [Peer('127.0.0.1', seed.port, b'seed')], announce=False)
+        await leech.wait(first.info_hash)
+        await leech.add(second, [Peer('127.0.0.1', seed.port, b'seed')], announce=False)
+        # The second torrent waits for the first one to free its connection
+        await asyncio.sleep(0.1)
+        self.assertTrue(leech.clients[first.info_hash].scheduler.is_complete)
+        self.assertFalse(leech.clients[second.info_hash].peer_connections)
+        self.assertEqual(1, leech.connections)
+
+        await leech.close()
+        await seed.close()
+
+    async def test_new_files_are_not_hashed(self):
+        session = Session(self.leech_path, port=0, host='127.0.0.1')
+        await session.start()
+        self.addAsyncCleanup(session.close)
+        with mock.patch.object(Client, 'check', autospec=True, side_effect=Client.check) as check:
+            await session.add(Torrent(self.torrent_paths[0]), announce=False)
+            check.assert_not_called()
+            seed = Session(self.seed_path, port=0, host='127.0.0.1')
+            await seed.start()
+            self.addAsyncCleanup(seed.close)
+            client = await seed.add(Torrent(self.torrent_paths[0]), announce=False)
+            check.assert_called_once()
+        self.assertTrue(client.scheduler.is_complete)
+
+
+if __name__ == '__main__':
+    unittest.main()
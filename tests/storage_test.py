@@ -0,0 +1,68 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from models.torrent import File
+from torrent.storage import Storage, FilePool, ReadCache
+
+
+class StorageTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        torrent = SimpleNamespace(files=[File(5, 'a'), File(0, 'empty'), File(3, 'b'), File(4, 'c')])
+        self.storage = Storage(torrent, self.dir.name, pool=FilePool(max_open=1))
+        self.storage.allocate()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_spans(self):
+        assert self.storage.spans(0, 5) == [(0, 0, 5)]
+        assert self.storage.spans(4, 6) == [(0, 4, 1), (2, 0, 3), (3, 0, 2)]
+        assert self.storage.spans(8, 4) == [(3, 0, 4)]
+
+    async def test_write_across_files(self):
+        await self.storage.write(3, b'abcdefg')
+        assert await self.storage.read(0, 12) == b'\0\0\0abcdefg\0\0'
+        with open(os.path.join(self.dir.name, 'b'), 'rb') as f:
+            assert f.read() == b'cde'
+
+
+class SlowStorage:
+    """
+    Storage whose reads of a piece finish once it is released.
+    """
+
+    def __init__(self, piece_length: int):
+        self.torrent = SimpleNamespace(piece_length=piece_length, piece_size=lambda index: piece_length)
+        self.released = {}
+
+    async def read(self, offset: int, length: int) -> bytes:
+        event = self.released.setdefault(offset // self.torrent.piece_length, asyncio.Event())
+        await event.wait()
+        return bytes(length)
+
+
+class ReadCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def test_pending_reads_are_not_evicted(self):
+        storage = SlowStorage(10)
+        cache = ReadCache(storage, max_bytes=20)
+        pending = asyncio.create_task(cache.read(0, 0, 10))
+        await asyncio.sleep(0)
+        for piece_index in (1, 2, 3):
+            storage.released[piece_index] = asyncio.Event()
+            storage.released[piece_index].set()
+            await cache.read(piece_index, 0, 10)
+        self.assertIn(0, cache._pieces)
+        storage.released[0].set()
+        await pending
+        cached = sum(len(future.result()) for future in cache._pieces.values())
+        self.assertEqual(cached, cache.used)
+        self.assertLessEqual(cache.used, cache.max_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
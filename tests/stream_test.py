@@ -0,0 +1,111 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+import aiohttp
+from bitarray import bitarray
+
+from models.peer import Peer
+from models.piece import DownloadInfo
+from models.torrent import Torrent
+from torrent.availability import AvailabilityIndex, PickPolicy
+from torrent.client import Client
+from torrent.scheduler import PieceScheduler
+from torrent.server import PeerServer
+from torrent.stream import StreamServer
+from tests.helpers import make_torrent
+
+PIECE_LENGTH = 2 ** 15
+
+
+class DeadlineTests(unittest.TestCase):
+    def _scheduler(self, piece_count: int) -> PieceScheduler:
+        availability = AvailabilityIndex(piece_count)
+        availability.add_bitfield(bitarray('1' * piece_count))
+        return PieceScheduler(DownloadInfo(piece_count, 16, 16 * piece_count), availability, PickPolicy.rarest_first)
+
+    def test_deadlines_come_first(self):
+        scheduler = self._scheduler(8)
+        now = time.monotonic()
+        scheduler.set_deadline(6, now + 20)
+        scheduler.set_deadline(5, now + 10)
+        have = bitarray('11111111')
+        assert scheduler.take(have) == 5
+        assert scheduler.take(have) == 6
+        assert scheduler.take(bitarray('00000001')) == 7
+
+    def test_urgent_pieces(self):
+        scheduler = self._scheduler(4)
+        now = time.monotonic()
+        scheduler.set_deadline(0, now)
+        scheduler.set_deadline(1, now + 60)
+        have = bitarray('1111')
+        assert scheduler.urgent(have) == []
+        scheduler.take(have)
+        scheduler.take(have)
+        assert scheduler.urgent(have) == [0]
+        assert scheduler.urgent(bitarray('0111')) == []
+        scheduler.complete(0)
+        assert scheduler.urgent(have) == []
+        assert 0 not in scheduler.deadlines
+
+
+class StreamServerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        torrent_path, self.data = make_torrent(self.dir.name, PIECE_LENGTH * 64 + 1000, PIECE_LENGTH, 'movie.mp4')
+        seed = Client([], Torrent(torrent_path), path=os.path.join(self.dir.name, 'seed'))
+        await seed.check()
+        # Slow enough for the whole file to take a few seconds
+        seed.set_rate_limits(upload_rate=16 * PIECE_LENGTH)
+        server = PeerServer(port=0, host='127.0.0.1')
+        await server.start()
+        await seed.listen(server)
+        self.addCleanup(seed.close)
+
+        self.leech = Client([Peer('127.0.0.1', server.port, b'seed')], Torrent(torrent_path),
+                            PickPolicy.rarest_first, path=os.path.join(self.dir.name, 'leech'))
+        self.addCleanup(self.leech.close)
+        self.server = StreamServer({self.leech.torrent.info_hash: self.leech}, port=0)
+        await self.server.start()
+        self.addAsyncCleanup(self.server.close)
+        self.url = f'http://127.0.0.1:{self.server.port}/{self.leech.torrent.info_hash.hex()}'
+
+    async def test_range_is_served_before_the_download_ends(self):
+        await self.leech.connect()
+        download = asyncio.create_task(self.leech.download())
+        self.addCleanup(download.cancel)
+        start = len(self.data) - 3 * PIECE_LENGTH
+        async with aiohttp.ClientSession() as http:
+            async with http.get(f'{self.url}/0/movie.mp4', headers={'Range': f'bytes={start}-'}) as response:
+                self.assertEqual(206, response.status)
+                self.assertEqual(f'bytes {start}-{len(self.data) - 1}/{len(self.data)}',
+                                 response.headers['Content-Range'])
+                self.assertEqual('video/mp4', response.headers['Content-Type'])
+                self.assertEqual(self.data[start:], await response.read())
+        self.assertFalse(self.leech.scheduler.is_complete)
+        self.assertEqual({}, self.leech.scheduler.deadlines)
+
+    async def test_files_and_errors(self):
+        async with aiohttp.ClientSession() as http:
+            async with http.get(self.url) as response:
+                files = await response.json()
+            self.assertEqual([{'index': 0, 'path': 'movie.mp4', 'length': len(self.data),
+                               'url': f'/{self.leech.torrent.info_hash.hex()}/0'}], files)
+            async with http.get(f'{self.url}/0', headers={'Range': f'bytes={len(self.data)}-'}) as response:
+                self.assertEqual(416, response.status)
+                self.assertEqual(f'bytes */{len(self.data)}', response.headers['Content-Range'])
+            async with http.head(f'{self.url}/0') as response:
+                self.assertEqual(200, response.status)
+                self.assertEqual(str(len(self.data)), response.headers['Content-Length'])
+            async with http.get(f'{self.url}/1') as response:
+                self.assertEqual(404, response.status)
+            async with http.get(f'http://127.0.0.1:{self.server.port}/{bytes(20).hex()}') as response:
+                self.assertEqual(404, response.status)
+
+
+if __name__ == '__main__':
+    unittest.main()
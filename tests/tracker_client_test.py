@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from const import AnnounceEvent
+from models.peer import Peer
+from torrent.tracker import TrackerClient, TrackerResponse
+
+
+class FakeTracker:
+    timeout = 1
+
+    def __init__(self, url, peers=None, interval=900, delay=0):
+        self.url = url
+        self.peers = peers
+        self.interval = interval
+        self.delay = delay
+        self.events = []
+
+    async def announce(self, event=AnnounceEvent.none):
+        self.events.append(event)
+        await asyncio.sleep(self.delay)
+        if self.peers is None:
+            raise ConnectionError('unreachable')
+        return TrackerResponse({b'interval': self.interval, b'complete': 1, b'incomplete': 0, b'peers': self.peers})
+
+
+class TrackerClientTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tracker_client = TrackerClient(SimpleNamespace(announce_list=[]))
+
+    async def test_merges_tiers(self):
+        self.tracker_client.tiers = [
+            [FakeTracker('a', [Peer('1.1.1.1', 1), Peer('2.2.2.2', 2)], interval=900)],
+            [FakeTracker('b', [Peer('2.2.2.2', 2), Peer('3.3.3.3', 3)], interval=600)],
+        ]
+        response = await self.tracker_client.announce()
+        self.assertEqual(3, len(response.peers))
+        self.assertEqual(600, self.tracker_client.interval)
+        self.assertEqual(2, response.complete)
+
+    async def test_slow_tiers_are_not_waited_for(self):
+        received = []
+        self.tracker_client.on_peers = received.append
+        self.tracker_client.tiers = [
+            [FakeTracker('slow', [Peer('2.2.2.2', 2)], delay=0.1)],
+            [FakeTracker('fast', [Peer('1.1.1.1', 1)])],
+        ]
+        response = await self.tracker_client.announce()
+        self.assertEqual(['1.1.1.1'], [p.ip for p in response.peers])
+        self.assertEqual(1, len(received))
+        await self.tracker_client.wait_closed()
+        self.assertEqual([['1.1.1.1'], ['2.2.2.2']], [[p.ip for p in peers] for peers in received])
+
+    async def test_failover_within_tier(self):
+        dead = FakeTracker('dead')
+        alive = FakeTracker('alive', [Peer('1.1.1.1', 1)])
+        tier = [dead, alive]
+        self.tracker_client.tiers = [tier]
+        response = await self.tracker_client.announce(AnnounceEvent.started)
+        self.assertEqual(1, len(response.peers))
+        self.assertEqual([alive, dead], tier)
+        self.assertEqual([AnnounceEvent.started], alive.events)
+
+    async def test_interval_floor(self):
+        self.tracker_client.tiers = [[FakeTracker('a', [], interval=1)]]
+        await self.tracker_client.announce()
+        self.assertEqual(60, self.tracker_client.interval)
+
+    async def test_events_are_awaited_on_close(self):
+        tracker = FakeTracker('a', [])
+        self.tracker_client.tiers = [[tracker]]
+        self.tracker_client.start()
+        self.tracker_client.completed()
+        self.tracker_client.close()
+        await self.tracker_client.wait_closed()
+        self.assertEqual([AnnounceEvent.completed, AnnounceEvent.stopped], tracker.events)
+        self.assertEqual(set(), self.tracker_client._events)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import asyncio
+import struct
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from const import AnnounceEvent
+from torrent import tracker
+from torrent.tracker import UdpTracker, TrackerError
+
+
+class FakeUdpTracker(asyncio.DatagramProtocol):
+    """
+    Answers BEP 15 requests, optionally ignoring the first few of them.
+    """
+
+    CONNECTION_ID = 0x1234
+
+    def __init__(self, drop=0):
+        self.drop = drop
+        self.actions = []
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection_id, action, tid = struct.unpack_from('!QII', data)
+        self.actions.append(action)
+        if self.drop:
+            self.drop -= 1
+            return
+        if action == 0:
+            reply = struct.pack('!IIQ', 0, tid, self.CONNECTION_ID)
+        elif connection_id != self.CONNECTION_ID:
+            reply = struct.pack('!II', 3, tid) + b'bad connection id'
+        elif action == 1:
+            reply = struct.pack('!II3I', 1, tid, 900, 1, 2) + bytes([127, 0, 0, 1, 0x1a, 0xe1])
+        else:
+            reply = struct.pack('!II3I', 2, tid, 2, 5, 1)
+        self.transport.sendto(reply, addr)
+
+
+def make_torrent(info_hash):
+    return SimpleNamespace(info_hash=info_hash, peer_id='-PC0001-000000000000', downloaded=0, left=10,
+                           uploaded=0, port=6881)
+
+
+class UdpTrackerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeUdpTracker()
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: self.fake, local_addr=('127.0.0.1', 0))
+        self.url = f'udp://127.0.0.1:{transport.get_extra_info("sockname")[1]}/announce'
+
+    async def asyncTearDown(self):
+        self.fake.transport.close()
+        (await tracker.get_udp_protocol()).close()
+
+    async def test_concurrent_announces_share_connection(self):
+        trackers = [UdpTracker(make_torrent(bytes([i]) * 20), self.url) for i in range(5)]
+        responses = await asyncio.gather(*(t.announce(AnnounceEvent.started) for t in trackers))
+        for response in responses:
+            self.assertEqual(900, response.interval)
+            self.assertEqual(2, response.complete)
+            self.assertEqual([('127.0.0.1', 6881)], [(p.ip, p.port) for p in response.peers])
+        # One connect serves all the announces, later ones reuse the cached ID
+        await trackers[0].announce()
+        self.assertEqual([0] + [1] * 6, self.fake.actions)
+
+    async def test_scrape(self):
+        response = await UdpTracker(make_torrent(b'x' * 20), self.url).scrape()
+        self.assertEqual(2, response.complete)
+        self.assertEqual(1, response.incomplete)
+
+    async def test_retransmits(self):
+        self.fake.drop = 1
+        with mock.patch.object(tracker, 'UDP_TRACKER_TIMEOUT', 0.05):
+            response = await UdpTracker(make_torrent(b'x' * 20), self.url).announce()
+        self.assertEqual(900, response.interval)
+        self.assertEqual([0, 0, 1], self.fake.actions)
+
+    async def test_error_reply(self):
+        udp_tracker = UdpTracker(make_torrent(b'x' * 20), self.url)
+        await udp_tracker.announce()
+        protocol = await tracker.get_udp_protocol()
+        addr = udp_tracker.addr
+        protocol.connection_ids[addr] = (0xdead, protocol.connection_ids[addr][1])
+        with self.assertRaises(TrackerError):
+            await udp_tracker.announce()
+        self.assertNotIn(addr, protocol.connection_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import random
+from enum import Enum
+from typing import List, Optional
+
+from bitarray import bitarray
+
+# Number of pieces picked at random before switching to rarest first
+RANDOM_FIRST_PIECES = 4
+
+
+class PickPolicy(Enum):
+    sequential = 0
+    rarest_first = 1
+    random_first = 2
+
+
+class AvailabilityIndex:
+    """
+    Number of connected peers having each piece.
+
+    Wanted pieces are kept in buckets by availability so that the rarest one
+    a peer has is found without looking at every piece, and every update on a
+    `bitfield`, `have` or disconnect is O(1) per piece.
+    """
+
+    def __init__(self, piece_count: int):
+        self.piece_count = piece_count
+        self.counts = [0] * piece_count
+        # buckets[n] holds the wanted pieces which n peers have
+        self.buckets: List[set] = [set(range(piece_count))]
+        self.wanted = bitarray(piece_count)
+        self.wanted.setall(1)
+        self.picked = 0
+
+    def add_piece(self, index: int):
+        count = self.counts[index]
+        self.counts[index] = count + 1
+        if self.wanted[index]:
+            self._move(index, count, count + 1)
+
+    def remove_piece(self, index: int):
+        count = self.counts[index]
+        self.counts[index] = count - 1
+        if self.wanted[index]:
+            self._move(index, count, count - 1)
+
+    def add_bitfield(self, have: bitarray):
+        for index in have.search(1):
+            self.add_piece(index)
+
+    def remove_bitfield(self, have: bitarray):
+        for index in have.search(1):
+            self.remove_piece(index)
+
+    def _move(self, index: int, old: int, new: int):
+        self.buckets[old].discard(index)
+        if new == len(self.buckets):
+            self.buckets.append(set())
+        self.buckets[new].add(index)
+
+    def withdraw(self, index: int):
+        """
+        Stops offering a piece, either because it is in flight or done.
+        """
+        if self.wanted[index]:
+            self.wanted[index] = 0
+            self.buckets[self.counts[index]].discard(index)
+
+    def restore(self, index: int):
+        if not self.wanted[index]:
+            self.wanted[index] = 1
+            self._move(index, self.counts[index], self.counts[index])
+
+    def pick(self, have: bitarray, policy: PickPolicy = PickPolicy.rarest_first) -> Optional[int]:
+        """
+        Selects the next wanted piece out of the ones a peer has.
+
+        Returns: the piece index or None if the peer has no wanted piece
+        """
+        if policy == PickPolicy.sequential:
+            index = (self.wanted & have).find(1)
+            index = index if index >= 0 else None
+        elif policy == PickPolicy.random_first and self.picked < RANDOM_FIRST_PIECES:
+            candidates = list((self.wanted & have).search(1))
+            index = random.choice(candidates) if candidates else None
+        else:
+            index = self._rarest(have)
+        if index is not None:
+            self.picked += 1
+        return index
+
+    def _rarest(self, have: bitarray) -> Optional[int]:
+        # nobody has the pieces in bucket 0, so the peer can't have them either
+        for bucket in self.buckets[1:]:
+            for index in bucket:
+                if have[index]:
+                    return index
+        return None
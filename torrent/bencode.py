@@ -0,0 +1,137 @@
+import re
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+_INT, _LIST, _DICT, _END = ord('i'), ord('l'), ord('d'), ord('e')
+_DIGITS = frozenset(b'0123456789')
+# Digits only, with no plus sign or separators. Leading zeros and -0 are not
+# canonical but still decoded, the info hash is taken on the raw bytes anyway
+_INTEGER = re.compile(rb'-?[0-9]+')
+_LENGTH = re.compile(rb'[0-9]+')
+
+# Keys of nested dictionaries leading to a value, from the top level one
+Path = Tuple[bytes, ...]
+
+
+class BencodeError(ValueError):
+    pass
+
+
+class Decoder:
+    """
+    Single pass bencode decoder that can point back into its input.
+
+    The decoder walks the buffer with an explicit stack, so deeply nested
+    data costs no recursion. For the paths in `spans` it records where their
+    value is encoded, e.g. `(b'info',)`, which lets the info hash be
+    computed on the original bytes: re-encoding would sort keys and hash
+    something else for torrents that are not canonically encoded. The
+    string values at the paths in `views` are returned as memoryviews into
+    the input instead of copies, e.g. the piece hashes.
+
+    Paths are matched from the top level dictionary only, so a key of the
+    same name nested elsewhere is left alone.
+    """
+
+    def __init__(self, data: bytes, spans: Iterable[Path] = (), views: Iterable[Path] = ()):
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        self.span_paths = frozenset(spans)
+        self.view_paths = frozenset(views)
+        # Paths worth following while decoding
+        self._prefixes = frozenset(path[:n] for path in self.span_paths | self.view_paths for n in range(len(path) + 1))
+        self.spans: Dict[Path, Tuple[int, int]] = {}
+        # Offset right after the decoded value
+        self.end = 0
+
+    def raw(self, path: Path) -> memoryview:
+        """
+        Returns: the encoded value at `path` as it appears in the input
+        """
+        start, end = self.spans[path]
+        return self.view[start:end]
+
+    def _child(self, parent: Optional[Path], key: bytes) -> Optional[Path]:
+        if parent is None:
+            return None
+        path = parent + (key,)
+        return path if path in self._prefixes else None
+
+    def decode(self, trailing: bool = False) -> Any:
+        """
+        With `trailing`, data may follow the value, e.g. the metadata piece
+        of a ut_metadata message; it starts at `end`.
+        """
+        data = self.data
+        length = len(data)
+        # Each frame is [container, pending dictionary key, path, start]; the
+        # path is None unless the container lies on one of the paths
+        stack = []
+        i = 0
+        while True:
+            if i >= length:
+                raise BencodeError('Unexpected end of data')
+            frame = stack[-1] if stack else None
+            in_dict = frame is not None and isinstance(frame[0], dict)
+            # The key whose value is being decoded, if any
+            key = frame[1] if in_dict else None
+            if frame is None:
+                path = ()
+            else:
+                path = self._child(frame[2], key) if key is not None else None
+            c = data[i]
+            start = i
+            if c in _DIGITS:
+                colon = data.find(b':', i)
+                if colon < 0:
+                    raise BencodeError(f'Missing string length delimiter at {i}')
+                if not _LENGTH.fullmatch(data, i, colon):
+                    raise BencodeError(f'Invalid string length at {i}')
+                i = colon + 1 + int(data[i:colon])
+                if i > length:
+                    raise BencodeError('Unexpected end of data')
+                if in_dict and key is None:
+                    frame[1] = data[colon + 1:i]
+                    continue
+                value = self.view[colon + 1:i] if path in self.view_paths else data[colon + 1:i]
+            elif c == _INT:
+                if in_dict and key is None:
+                    raise BencodeError(f'Dictionary key must be a string at {i}')
+                end = data.find(b'e', i)
+                if end < 0:
+                    raise BencodeError(f'Unterminated integer at {i}')
+                if not _INTEGER.fullmatch(data, i + 1, end):
+                    raise BencodeError(f'Invalid integer at {i}')
+                value = int(data[i + 1:end])
+                i = end + 1
+            elif c == _LIST or c == _DICT:
+                if in_dict and key is None:
+                    raise BencodeError(f'Dictionary key must be a string at {i}')
+                stack.append([[] if c == _LIST else {}, None, path, start])
+                i += 1
+                continue
+            elif c == _END and frame is not None:
+                if in_dict and key is not None:
+                    raise BencodeError(f'Missing value for key {key!r}')
+                value, _, path, start = stack.pop()
+                i += 1
+            else:
+                raise BencodeError(f'Unexpected byte {bytes([c])!r} at {i}')
+
+            if path is not None and path in self.span_paths:
+                self.spans.setdefault(path, (start, i))
+            if not stack:
+                break
+            parent = stack[-1]
+            if isinstance(parent[0], dict):
+                parent[0][parent[1]] = value
+                parent[1] = None
+            else:
+                parent[0].append(value)
+        self.end = i
+        if i != length and not trailing:
+            raise BencodeError(f'Trailing data at {i}')
+        return value
+
+
+def decode(data: bytes) -> Any:
+    return Decoder(data).decode()
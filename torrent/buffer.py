@@ -0,0 +1,96 @@
+import asyncio
+from typing import Dict, Hashable, Optional, Set
+
+from const import PIECE_BUFFER_MEMORY
+
+
+class PieceBuffer:
+    """
+    Assembles the blocks of one in-flight piece in memory.
+    """
+
+    def __init__(self, index: Hashable, length: int):
+        self.index = index
+        self.data = bytearray(length)
+        self.view = memoryview(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def write(self, offset: int, data: bytes):
+        self.view[offset:offset + len(data)] = data
+
+
+class BufferPool:
+    """
+    Piece buffers of all the in-flight pieces, under a global memory cap.
+
+    Peers only start a new piece when there is room for its buffer, which
+    pushes back on requesting instead of letting memory grow with the number
+    of peers. A single piece is always allowed, even if it exceeds the cap.
+    """
+
+    def __init__(self, max_bytes: int = PIECE_BUFFER_MEMORY):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.buffers: Dict[Hashable, PieceBuffer] = {}
+        self._waiters: Set[asyncio.Future] = set()
+
+    def has_room(self, length: int) -> bool:
+        return not self.buffers or self.used + length <= self.max_bytes
+
+    def acquire(self, index: Hashable, length: int) -> PieceBuffer:
+        buffer = self.buffers.get(index)
+        if buffer is None:
+            buffer = self.buffers[index] = PieceBuffer(index, length)
+            self.used += length
+        return buffer
+
+    def get(self, index: Hashable) -> Optional[PieceBuffer]:
+        return self.buffers.get(index)
+
+    def release(self, index: Hashable):
+        buffer = self.buffers.pop(index, None)
+        if buffer is None:
+            return
+        self.used -= len(buffer)
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_for_room(self, length: int):
+        while not self.has_room(length):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            try:
+                await waiter
+            finally:
+                self._waiters.discard(waiter)
+
+    def for_torrent(self, info_hash: bytes) -> 'TorrentBuffers':
+        return TorrentBuffers(self, info_hash)
+
+
+class TorrentBuffers:
+    """
+    The buffers of one torrent in a pool shared by several torrents.
+    """
+
+    def __init__(self, pool: BufferPool, info_hash: bytes):
+        self.pool = pool
+        self.info_hash = info_hash
+
+    def has_room(self, length: int) -> bool:
+        return self.pool.has_room(length)
+
+    def acquire(self, index: int, length: int) -> PieceBuffer:
+        return self.pool.acquire((self.info_hash, index), length)
+
+    def get(self, index: int) -> Optional[PieceBuffer]:
+        return self.pool.get((self.info_hash, index))
+
+    def release(self, index: int):
+        self.pool.release((self.info_hash, index))
+
+    async def wait_for_room(self, length: int):
+        await self.pool.wait_for_room(length)
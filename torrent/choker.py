@@ -0,0 +1,74 @@
+import asyncio
+import random
+from typing import TYPE_CHECKING, Optional
+
+from const import UPLOAD_SLOTS, CHOKE_INTERVAL, OPTIMISTIC_UNCHOKE_ROUNDS
+from log import get_logger
+
+if TYPE_CHECKING:
+    from torrent.client import Client, PeerClient
+
+log = get_logger(__name__)
+
+
+class Choker:
+    """
+    Tit-for-tat choking of the peers downloading from us.
+
+    Every `CHOKE_INTERVAL` seconds the interested peers which give us the best
+    download rate (or, once we are seeding, which take the best upload rate)
+    get the regular upload slots. One more slot is handed to a random choked
+    peer every `OPTIMISTIC_UNCHOKE_ROUNDS` rounds, so newcomers get a chance to
+    prove themselves.
+    """
+
+    def __init__(self, client: 'Client', slots: int = UPLOAD_SLOTS):
+        self.client = client
+        self.slots = slots
+        self.optimistic: Optional['PeerClient'] = None
+        self.rounds = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self.rechoke()
+            await asyncio.sleep(CHOKE_INTERVAL)
+
+    def _rank(self, peer_client: 'PeerClient') -> float:
+        if self.client.scheduler.is_complete:
+            return peer_client.upload_meter.rate
+        return peer_client.pipeline.rate
+
+    def rechoke(self):
+        peers = [pc for pc in self.client.peer_connections.values() if not pc.is_closed]
+        interested = [pc for pc in peers if pc.is_peer_interested]
+        ranked = sorted(interested, key=self._rank, reverse=True)
+        unchoked = set(ranked[:self.slots - 1])
+
+        if self.rounds % OPTIMISTIC_UNCHOKE_ROUNDS == 0 or self.optimistic not in interested:
+            candidates = [pc for pc in interested if pc not in unchoked]
+            self.optimistic = random.choice(candidates) if candidates else None
+        self.rounds += 1
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for peer_client in peers:
+            peer_client.set_choking(peer_client not in unchoked)
+        log.debug(f'Unchoked {len(unchoked)} of {len(interested)} interested peers.')
+
+    def interested(self, peer_client: 'PeerClient'):
+        """
+        Unchokes a newly interested peer right away if a slot is free.
+        """
+        unchoked = sum(1 for pc in self.client.peer_connections.values() if not pc.is_choking and not pc.is_closed)
+        if unchoked < self.slots:
+            peer_client.set_choking(False)
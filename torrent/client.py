@@ -1,241 +1,1084 @@
 import asyncio
-import os.path
+import concurrent.futures
 import struct
-from asyncio import IncompleteReadError
-from typing import List
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
 
-import math
-from aiofile import async_open
 from bitarray import bitarray
 
-from const import PROTOCOL_LEN, PROTOCOL, PEER_CONNECT_TIMEOUT, PeerMessage, BLOCK_SIZE, DOWNLOAD_PATH
+from const import PROTOCOL_LEN, PROTOCOL, PEER_CONNECT_TIMEOUT, PeerMessage, REQUEST_TIMEOUT, \
+    RESERVED, FAST_EXTENSION_BYTE, FAST_EXTENSION_BIT, ALLOWED_FAST_COUNT, BLOCK_SIZE, KEEP_ALIVE_INTERVAL, \
+    PEER_IDLE_TIMEOUT, AnnounceEvent, MAX_HASH_FAILURES, MAX_REQUEST_LENGTH, UPLOAD_QUEUE_MAX, DOWNLOAD_PATH, RESUME_SAVE_INTERVAL, \
+    DHT_ANNOUNCE_INTERVAL, EXTENSION_IDS, METADATA_PIECE_SIZE, MetadataMessage, MAX_MESSAGE_LENGTH
 from log import get_logger
 from models.peer import Peer
 from models.piece import Block
 from models.torrent import Torrent
+from torrent.availability import AvailabilityIndex, PickPolicy
+from torrent.buffer import BufferPool
+from torrent.choker import Choker
+from torrent.connections import ConnectionManager, PeerSource
+from torrent.download import Downloader
+from torrent.fast import allowed_fast_set
+from torrent.files import FileIndex, FilePriority
+from torrent.hasher import PieceHasher
+from torrent.metadata import extended_message, extension_handshake, metadata_message, parse_extended, \
+    supports_extensions
+from torrent.pex import PeerExchange
+from torrent.pipeline import RequestPipeline
+from torrent.protocol import PeerProtocol
+from torrent.resume import ResumeData
+from torrent.scheduler import PieceScheduler
+from torrent.server import PeerServer
+from torrent.storage import Storage, ReadCache
+from torrent.tracker import TrackerClient
+from torrent.ratelimit import TokenBucket
+from util import RateMeter
+
+if TYPE_CHECKING:
+    from dht.node import DHTNode
+    from torrent.session import Session
 
 log = get_logger(__name__)
 
+PIECE_HEADER = struct.Struct('!2I')
+BLOCK_REQUEST = struct.Struct('!3I')
+
 
 class Client:
-    def __init__(self, peers: List[Peer], torrent: Torrent):
+    def __init__(self, peers: List[Peer], torrent: Torrent, policy: PickPolicy = PickPolicy.rarest_first,
+                 path: Optional[str] = None, session: Optional['Session'] = None,
+                 file_priorities: Optional[List[FilePriority]] = None):
         self.peers = peers
         self.torrent = torrent
+        self.session = session
 
-        self.peer_connections = None
-        self.init_blocks()
-
-        self.fd = None
+        # Keyed by the address of the other end of the connection, which
+        # unlike the peer id in the handshake is not up to the peer
+        self.peer_connections: Dict[Tuple[str, int], PeerClient] = {}
+        if session is not None:
+            # Pools shared with the other torrents of the session
+            self.storage = Storage(torrent, path or session.path, session.file_pool, session.disk_executor)
+            self.hasher = session.hasher
+            self.buffers = session.buffers.for_torrent(torrent.info_hash)
+            # Limits of this torrent, under the ones of the session
+            self.download_limiter = TokenBucket(parent=session.download_limiter)
+            self.upload_limiter = TokenBucket(parent=session.upload_limiter)
+            self.dht: Optional['DHTNode'] = session.dht
+        else:
+            self.storage = Storage(torrent, path or DOWNLOAD_PATH)
+            self.hasher = PieceHasher()
+            self.buffers = BufferPool()
+            self.download_limiter = TokenBucket()
+            self.upload_limiter = TokenBucket()
+            self.dht = None
+        self.read_cache = ReadCache(self.storage)
+        self.file_index = FileIndex(torrent)
+        self.file_priorities = file_priorities or [FilePriority.normal] * len(torrent.files)
+        self.storage.skipped = {i for i, priority in enumerate(self.file_priorities) if priority == FilePriority.skip}
+        self.storage.allocate()
+        self.availability = AvailabilityIndex(self.torrent.download_info.piece_count)
+        self.scheduler = PieceScheduler(self.torrent.download_info, self.availability, policy)
+        if file_priorities is not None:
+            self.scheduler.set_priorities(self.file_index.piece_priorities(file_priorities))
+        # Reported to trackers, skipped files are not counted
+        self.torrent.left = self.scheduler.bytes_left
+        self.choker = Choker(self)
+        self.connections = ConnectionManager(self)
+        self.pex = PeerExchange(self)
+        self.server = None
+        self._owns_server = False
+        self.upload_meter = RateMeter()
+        self.resume_data = ResumeData(self.storage)
+        self.tracker = None
+        self.downloader = None
+        self._resume_task = None
+        self._is_resume_dirty = False
+        self._keep_alive_task = None
+        self._dht_task = None
 
     async def connect(self):
         """
         Connect to peers.
         """
         log.info(f'Attempting connection to {len(self.peers)} peers.')
-        self.peer_connections = {peer.peer_id: PeerClient(peer, self.torrent) for peer in self.peers}
-        tasks = [self.peer_connections[peer.peer_id].connect() for peer in self.peers]
-        await asyncio.gather(*tasks)
-        log.info('Successfully connected to all the peers!')
-
-    def init_blocks(self):
-        self._create_file()
-        for index, piece in enumerate(self.torrent.pieces):
-            if piece.is_last and self.torrent.file_length % self.torrent.piece_length != 0:
-                remaining_length = self.torrent.file_length % self.torrent.piece_length
-                n_blocks = math.ceil(remaining_length / BLOCK_SIZE)
+        self.connections.add(self.peers, PeerSource.manual)
+        self.connections.start()
+        await self.connections.wait_for_peers()
+        self.choker.start()
+        self.pex.start()
+        self._start_resume_saver()
+        self._start_keep_alive()
+        log.info(f'Connected to {self.connections.connected} peers, more may follow.')
+
+    async def announce(self) -> List[Peer]:
+        """
+        Announces the torrent to its trackers, and to the DHT if the session
+        runs a node, then keeps re-announcing. Peers are connected to as
+        each tracker tier or DHT lookup returns them.
+
+        Returns: the peers returned by the first tracker tiers to answer
+        """
+        self.tracker = TrackerClient(self.torrent, on_peers=self.add_peers)
+        if self.dht is not None:
+            # Lookups take a while, the trackers do not wait for them
+            self._dht_task = asyncio.create_task(self._reannounce_dht())
+        response = await self.tracker.announce(AnnounceEvent.started)
+        # Keep the peers we were given, e.g. by a magnet link
+        self.peers = self.peers + response.peers
+        self.tracker.start()
+        return response.peers
+
+    async def _announce_dht(self) -> List[Peer]:
+        await self.dht.ready.wait()
+        try:
+            return await self.dht.announce_peer(self.torrent.info_hash, self.torrent.port)
+        except Exception as e:
+            log.warning(f'DHT announce failed: {e!r}')
+            return []
+
+    async def _reannounce_dht(self):
+        while True:
+            self.add_peers(await self._announce_dht(), PeerSource.dht)
+            await asyncio.sleep(DHT_ANNOUNCE_INTERVAL)
+
+    def add_peers(self, peers: List[Peer], source: PeerSource = PeerSource.tracker):
+        self.connections.add(peers, source)
+        self.connections.start()
+
+    def create_peer(self, peer: Peer) -> 'PeerClient':
+        peer_client = PeerClient(peer, self)
+        self.peer_connections[(peer.ip, peer.port)] = peer_client
+        return peer_client
+
+    def peer_wanted(self, peer_client: 'PeerClient'):
+        """
+        Starts downloading from a peer which has pieces we want.
+        """
+        if self.downloader is not None:
+            self.downloader.add(peer_client)
+
+    def peer_closed(self, peer_client: 'PeerClient'):
+        address = (peer_client.peer.ip, peer_client.peer.port)
+        if self.peer_connections.get(address) is peer_client:
+            del self.peer_connections[address]
+        self.release_connection()
+        self.connections.closed(peer_client)
+        self.pex.closed(peer_client)
+
+    async def listen(self, server: Optional[PeerServer] = None):
+        """
+        Starts accepting connections from peers to upload to them.
+        """
+        if server is None:
+            server = PeerServer()
+            await server.start()
+            self._owns_server = True
+        self.server = server
+        self.torrent.port = server.port
+        server.register(self)
+        self.choker.start()
+        self.pex.start()
+        self._start_resume_saver()
+        self._start_keep_alive()
+
+    def set_rate_limits(self, download_rate: Optional[int] = None, upload_rate: Optional[int] = None):
+        """
+        Changes the rate limits of the torrent, in bytes per second; 0 lifts
+        a limit and None leaves it as is.
+        """
+        if download_rate is not None:
+            self.download_limiter.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload_limiter.set_rate(upload_rate)
+
+    def cancel_block(self, piece_index: int, begin: int, length: int, received_from: 'PeerClient'):
+        """
+        Cancels the duplicate requests for a block sent in endgame or close
+        to the deadline of its piece.
+        """
+        for peer_client in self.peer_connections.values():
+            if peer_client is not received_from:
+                peer_client.cancel_request(piece_index, begin, length)
+
+    def piece_received(self, piece_index: int):
+        """
+        Takes a piece whose blocks all arrived off every peer downloading it,
+        so that none of them releases it while it is verified.
+        """
+        for peer_client in self.peer_connections.values():
+            peer_client.active_pieces.discard(piece_index)
+
+    def acquire_connection(self) -> bool:
+        return self.session is None or self.session.acquire_connection()
+
+    def release_connection(self):
+        if self.session is not None:
+            self.session.release_connection()
+
+    def accept(self, peer: Peer, protocol: PeerProtocol, handshake: bytes):
+        if not self.acquire_connection():
+            log.debug(f'Connection limit reached, refusing peer={peer.peer_id}')
+            protocol.transport.close()
+            return
+        peer_client = PeerClient(peer, self)
+        self.peer_connections[(peer.ip, peer.port)] = peer_client
+        peer_client.accept(protocol, handshake)
+
+    async def check(self, indices: Optional[Iterable[int]] = None):
+        """
+        Hashes the data already on disk and marks the pieces which match as
+        downloaded, e.g. to seed a file we already have.
+        """
+        if indices is None:
+            indices = self.scheduler.wanted.search(1)
+        for index in indices:
+            if self.scheduler.have[index]:
+                continue
+            data = await self.storage.read(index * self.torrent.piece_length, self.torrent.piece_size(index))
+            if await self.hasher.verify(data, self.torrent.piece_hash(index)):
+                self.piece_completed(index)
+        piece_count = self.torrent.download_info.piece_count
+        log.info(f'Checked files, {self.scheduler.downloaded}/{piece_count} pieces present.')
+
+    async def set_file_priorities(self, priorities: List[FilePriority]):
+        """
+        Changes which files are downloaded, and which ones first.
+        """
+        piece_priorities = self.file_index.piece_priorities(priorities)
+        self.file_priorities = list(priorities)
+        await self.storage.set_skipped({i for i, priority in enumerate(priorities) if priority == FilePriority.skip})
+        self.scheduler.set_priorities(piece_priorities)
+        self.torrent.left = self.scheduler.bytes_left
+        # Files no longer skipped may be on peers we had no use for
+        for peer_client in list(self.peer_connections.values()):
+            peer_client.update_interest()
+
+    async def resume(self) -> bool:
+        """
+        Restores the pieces completed before a restart from the resume file.
+        Only the pieces lying in files which changed since it was written are
+        hashed again.
+
+        Returns: whether there was a resume file to restore from
+        """
+        resume = self.resume_data.load(self.torrent.download_info.piece_count)
+        if resume is None:
+            return False
+        have, changed = resume
+        changed = set(changed)
+        recheck = []
+        for index in have.search(1):
+            spans = self.storage.spans(index * self.torrent.piece_length, self.torrent.piece_size(index))
+            if any(file_index in changed for file_index, _, _ in spans):
+                recheck.append(index)
             else:
-                n_blocks = math.ceil(self.torrent.piece_length / BLOCK_SIZE)
-            piece.blocks = [Block(index, offset * BLOCK_SIZE, BLOCK_SIZE) for offset in range(n_blocks)]
-        if self.torrent.file_length % BLOCK_SIZE != 0:
-            # log.info(f'Last piece size {self.torrent.file_length % BLOCK_SIZE}')
-            # self.torrent.pieces[-1].blocks[-1].length = self.torrent.piece_length % BLOCK_SIZE
-            self.torrent.pieces[-1].blocks[-1].length = self.torrent.file_length % BLOCK_SIZE
-        log.info('Successfully initialized blocks.')
-
-    def _create_file(self):
-        if not os.path.exists(DOWNLOAD_PATH):
-            os.mkdir(DOWNLOAD_PATH)
-        if self.torrent.files is None:
-            path = os.path.join(DOWNLOAD_PATH, self.torrent.filename)
-            if not os.path.exists(path):
-                with open(path, 'w') as _:
-                    pass
-        else:
-            for file in self.torrent.files:
-                path = os.path.join(DOWNLOAD_PATH, file.path)
-                if not os.path.exists(path):
-                    with open(path, 'w') as _:
-                        pass
+                self.piece_completed(index)
+        if recheck:
+            log.info(f'{len(changed)} files changed, rehashing {len(recheck)} pieces.')
+            await self.check(recheck)
+        log.info(f'Resumed with {self.scheduler.downloaded}/{self.torrent.download_info.piece_count} pieces.')
+        return True
+
+    def piece_completed(self, index: int):
+        if self.scheduler.have[index]:
+            return
+        self.scheduler.complete(index)
+        self.torrent.left = self.scheduler.bytes_left
+        if self.scheduler.is_complete and self.tracker is not None:
+            self.tracker.completed()
+        self._is_resume_dirty = True
+        for peer_client in self.peer_connections.values():
+            peer_client.send_have(index)
+
+    def _start_resume_saver(self):
+        if self._resume_task is None:
+            self._resume_task = asyncio.create_task(self._save_resume_periodically())
+
+    async def _save_resume_periodically(self):
+        while True:
+            await asyncio.sleep(RESUME_SAVE_INTERVAL)
+            await self.save_resume()
+
+    def _start_keep_alive(self):
+        if self._keep_alive_task is None:
+            self._keep_alive_task = asyncio.create_task(self._keep_alive())
+
+    async def _keep_alive(self):
+        """
+        Sends keep-alives to the peers we did not write to for a while, and
+        drops the ones which went silent.
+        """
+        while True:
+            await asyncio.sleep(KEEP_ALIVE_INTERVAL / 2)
+            self.check_idle(time.monotonic())
+
+    def check_idle(self, now: float):
+        for peer_client in list(self.peer_connections.values()):
+            if peer_client.is_closed or peer_client.transport is None:
+                continue
+            if now - peer_client.last_received >= PEER_IDLE_TIMEOUT:
+                log.info(f'Dropping idle peer={peer_client.peer.peer_id}')
+                peer_client.close()
+            elif now - peer_client.last_sent >= KEEP_ALIVE_INTERVAL:
+                peer_client.send_keep_alive()
+
+    def _submit_resume(self) -> Optional[concurrent.futures.Future]:
+        if not self._is_resume_dirty:
+            return None
+        self._is_resume_dirty = False
+        # A copy, pieces keep completing while the disk thread writes
+        return self.storage.executor.submit(self.resume_data.save, self.scheduler.have.copy())
+
+    async def save_resume(self):
+        """
+        Writes the resume file on the disk thread, if pieces completed since
+        the last save.
+        """
+        future = self._submit_resume()
+        if future is not None:
+            await asyncio.wrap_future(future)
 
     async def download(self):
-        log.info(f'Number of pieces {len(self.torrent.download_info.pieces)}')
-        for i, piece in enumerate(self.torrent.download_info.pieces):
-            peer = piece.owners.pop()
-            await self.peer_connections[peer.peer_id].download(i)
+        log.info(f'Number of pieces {self.torrent.download_info.piece_count}')
+        self.downloader = Downloader(self.torrent, self.scheduler)
+        # Peers which connected before the download started
+        for peer_client in list(self.peer_connections.values()):
+            peer_client.update_interest()
+        try:
+            await self.downloader.download()
+        finally:
+            self.downloader = None
+
+    def close(self):
+        if self.downloader is not None:
+            self.downloader.stop()
+        self.choker.stop()
+        self.pex.stop()
+        self.connections.stop()
+        if self.tracker is not None:
+            self.tracker.close()
+        if self._resume_task is not None:
+            self._resume_task.cancel()
+        if self._keep_alive_task is not None:
+            self._keep_alive_task.cancel()
+        if self._dht_task is not None:
+            self._dht_task.cancel()
+        # Written before the storage closes, on the same disk thread
+        self._submit_resume()
+        if self.server is not None:
+            self.server.unregister(self)
+            if self._owns_server:
+                self.server.close()
+        for peer_client in list(self.peer_connections.values()):
+            peer_client.close()
+        if self.session is None:
+            self.hasher.close()
+        self.storage.close()
 
 
 class PeerClient:
-    def __init__(self, peer: Peer, torrent: Torrent):
+    """
+    A connection to a single peer.
+
+    Messages are parsed by `PeerProtocol` and dispatched synchronously to the
+    `_handle_*` methods, which must not hold on to their payload.
+    """
+
+    def __init__(self, peer: Peer, client: Client):
         self.peer = peer
-        self.torrent = torrent
+        self.client = client
+        self.torrent = client.torrent
+        self.availability = client.availability
+        self.storage = client.storage
+        self.hasher = client.hasher
+        self.buffers = client.buffers
+        # Pieces the peer has
+        self.bitfield = bitarray(self.torrent.download_info.piece_count)
+        self.bitfield.setall(0)
 
-        self.reader = None
-        self.writer = None
+        self.transport = None
+        self.protocol = None
+        self._handlers = {
+            PeerMessage.choke.value: self._handle_choke,
+            PeerMessage.unchoke.value: self._handle_unchoke,
+            PeerMessage.interested.value: self._handle_interested,
+            PeerMessage.not_interested.value: self._handle_not_interested,
+            PeerMessage.request.value: self._handle_request,
+            PeerMessage.cancel.value: self._handle_cancel,
+            PeerMessage.have.value: self._handle_have,
+            PeerMessage.bitfield.value: self._handle_bitfield,
+            PeerMessage.piece.value: self._handle_piece,
+            PeerMessage.suggest_piece.value: self._handle_suggest_piece,
+            PeerMessage.have_all.value: self._handle_have_all,
+            PeerMessage.have_none.value: self._handle_have_none,
+            PeerMessage.reject_request.value: self._handle_reject_request,
+            PeerMessage.allowed_fast.value: self._handle_allowed_fast,
+            PeerMessage.extended.value: self._handle_extended,
+        }
+        self._handshake = None
+        # Set when the download loop has to look at the peer again: the
+        # request window ran dry or the connection went away.
+        self._idle = asyncio.Event()
+        self._unchoked = asyncio.Event()
 
+        # is_choked/is_interested: the peer's view of us, is_choking and
+        # is_peer_interested: our view of the peer
         self.is_choked = True
         self.is_interested = False
+        self.is_choking = True
+        self.is_peer_interested = False
         self.is_bit_field_received = False
+        # Handshakes and our bitfield were exchanged
+        self.is_connected = False
+        self.is_closed = False
+        self.is_banned = False
+        self.hash_failures = 0
+        # Both sides set the Fast Extension bit of the handshake
+        self.is_fast = False
+        # Pieces we may request while choked, and the ones the peer may
+        self.allowed_fast = bitarray(self.torrent.download_info.piece_count)
+        self.allowed_fast.setall(0)
+        self.peer_allowed_fast = set()
+        # Both sides set the Extension Protocol bit, and the ids the peer
+        # wants for the extension messages we send it
+        self.is_extended = False
+        self.extensions: Dict[bytes, int] = {}
+        # Whether we opened the connection, and where the peer accepts them,
+        # which for incoming connections only its extension handshake tells
+        self.is_outgoing = True
+        self.listen_port: Optional[int] = peer.port
+
+        self.scheduler = None
+        self.pipeline = RequestPipeline()
+        # Pieces assigned to this peer and their blocks not requested yet
+        self.active_pieces = set()
+        self.block_queue = deque()
+        self.verify_tasks = set()
+        self.last_received = time.monotonic()
+        self.last_sent = time.monotonic()
+        # Timer topping up the pipeline once the download rate limit allows it
+        self._throttle = None
 
-        # self.path = os.path.join(DOWNLOAD_PATH, self.torrent.filename)
+        # (piece index, begin, length) of the blocks the peer asked for
+        self.upload_queue = deque()
+        self.upload_meter = RateMeter()
+        self.download_limiter = TokenBucket(parent=client.download_limiter)
+        self.upload_limiter = TokenBucket(parent=client.upload_limiter)
+        self._upload_task = None
 
     async def connect(self):
+        loop = asyncio.get_running_loop()
+        self._handshake = loop.create_future()
         try:
-            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.peer.ip, self.peer.port),
-                                                              timeout=PEER_CONNECT_TIMEOUT)
-            log.info(f'Connection opened to peer={self.torrent.peer_id}')
-            await self._handshake()
-            response = await asyncio.wait_for(self.reader.readexactly(self.data_length),
-                                              timeout=PEER_CONNECT_TIMEOUT)
+            self.transport, self.protocol = await asyncio.wait_for(
+                loop.create_connection(lambda: PeerProtocol(self, max_length=self.max_message_length),
+                                       self.peer.ip, self.peer.port),
+                timeout=PEER_CONNECT_TIMEOUT)
+            log.info(f'Connection opened to peer={self.peer.peer_id}')
+            self._send_handshake()
+            response = await asyncio.wait_for(self._handshake, timeout=PEER_CONNECT_TIMEOUT)
             if response[28:48] != self.torrent.info_hash:
                 log.error(f"Info hash doesn't match for peer={self.peer.peer_id}!")
+                self.close()
                 return
             log.info(f'Verified info hash for peer={self.peer.peer_id}.')
-            await self._interested()
+            self._send_bitfield()
+            self._send_extension_handshake()
+            # Choking peers are left to the choker and the idle timeout
+            self.is_connected = True
+            self.update_interest()
+        except asyncio.TimeoutError:
+            log.warning(f'peer={self.peer.peer_id} timed out')
+            self.close()
+        except Exception as e:
+            log.error(f'peer={self.peer.peer_id} failed with error: {e}')
+            self.close()
 
-            while True:
-                await self._receive_message()
-                if not self.is_choked and self.is_bit_field_received:
-                    break
+    def accept(self, protocol: PeerProtocol, handshake: bytes):
+        """
+        Takes over a connection the peer opened, once its handshake is in.
+        """
+        self.protocol = protocol
+        self.transport = protocol.transport
+        self.is_outgoing = False
+        self.listen_port = None
+        protocol.handler = self
+        protocol.max_length = self.max_message_length
+        self._send_handshake()
+        self._set_extensions(handshake)
+        self._send_bitfield()
+        self._send_extension_handshake()
+        log.info(f'Accepted connection from peer={self.peer.peer_id}')
+        self.is_connected = True
+        self.update_interest()
 
-        except TimeoutError:
-            log.warn(f'peer={self.torrent.peer_id} timed out')
-        except Exception as e:
-            log.error(f'peer={self.torrent.peer_id} failed with error: {e}')
+    @property
+    def max_message_length(self) -> int:
+        """
+        Returns: the longest message the peer may send, a piece or our bitfield
+        """
+        return max(MAX_MESSAGE_LENGTH, 1 + (self.torrent.download_info.piece_count + 7) // 8)
 
-    async def _receive_message(self):
-        try:
-            # read length
-            response = await asyncio.wait_for(self.reader.readexactly(4), timeout=PEER_CONNECT_TIMEOUT)
-            (length,) = struct.unpack('!I', response)
-            log.info(f'Message length={length}')
-            response = await asyncio.wait_for(self.reader.readexactly(length), timeout=PEER_CONNECT_TIMEOUT)
-            # log.info(f'Message info={response}')
-        except IncompleteReadError:
-            log.warn(f'0 bytes read from peer={self.torrent.peer_id}')
+    def close(self):
+        if self.is_closed:
             return
+        self.is_closed = True
+        self._cancel_throttle()
+        self.client.peer_closed(self)
+        self.availability.remove_bitfield(self.bitfield)
+        self.bitfield.setall(0)
+        self._idle.set()
+        self._unchoked.set()
+        self.upload_queue.clear()
+        if self._handshake is not None and not self._handshake.done():
+            self._handshake.set_exception(ConnectionError(f'Connection to peer={self.peer.peer_id} was closed'))
+        if self.transport is not None:
+            self.transport.close()
 
-        if not response:
-            log.warn('Received empty response.')
+    def handshake_received(self, handshake: bytes):
+        # The messages right behind the handshake depend on its extensions
+        self._set_extensions(handshake)
+        if self._handshake is not None and not self._handshake.done():
+            self._handshake.set_result(handshake)
+
+    def keep_alive_received(self):
+        self.last_received = time.monotonic()
+
+    def message_received(self, message_id: int, payload: memoryview):
+        self.last_received = time.monotonic()
+        handler = self._handlers.get(message_id)
+        if handler is None:
+            log.debug(f'Ignoring message id={message_id} from peer={self.peer.peer_id}')
             return
         try:
-            message_id = PeerMessage(response[0])
-            log.info(f'Received a message.={str(response)}')
-        except ValueError:
-            return
-
-        payload = response[1:]
-        if message_id == PeerMessage.bitfield:
-            self._handle_bitfield(payload)
-        elif message_id == PeerMessage.unchoke:
-            self._handle_unchoke()
-        elif message_id == PeerMessage.piece:
-            log.info('Received a piece message, yay!')
-            await self._handle_piece(payload)
-        else:
-            log.info(f'Received a non-bitfield message, type={message_id}')
+            handler(payload)
+        except Exception as e:
+            log.error(f'Invalid message id={message_id} from peer={self.peer.peer_id}: {e}')
+            self.close()
 
-        log.info('Received and parsed response.')
+    def connection_lost(self, exc: Optional[Exception]):
+        log.info(f'Connection to peer={self.peer.peer_id} lost: {exc}')
+        self.close()
 
-    async def _handshake(self):
-        info_hash = self.torrent.info_hash
-        handshake_bytes = struct.pack('>B19s8x20s20s',
+    def _send_handshake(self):
+        handshake_bytes = struct.pack('>B19s8s20s20s',
                                       PROTOCOL_LEN,
                                       PROTOCOL,
-                                      info_hash,
+                                      RESERVED,
+                                      self.torrent.info_hash,
                                       self.torrent.peer_id.encode('utf-8'))
-        log.info(f'Sending message={handshake_bytes}')
-        self.data_length = len(handshake_bytes)
-        self.writer.write(handshake_bytes)
-        log.info('Handshake completed.')
+        self.transport.write(handshake_bytes)
+        self.last_sent = time.monotonic()
+        log.debug(f'Sent handshake to peer={self.peer.peer_id}')
 
-    async def _interested(self):
+    def _set_extensions(self, handshake: bytes):
+        reserved = handshake[1 + PROTOCOL_LEN:1 + PROTOCOL_LEN + 8]
+        self.is_fast = bool(reserved[FAST_EXTENSION_BYTE] & FAST_EXTENSION_BIT)
+        self.is_extended = supports_extensions(handshake)
+
+    def _send_extension_handshake(self):
+        if self.is_extended:
+            metadata = self.torrent.metadata
+            self._send_raw(extension_handshake(self.torrent.port, len(metadata) if metadata is not None else None))
+
+    def _interested(self):
         self.is_interested = True
-        msg = struct.pack('>Ib', 1, PeerMessage.interested.value)
-        self.writer.write(msg)
-        log.info('Sent interested message!')
-        await self.writer.drain()
+        self._send_message(PeerMessage.interested)
+        log.debug(f'Sent interested to peer={self.peer.peer_id}')
 
-    def _handle_bitfield(self, payload):
-        self.is_bit_field_received = True
+    def _not_interested(self):
+        self.is_interested = False
+        self._send_message(PeerMessage.not_interested)
+        log.debug(f'Sent not interested to peer={self.peer.peer_id}')
+
+    def update_interest(self):
+        """
+        Tells the peer we are interested once it has pieces we want, and
+        starts downloading from it.
+        """
+        if not self.is_connected or self.is_closed or not self._has_wanted_pieces():
+            return
+        if not self.is_interested:
+            self._interested()
+        self.client.peer_wanted(self)
+
+    def _send_message(self, message_type: PeerMessage, payload: bytes = b''):
+        self.transport.write(struct.pack('!IB', len(payload) + 1, message_type.value) + payload)
+        self.last_sent = time.monotonic()
+
+    def send_extended(self, name: bytes, payload: bytes):
+        """
+        Sends an extension message, with the id the peer asked for.
+        """
+        if self.transport is not None and not self.is_closed:
+            self._send_raw(extended_message(self.extensions[name], payload))
+
+    def _send_raw(self, message: bytes):
+        self.transport.write(message)
+        self.last_sent = time.monotonic()
+
+    def send_keep_alive(self):
+        self.transport.write(bytes(4))
+        self.last_sent = time.monotonic()
+
+    def _send_bitfield(self):
+        scheduler = self.client.scheduler
+        have = scheduler.have
+        if self.is_fast and scheduler.is_complete:
+            self._send_message(PeerMessage.have_all)
+        elif have.any():
+            self._send_message(PeerMessage.bitfield, have.tobytes())
+        elif self.is_fast:
+            self._send_message(PeerMessage.have_none)
+        if self.is_fast:
+            self._send_allowed_fast()
+
+    def _send_allowed_fast(self):
+        info_hash = self.torrent.info_hash
+        piece_count = self.torrent.download_info.piece_count
+        for piece_index in allowed_fast_set(self.peer.ip, info_hash, piece_count, ALLOWED_FAST_COUNT):
+            self.peer_allowed_fast.add(piece_index)
+            self._send_message(PeerMessage.allowed_fast, struct.pack('!I', piece_index))
+
+    def send_have(self, piece_index: int):
+        if self.transport is not None and not self.is_closed:
+            self._send_message(PeerMessage.have, struct.pack('!I', piece_index))
+
+    def set_choking(self, choking: bool):
+        if choking == self.is_choking or self.is_closed:
+            return
+        self.is_choking = choking
+        if choking:
+            upload_queue, self.upload_queue = self.upload_queue, deque()
+            self._send_message(PeerMessage.choke)
+            for request in upload_queue:
+                if request[0] in self.peer_allowed_fast:
+                    self.upload_queue.append(request)
+                elif self.is_fast:
+                    self._send_message(PeerMessage.reject_request, BLOCK_REQUEST.pack(*request))
+        else:
+            self._send_message(PeerMessage.unchoke)
+        log.debug(f'{"Choked" if choking else "Unchoked"} peer={self.peer.peer_id}')
+
+    def set_rate_limits(self, download_rate: Optional[int] = None, upload_rate: Optional[int] = None):
+        if download_rate is not None:
+            self.download_limiter.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload_limiter.set_rate(upload_rate)
+
+    def _handle_bitfield(self, payload: memoryview):
+        piece_count = self.torrent.download_info.piece_count
+        if len(payload) != (piece_count + 7) // 8:
+            raise ValueError(f'"bitfield" message of {len(payload)} bytes for {piece_count} pieces')
         arr = bitarray(endian='big')
         arr.frombytes(payload)
-        piece_count = self.torrent.download_info.piece_count
-        for i in range(piece_count):
-            if arr[i]:
-                self._add_owner(i)
-        for i in range(piece_count, len(arr)):
-            if arr[i]:
-                raise ValueError('Spare bits in "bitfield" message must be zero')
-
-    def _add_owner(self, piece_index):
-        self.torrent.download_info.pieces[piece_index].owners.add(self.peer)
-
-    def _handle_unchoke(self):
-        log.info(f'Received unchoked from peer={self.peer.peer_id}')
+        if arr[piece_count:].any():
+            raise ValueError('Spare bits in "bitfield" message must be zero')
+        if self.is_bit_field_received:
+            self.availability.remove_bitfield(self.bitfield)
+        self.is_bit_field_received = True
+        self.bitfield = arr[:piece_count]
+        self.availability.add_bitfield(self.bitfield)
+        self.update_interest()
+
+    def _handle_have(self, payload: memoryview):
+        (piece_index,) = struct.unpack('!I', payload)
+        if self.bitfield[piece_index]:
+            return
+        self.bitfield[piece_index] = 1
+        self.availability.add_piece(piece_index)
+        if self.scheduler is not None:
+            self.scheduler.notify()
+        # Restarts the worker if it ended for want of pieces
+        self.update_interest()
+
+    def _handle_have_all(self, payload: memoryview):
+        if not self.is_fast:
+            raise ValueError('"have all" without the Fast Extension')
+        if self.is_bit_field_received:
+            self.availability.remove_bitfield(self.bitfield)
+        self.is_bit_field_received = True
+        self.bitfield.setall(1)
+        self.availability.add_bitfield(self.bitfield)
+        self.update_interest()
+
+    def _handle_have_none(self, payload: memoryview):
+        if not self.is_fast:
+            raise ValueError('"have none" without the Fast Extension')
+        if self.is_bit_field_received:
+            self.availability.remove_bitfield(self.bitfield)
+        self.is_bit_field_received = True
+        self.bitfield.setall(0)
+
+    def _handle_choke(self, payload: memoryview):
+        log.info(f'Received choke from peer={self.peer.peer_id}')
+        self.is_choked = True
+        self._unchoked.clear()
+        if not self.is_fast:
+            # Requests are dropped on choke, unless the peer rejects them one by one
+            self._requeue(self.pipeline.clear())
+        self._idle.set()
+
+    def _handle_unchoke(self, payload: memoryview):
+        log.info(f'Received unchoke from peer={self.peer.peer_id}')
         self.is_choked = False
+        self._unchoked.set()
+        if self.scheduler is not None:
+            self._fill_pipeline()
+
+    def _handle_suggest_piece(self, payload: memoryview):
+        # Only a hint, rarest first is a better one for us
+        pass
+
+    def _handle_reject_request(self, payload: memoryview):
+        if not self.is_fast:
+            raise ValueError('"reject request" without the Fast Extension')
+        piece_index, begin, length = BLOCK_REQUEST.unpack(payload)
+        if self.pipeline.cancel(piece_index, begin):
+            self._requeue([(piece_index, begin)])
+            if not self.pipeline.outstanding:
+                self._idle.set()
+
+    def _handle_allowed_fast(self, payload: memoryview):
+        if not self.is_fast:
+            raise ValueError('"allowed fast" without the Fast Extension')
+        (piece_index,) = struct.unpack('!I', payload)
+        if piece_index < len(self.allowed_fast):
+            self.allowed_fast[piece_index] = 1
+
+    def _handle_extended(self, payload: memoryview):
+        if not self.is_extended:
+            raise ValueError('Extended message without the Extension Protocol')
+        extension_id, message, _ = parse_extended(payload)
+        if extension_id == 0:
+            extensions = message.get(b'm')
+            if isinstance(extensions, dict):
+                self.extensions = {name: i for name, i in extensions.items() if isinstance(i, int) and i}
+            port = message.get(b'p')
+            if not self.is_outgoing and isinstance(port, int) and 0 < port < 2 ** 16:
+                self.listen_port = port
+            if b'ut_pex' in self.extensions:
+                self.client.pex.send(self)
+        elif extension_id == EXTENSION_IDS[b'ut_metadata']:
+            self._handle_metadata(message)
+        elif extension_id == EXTENSION_IDS[b'ut_pex']:
+            self.client.pex.received(self, message)
+
+    def _handle_metadata(self, message: Dict[bytes, Any]):
+        """
+        Answers the BEP 9 requests of a peer which started from a magnet link.
+        """
+        extension_id = self.extensions.get(b'ut_metadata')
+        if message.get(b'msg_type') != MetadataMessage.request.value or not extension_id:
+            return
+        piece = message.get(b'piece')
+        metadata = self.torrent.metadata
+        if metadata is not None and isinstance(piece, int) and 0 <= piece * METADATA_PIECE_SIZE < len(metadata):
+            self._send_raw(metadata_message(extension_id, MetadataMessage.data, piece, metadata))
+        else:
+            self._send_raw(metadata_message(extension_id, MetadataMessage.reject, piece if isinstance(piece, int) else 0))
+
+    def _requeue(self, requests: List[Tuple[int, int]]):
+        """
+        Puts blocks whose requests were dropped back in front of the queue.
+        """
+        info = self.torrent.download_info
+        for piece_index, begin in reversed(requests):
+            if piece_index in self.active_pieces or self.buffers.get(piece_index) is not None:
+                length = min(BLOCK_SIZE, info.piece_size(piece_index) - begin)
+                self.block_queue.appendleft(Block(piece_index, begin, length))
 
-    async def download(self, piece_index: int):
-        blocks = self.torrent.pieces[piece_index].blocks
-        for block in blocks:
-            log.info(f'Size of the request {block.offset} {block.length}')
-            payload = struct.pack('!3I', piece_index, block.offset, block.length)
-            self._send_message(PeerMessage.request, payload)
-        log.info(f'Request blocks for piece={piece_index}')
-        log.info('Sent message, receiving now...')
-        # while True:
-        #     await self._receive_message()
-        while not self.torrent.pieces[piece_index].is_downloaded:
-            await self._receive_message()
-
-    def _send_message(self, message_type: PeerMessage, payload: bytes):
-        length = len(payload) + 1
-        self.writer.write(struct.pack('!IB', length, message_type.value))
-        self.writer.write(payload)
-
-    async def _handle_piece(self, payload: bytes):
-        fmt = '!2I'
-        piece_index, block_begin = struct.unpack_from(fmt, payload)
-        block_index = int(block_begin / BLOCK_SIZE)
-        log.info(f'Block Index={block_index}')
-        log.info(f'Block Begin={block_begin}')
-        piece = self.torrent.pieces[piece_index]
-        log.info(f'No of blocks={len(piece.blocks)}')
-        if piece.is_downloaded:
+    def _handle_interested(self, payload: memoryview):
+        self.is_peer_interested = True
+        self.client.choker.interested(self)
+
+    def _handle_not_interested(self, payload: memoryview):
+        self.is_peer_interested = False
+
+    def _handle_request(self, payload: memoryview):
+        piece_index, begin, length = BLOCK_REQUEST.unpack(payload)
+        if self.is_choking and piece_index not in self.peer_allowed_fast:
+            if self.is_fast:
+                self._send_message(PeerMessage.reject_request, payload)
+            return
+        if piece_index >= self.torrent.download_info.piece_count or not self.client.scheduler.have[piece_index] or \
+                length > MAX_REQUEST_LENGTH or begin + length > self.torrent.piece_size(piece_index):
+            raise ValueError(f'Invalid request piece={piece_index} begin={begin} length={length}')
+        if len(self.upload_queue) >= UPLOAD_QUEUE_MAX:
+            log.debug(f'Upload queue of peer={self.peer.peer_id} is full, dropping request.')
+            if self.is_fast:
+                self._send_message(PeerMessage.reject_request, payload)
             return
-        piece.blocks[block_index].is_downloaded = True
-        if all([block.is_downloaded for block in piece.blocks]):
-            log.info('Piece is already downloaded.')
-            piece.is_downloaded = True
-
-        block_data = payload[struct.calcsize(fmt):]
-        await self._write(piece_index * self.torrent.piece_length + block_begin, block_data)
-
-    async def _write(self, offset: int, data: bytes):
-        file_index = 0
-        length = self.torrent.files[0].length
-        while offset > length:
-            file_index += 1
-            length += self.torrent.files[file_index].length
-
-        file_to_write = self.torrent.files[file_index]
-        for i in range(0, file_index):
-            offset -= self.torrent.files[i].length
-        filepath = os.path.join(DOWNLOAD_PATH, file_to_write.path)
-        log.info(f'File Name={file_to_write.path}')
-        async with async_open(filepath, 'r+b') as afp:
-            afp.seek(offset)
-            await afp.write(data)
-
-        # self.fd.seek(offset)
-        # self.fd.write(data)
-        log.info('Successfully wrote to the file.')
+        self.upload_queue.append((piece_index, begin, length))
+        if self._upload_task is None or self._upload_task.done():
+            self._upload_task = asyncio.create_task(self._upload())
+
+    def _handle_cancel(self, payload: memoryview):
+        try:
+            self.upload_queue.remove(BLOCK_REQUEST.unpack(payload))
+        except ValueError:
+            return
+        if self.is_fast:
+            # Every request gets an answer with the Fast Extension
+            self._send_message(PeerMessage.reject_request, payload)
+
+    async def _upload(self):
+        """
+        Serves the queued requests one block at a time, waiting for the
+        transport to drain so that a slow peer never buffers more than a few
+        blocks in memory.
+        """
+        try:
+            while self.upload_queue and not self.is_closed:
+                piece_index, begin, length = self.upload_queue.popleft()
+                block = await self.client.read_cache.read(piece_index, begin, length)
+                if not self.upload_limiter.try_consume(length):
+                    await self.upload_limiter.consume(length)
+                if self.is_closed or self.is_choking and piece_index not in self.peer_allowed_fast:
+                    continue
+                self.transport.write(struct.pack('!IB2I', 9 + length, PeerMessage.piece.value, piece_index, begin))
+                self.transport.write(block)
+                self.last_sent = time.monotonic()
+                self.upload_meter.add(length)
+                self.client.upload_meter.add(length)
+                self.torrent.uploaded += length
+                await self.protocol.drain()
+        except ConnectionError:
+            self.close()
+
+    async def download(self, scheduler: PieceScheduler):
+        """
+        Downloads pieces from the peer until the scheduler has nothing left
+        for it.
+
+        Requests are pipelined across piece boundaries: every arriving block
+        tops the window of outstanding requests up again, taking the next
+        piece from the scheduler once the pieces at hand are fully requested.
+        This loop only wakes up when the window runs dry or the peer stalls.
+        """
+        self.scheduler = scheduler
+        self.last_received = time.monotonic()
+        try:
+            while True:
+                if self.is_closed:
+                    raise ConnectionError(f'Connection to peer={self.peer.peer_id} was closed')
+                if not self._has_wanted_pieces():
+                    self._lose_interest()
+                    return
+                self._fill_pipeline()
+                if self.is_choked and not self.pipeline.outstanding:
+                    await self._wait_unchoked()
+                    continue
+                if not self.pipeline.outstanding and not self.block_queue:
+                    if scheduler.is_endgame:
+                        # Nothing to duplicate from this peer for now
+                        await scheduler.wait()
+                        continue
+                    if not self.buffers.has_room(self.torrent.piece_length):
+                        await self.buffers.wait_for_room(self.torrent.piece_length)
+                        continue
+                    piece_index = await scheduler.next_piece(self.bitfield)
+                    if piece_index is None:
+                        if scheduler.is_endgame or scheduler.urgent(self.bitfield):
+                            continue
+                        self._lose_interest()
+                        return
+                    self._queue_piece(piece_index)
+                    continue
+                self._idle.clear()
+                try:
+                    await asyncio.wait_for(self._idle.wait(), timeout=REQUEST_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - self.last_received >= REQUEST_TIMEOUT:
+                        raise
+        except BaseException:
+            self._release_pieces()
+            raise
+
+    def _lose_interest(self):
+        """
+        Tells the peer we are no longer interested when the worker ends for
+        want of pieces, a "have" or a bitfield starts it again.
+        """
+        if self.is_interested and not self.is_closed:
+            self._not_interested()
+
+    def _has_wanted_pieces(self) -> bool:
+        """
+        Returns: whether the peer has pieces we still need, pending or in flight
+        """
+        scheduler = self.client.scheduler
+        return not scheduler.is_complete and (scheduler.remaining & self.bitfield).any()
+
+    async def _wait_unchoked(self):
+        """
+        Waits for the peer to unchoke us, handing our pieces over to other
+        peers if that takes too long. Also returns once the peer has nothing
+        left we want, so the worker does not outlive the download.
+        """
+        deadline = time.monotonic() + REQUEST_TIMEOUT
+        while not self._unchoked.is_set() and self._has_wanted_pieces():
+            if self.active_pieces and time.monotonic() >= deadline:
+                log.info(f'peer={self.peer.peer_id} keeps choking us, releasing its pieces.')
+                self._release_pieces()
+            unchoked = asyncio.ensure_future(self._unchoked.wait())
+            # The scheduler wakes us up when pieces complete or get released
+            changed = self.scheduler.waiter()
+            timeout = deadline - time.monotonic() if self.active_pieces else None
+            try:
+                await asyncio.wait({unchoked, changed}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                unchoked.cancel()
+                changed.cancel()
+
+    def _queue_piece(self, piece_index: int):
+        self.active_pieces.add(piece_index)
+        self.buffers.acquire(piece_index, self.torrent.piece_size(piece_index))
+        self.block_queue.extend(self.torrent.download_info.piece(piece_index).blocks())
+
+    def _fill_pipeline(self):
+        self._cancel_throttle()
+        requested = 0
+        limiter = self.download_limiter
+        info = self.torrent.download_info
+        # While choked, only the pieces the peer allows fast may be requested
+        have = self.bitfield & self.allowed_fast if self.is_choked else self.bitfield
+        is_endgame_queued = is_urgent_queued = False
+        while self.pipeline.free > 0:
+            if not self.block_queue:
+                if self.scheduler.deadlines and not is_urgent_queued:
+                    # Pieces close to their deadline come before new ones
+                    is_urgent_queued = True
+                    self._queue_duplicate_blocks(self.scheduler.urgent(have))
+                    if self.block_queue:
+                        continue
+                piece_index = None
+                if self.buffers.has_room(self.torrent.piece_length):
+                    piece_index = self.scheduler.take(have)
+                if piece_index is not None:
+                    self._queue_piece(piece_index)
+                elif self.scheduler.is_endgame and not is_endgame_queued:
+                    is_endgame_queued = True
+                    self._queue_duplicate_blocks(index for index in self.scheduler.assigned if have[index])
+                    if not self.block_queue:
+                        break
+                else:
+                    break
+            block = self.block_queue[0]
+            if info.is_block_received(block.piece, block.offset) or self.buffers.get(block.piece) is None or \
+                    (block.piece, block.offset) in self.pipeline.outstanding:
+                # Arrived from another peer in endgame, or the piece was given up
+                self.block_queue.popleft()
+                continue
+            if self.is_choked and not self.allowed_fast[block.piece]:
+                break
+            if not limiter.try_consume(block.length):
+                # Requests are held back rather than the data they bring
+                self._throttle = asyncio.get_running_loop().call_later(limiter.delay(), self._fill_pipeline)
+                break
+            block = self.block_queue.popleft()
+            self.torrent.download_info.mark_requested(block.piece, block.offset)
+            self._send_message(PeerMessage.request, BLOCK_REQUEST.pack(block.piece, block.offset, block.length))
+            self.pipeline.sent(block.piece, block.offset)
+            requested += 1
+        if requested:
+            log.debug(f'Requested {requested} blocks from peer={self.peer.peer_id}, window={self.pipeline.depth}')
+        if not self.pipeline.outstanding and self._throttle is None:
+            self._idle.set()
+
+    def _queue_duplicate_blocks(self, pieces: Iterable[int]):
+        """
+        Queues the missing blocks of pieces in flight, even if another peer
+        was asked for them already.
+        """
+        info = self.torrent.download_info
+        for piece_index in pieces:
+            if self.buffers.get(piece_index) is None:
+                continue
+            for block in info.piece(piece_index).missing_blocks():
+                if (block.piece, block.offset) not in self.pipeline.outstanding:
+                    self.block_queue.append(block)
+        if self.block_queue:
+            log.debug(f'Requesting {len(self.block_queue)} blocks in flight from peer={self.peer.peer_id} too')
+
+    def cancel_request(self, piece_index: int, begin: int, length: int):
+        """
+        Withdraws a request for a block which arrived from another peer.
+        """
+        if not self.pipeline.cancel(piece_index, begin) or self.is_closed:
+            return
+        self._send_message(PeerMessage.cancel, BLOCK_REQUEST.pack(piece_index, begin, length))
+        if not self.pipeline.outstanding:
+            self._idle.set()
+
+    def _cancel_throttle(self):
+        if self._throttle is not None:
+            self._throttle.cancel()
+            self._throttle = None
+
+    def _release_pieces(self):
+        self._cancel_throttle()
+        self.pipeline.clear()
+        self.block_queue.clear()
+        active_pieces, self.active_pieces = self.active_pieces, set()
+        for piece_index in active_pieces:
+            self.buffers.release(piece_index)
+            self.scheduler.release(piece_index)
+
+    def _handle_piece(self, payload: memoryview):
+        piece_index, block_begin = PIECE_HEADER.unpack_from(payload)
+        block_data = payload[PIECE_HEADER.size:]
+        if not self.pipeline.received(piece_index, block_begin, len(block_data)):
+            log.debug(f'Ignoring unrequested block piece={piece_index} begin={block_begin}')
+            return
+        self.torrent.downloaded += len(block_data)
+        buffer = self.buffers.get(piece_index)
+        info = self.torrent.download_info
+        if buffer is not None and not info.completed[piece_index] and info.mark_received(piece_index, block_begin):
+            self.scheduler.add_contributor(piece_index, self)
+            buffer.write(block_begin, block_data)
+            if self.scheduler.is_endgame or piece_index in self.scheduler.deadlines:
+                self.client.cancel_block(piece_index, block_begin, len(block_data), self)
+            if info.is_received(piece_index):
+                self.active_pieces.discard(piece_index)
+                self.client.piece_received(piece_index)
+                # Hashing runs in the background so the pipeline keeps flowing.
+                task = asyncio.create_task(self._verify_piece(piece_index))
+                self.verify_tasks.add(task)
+                task.add_done_callback(self.verify_tasks.discard)
+        self._fill_pipeline()
+
+    async def _verify_piece(self, piece_index: int):
+        """
+        Checks an assembled piece and flushes it to disk in a single write.
+        """
+        buffer = self.buffers.get(piece_index)
+        try:
+            if await self.hasher.verify(buffer.view, self.torrent.piece_hash(piece_index)):
+                await self.storage.write(piece_index * self.torrent.piece_length, buffer.view)
+                self.client.piece_completed(piece_index)
+                return
+        except OSError as e:
+            # Disk full or failing: the piece goes back to the queue for a retry
+            log.error(f'Could not write piece={piece_index}: {e!r}')
+            self.scheduler.release(piece_index)
+            return
+        finally:
+            self.buffers.release(piece_index)
+        log.warning(f'Piece={piece_index} failed the hash check, downloading it again.')
+        for peer_client in self.scheduler.contributors.get(piece_index, ()):
+            peer_client.penalize()
+        self.scheduler.release(piece_index)
+
+    def penalize(self):
+        """
+        Counts a failed hash check against the peer and drops it once it sent
+        too many bad pieces.
+        """
+        self.hash_failures += 1
+        if self.hash_failures >= MAX_HASH_FAILURES and not self.is_banned:
+            log.warning(f'Dropping peer={self.peer.peer_id} after {self.hash_failures} bad pieces.')
+            self.is_banned = True
+            self.close()
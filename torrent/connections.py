@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from typing import Dict, Iterable, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from const import MAX_PEERS, MAX_HALF_OPEN, CONNECT_BACKOFF, MAX_CONNECT_FAILURES
+from log import get_logger
+from models.peer import Peer
+
+if TYPE_CHECKING:
+    from torrent.client import Client, PeerClient
+
+log = get_logger(__name__)
+
+
+class PeerSource(IntEnum):
+    """
+    Where a peer was learnt from, the most trusted first.
+    """
+    manual = 0
+    tracker = 1
+    incoming = 2
+    pex = 3
+    dht = 4
+
+
+class Candidate:
+    __slots__ = ('peer', 'source', 'failures', 'rate', 'retry_at', 'peer_client', 'is_connected')
+
+    def __init__(self, peer: Peer, source: PeerSource):
+        self.peer = peer
+        self.source = source
+        self.failures = 0
+        # Best download rate seen from the peer, in bytes per second
+        self.rate = 0.0
+        self.retry_at = 0.0
+        self.peer_client: Optional['PeerClient'] = None
+        self.is_connected = False
+
+    @property
+    def score(self) -> Tuple[int, float, int]:
+        return self.failures, -self.rate, self.source
+
+
+class ConnectionManager:
+    """
+    Keeps a torrent connected to the best peers it knows of.
+
+    Candidate peers wait in a priority queue ordered by their failures,
+    the throughput they gave us before and where they came from. At most
+    `max_half_open` of them are being connected to at once, up to
+    `max_peers` connections. Peers which fail are retried with exponential
+    backoff, and dropped connections are replaced from the queue.
+    """
+
+    def __init__(self, client: 'Client', max_peers: int = MAX_PEERS, max_half_open: int = MAX_HALF_OPEN):
+        self.client = client
+        self.max_peers = max_peers
+        self.max_half_open = max_half_open
+        self.candidates: Dict[Tuple[str, int], Candidate] = {}
+        self.banned: Set[Tuple[str, int]] = set()
+        self.half_open = 0
+        self.connected = 0
+        self._queue: List[Tuple[Tuple[int, float, int], int, Candidate]] = []
+        # Candidates backing off, by the time they may be retried
+        self._backoff: List[Tuple[float, int, Candidate]] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._waiters: Set[asyncio.Future] = set()
+        # Connection attempts in progress
+        self._connects: Set[asyncio.Task] = set()
+        self._task = None
+
+    @property
+    def is_connecting(self) -> bool:
+        """
+        Whether more peers may still get connected without new candidates.
+        """
+        return bool(self.half_open or self._queue or self._backoff)
+
+    def add(self, peers: Iterable[Peer], source: PeerSource = PeerSource.tracker):
+        added = 0
+        for peer in peers:
+            key = peer.ip, peer.port
+            if key in self.candidates or key in self.banned:
+                continue
+            candidate = self.candidates[key] = Candidate(peer, source)
+            self._push(candidate)
+            added += 1
+        if added:
+            log.debug(f'{added} new peer candidates from {source.name}.')
+            self._wakeup.set()
+
+    def _push(self, candidate: Candidate):
+        if candidate.retry_at > time.monotonic():
+            heapq.heappush(self._backoff, (candidate.retry_at, next(self._counter), candidate))
+        else:
+            heapq.heappush(self._queue, (candidate.score, next(self._counter), candidate))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in self._connects:
+            task.cancel()
+        self._notify()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._backoff and self._backoff[0][0] <= now:
+                _, _, candidate = heapq.heappop(self._backoff)
+                heapq.heappush(self._queue, (candidate.score, next(self._counter), candidate))
+            is_starved = False
+            while self._queue and self.half_open < self.max_half_open and \
+                    self.half_open + self.connected < self.max_peers:
+                if not self.client.acquire_connection():
+                    is_starved = True
+                    break
+                _, _, candidate = heapq.heappop(self._queue)
+                self.half_open += 1
+                task = asyncio.create_task(self._connect(candidate))
+                self._connects.add(task)
+                task.add_done_callback(self._connects.discard)
+            if not self.is_connecting:
+                self._notify()
+            self._wakeup.clear()
+            timeout = self._backoff[0][0] - now if self._backoff else None
+            if is_starved:
+                # Out of session-wide connection slots, look again later
+                timeout = CONNECT_BACKOFF if timeout is None else min(timeout, CONNECT_BACKOFF)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _connect(self, candidate: Candidate):
+        peer_client = self.client.create_peer(candidate.peer)
+        candidate.peer_client = peer_client
+        try:
+            await peer_client.connect()
+        except asyncio.CancelledError:
+            peer_client.close()
+            raise
+        finally:
+            self.half_open -= 1
+            self._wakeup.set()
+        if peer_client.is_closed:
+            self._failed(candidate)
+            return
+        candidate.failures = 0
+        candidate.is_connected = True
+        self.connected += 1
+        self._notify()
+
+    def _failed(self, candidate: Candidate):
+        candidate.peer_client = None
+        candidate.failures += 1
+        if candidate.failures >= MAX_CONNECT_FAILURES:
+            log.debug(f'Giving up on peer {candidate.peer.ip}:{candidate.peer.port}')
+            self._forget(candidate)
+            return
+        candidate.retry_at = time.monotonic() + CONNECT_BACKOFF * 2 ** (candidate.failures - 1)
+        self._push(candidate)
+
+    def _forget(self, candidate: Candidate):
+        key = candidate.peer.ip, candidate.peer.port
+        self.candidates.pop(key, None)
+        self.banned.add(key)
+        self._notify()
+
+    def closed(self, peer_client: 'PeerClient'):
+        """
+        Puts the peer of a dropped connection back in the queue, and lets a
+        new connection replace it.
+        """
+        candidate = self.candidates.get((peer_client.peer.ip, peer_client.peer.port))
+        if candidate is None or candidate.peer_client is not peer_client or not candidate.is_connected:
+            return
+        candidate.peer_client = None
+        candidate.is_connected = False
+        self.connected -= 1
+        candidate.rate = max(candidate.rate, peer_client.pipeline.rate)
+        if peer_client.is_banned:
+            self._forget(candidate)
+        else:
+            candidate.retry_at = time.monotonic() + CONNECT_BACKOFF
+            self._push(candidate)
+        self._wakeup.set()
+
+    def _notify(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_for_peers(self):
+        """
+        Waits until a peer is connected or there is nobody left to try.
+        """
+        while not self.connected and self.is_connecting and self._task is not None:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.add(waiter)
+            try:
+                await waiter
+            finally:
+                self._waiters.discard(waiter)
@@ -1,12 +1,77 @@
-from typing import Dict
+import asyncio
+from typing import Dict, TYPE_CHECKING
 
+from log import get_logger
 from models.torrent import Torrent
-from torrent.client import PeerClient
+from torrent.scheduler import PieceScheduler
+
+if TYPE_CHECKING:
+    from torrent.client import PeerClient
+
+log = get_logger(__name__)
 
 
 class Downloader:
-    def __init__(self, torrent: Torrent, peer_clients: Dict[bytes, PeerClient]):
+    """
+    Runs one worker per peer which has pieces we want, all of them pulling
+    pieces from the same scheduler. Peers connect and announce pieces at any
+    time, so the download goes on until it is complete or stopped, even
+    while there are no workers.
+    """
+
+    def __init__(self, torrent: Torrent, scheduler: PieceScheduler):
         self.torrent = torrent
-        self.peer_clients = peer_clients
+        self.scheduler = scheduler
+        self._workers: Dict['PeerClient', asyncio.Task] = {}
+        self._stopped = asyncio.Event()
+
+    async def download(self):
+        log.info(f'Starting download with {len(self._workers)} peers.')
+        while not self.scheduler.is_complete and not self._stopped.is_set():
+            # The scheduler wakes us up when pieces complete
+            changed = self.scheduler.waiter()
+            stopped = asyncio.ensure_future(self._stopped.wait())
+            try:
+                await asyncio.wait({changed, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                changed.cancel()
+                stopped.cancel()
+        if self._workers:
+            await asyncio.wait(set(self._workers.values()))
+        if self.scheduler.is_complete:
+            log.info('Download complete!')
+        else:
+            log.info(f'Download stopped with {self.scheduler.left} pieces left.')
+
+    def add(self, peer_client: 'PeerClient'):
+        """
+        Starts a worker for a peer which has pieces we want, unless it
+        already has one.
+        """
+        task = self._workers.get(peer_client)
+        if task is not None and not task.done():
+            return
+        self._workers[peer_client] = asyncio.create_task(self._worker(peer_client))
+
+    def stop(self):
+        """
+        Ends the download once the workers are done, e.g. when the client
+        closes its connections.
+        """
+        self._stopped.set()
 
-    
\ No newline at end of file
+    async def _worker(self, peer_client: 'PeerClient'):
+        peer = peer_client.peer
+        try:
+            await peer_client.download(self.scheduler)
+            log.info(f'Worker for peer={peer.peer_id} finished.')
+            return
+        except asyncio.TimeoutError:
+            log.warning(f'peer={peer.peer_id} stopped answering requests, dropping it.')
+        except Exception as e:
+            log.error(f'peer={peer.peer_id} failed with error: {e}')
+        finally:
+            if self._workers.get(peer_client) is asyncio.current_task():
+                del self._workers[peer_client]
+        # The peer client has already put its pieces back in the queue.
+        peer_client.close()
@@ -0,0 +1,31 @@
+import hashlib
+import socket
+import struct
+from typing import List
+
+
+def allowed_fast_set(ip: str, info_hash: bytes, piece_count: int, k: int) -> List[int]:
+    """
+    The pieces a peer may download from us while choked, as computed in
+    BEP 6 from its /24 network so that it cannot get more by reconnecting.
+
+    Returns: up to `k` piece indices
+    """
+    k = min(k, piece_count)
+    pieces: List[int] = []
+    try:
+        packed_ip = socket.inet_aton(ip)
+    except OSError:
+        # Only IPv4 addresses are covered by the BEP
+        return pieces
+    x = bytes(packed_ip[:3]) + b'\x00' + info_hash
+    while len(pieces) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(pieces) >= k:
+                break
+            (y,) = struct.unpack_from('!I', x, i)
+            index = y % piece_count
+            if index not in pieces:
+                pieces.append(index)
+    return pieces
@@ -0,0 +1,50 @@
+from enum import Enum
+from typing import List, Sequence
+
+from models.torrent import Torrent
+
+
+class FilePriority(Enum):
+    skip = 0
+    normal = 1
+    high = 2
+
+
+class FileIndex:
+    """
+    Range of pieces each file of a torrent overlaps, computed once.
+
+    File priorities turn into piece priorities in a single pass over the
+    files, a piece taking the highest priority of the files it overlaps: the
+    pieces at the boundary of a wanted file are downloaded even if the file
+    next to it is skipped.
+    """
+
+    def __init__(self, torrent: Torrent):
+        self.piece_count = torrent.download_info.piece_count
+        self.ranges: List[range] = []
+        offset = 0
+        for file in torrent.files:
+            if file.length:
+                self.ranges.append(range(offset // torrent.piece_length,
+                                         (offset + file.length - 1) // torrent.piece_length + 1))
+            else:
+                self.ranges.append(range(0))
+            offset += file.length
+
+    def pieces(self, file_index: int) -> range:
+        return self.ranges[file_index]
+
+    def piece_priorities(self, priorities: Sequence[FilePriority]) -> List[FilePriority]:
+        """
+        Returns: the priority of each piece
+        """
+        if len(priorities) != len(self.ranges):
+            raise ValueError(f'Expected {len(self.ranges)} file priorities, got {len(priorities)}')
+        pieces = [FilePriority.skip] * self.piece_count
+        # Higher priorities are written last and win at the boundaries
+        for file_index in sorted(range(len(priorities)), key=lambda i: priorities[i].value):
+            priority, pieces_range = priorities[file_index], self.ranges[file_index]
+            if priority != FilePriority.skip:
+                pieces[pieces_range.start:pieces_range.stop] = [priority] * len(pieces_range)
+        return pieces
@@ -0,0 +1,32 @@
+import asyncio
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from log import get_logger
+
+log = get_logger(__name__)
+
+
+def sha1(data: bytes) -> bytes:
+    return hashlib.sha1(data).digest()
+
+
+class PieceHasher:
+    """
+    Checks pieces against their SHA-1 hash on a pool of worker threads.
+
+    hashlib releases the GIL while hashing large buffers, so the threads hash
+    in parallel and the event loop keeps serving peers meanwhile.
+    """
+
+    def __init__(self, executor: Optional[ThreadPoolExecutor] = None):
+        self.executor = executor or ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='hash')
+
+    async def verify(self, data: bytes, expected: bytes) -> bool:
+        digest = await asyncio.get_running_loop().run_in_executor(self.executor, sha1, data)
+        return digest == expected
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import struct
+from typing import Any, Awaitable, Dict, Iterable, List, Optional, Set, Tuple
+
+import bencodepy
+
+from const import PROTOCOL_LEN, PROTOCOL, RESERVED, EXTENSION_PROTOCOL_BYTE, EXTENSION_PROTOCOL_BIT, EXTENSION_IDS, \
+    METADATA_PIECE_SIZE, MAX_METADATA_SIZE, METADATA_PEERS, METADATA_REQUEST_TIMEOUT, PEER_CONNECT_TIMEOUT, \
+    CLIENT_ID, VERSION, PeerMessage, MetadataMessage
+from log import get_logger
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.bencode import BencodeError, Decoder
+from torrent.protocol import PeerProtocol
+
+log = get_logger(__name__)
+
+MESSAGE_HEADER = struct.Struct('!IBB')
+
+
+def supports_extensions(handshake: bytes) -> bool:
+    reserved = handshake[1 + PROTOCOL_LEN:1 + PROTOCOL_LEN + 8]
+    return bool(reserved[EXTENSION_PROTOCOL_BYTE] & EXTENSION_PROTOCOL_BIT)
+
+
+def extended_message(extension_id: int, payload: bytes) -> bytes:
+    return MESSAGE_HEADER.pack(len(payload) + 2, PeerMessage.extended.value, extension_id) + payload
+
+
+def extension_handshake(port: int, metadata_size: Optional[int] = None) -> bytes:
+    """
+    Returns: our BEP 10 handshake, with the ids of the extensions we support
+    """
+    handshake = {b'm': EXTENSION_IDS, b'p': port, b'v': f'{CLIENT_ID} {VERSION}'.encode()}
+    if metadata_size is not None:
+        handshake[b'metadata_size'] = metadata_size
+    return extended_message(0, bencodepy.encode(handshake))
+
+
+def metadata_message(extension_id: int, message_type: MetadataMessage, piece: int,
+                     metadata: Optional[bytes] = None) -> bytes:
+    """
+    Returns: a ut_metadata message; `metadata` is the whole info dictionary
+    when sending one of its pieces
+    """
+    message = {b'msg_type': message_type.value, b'piece': piece}
+    data = b''
+    if metadata is not None:
+        message[b'total_size'] = len(metadata)
+        data = metadata[piece * METADATA_PIECE_SIZE:(piece + 1) * METADATA_PIECE_SIZE]
+    return extended_message(extension_id, bencodepy.encode(message) + data)
+
+
+def parse_extended(payload: memoryview) -> Tuple[int, Dict[bytes, Any], memoryview]:
+    """
+    Returns: the extension id of an extended message, its bencoded
+    dictionary and the data which follows it
+    """
+    decoder = Decoder(payload[1:])
+    message = decoder.decode(trailing=True)
+    if not isinstance(message, dict):
+        raise BencodeError('Extended message is not a dictionary')
+    return payload[0], message, decoder.view[decoder.end:]
+
+
+class MetadataError(Exception):
+    pass
+
+
+class MetadataPeer:
+    """
+    A connection used only to download the info dictionary from a peer.
+    """
+
+    def __init__(self, fetcher: 'MetadataFetcher', peer: Peer):
+        self.fetcher = fetcher
+        self.peer = peer
+        self.transport = None
+        self.extension_id = None
+        self._handshake: Optional[asyncio.Future] = None
+        self._extended: Optional[asyncio.Future] = None
+        self._pieces: Dict[int, asyncio.Future] = {}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._handshake = loop.create_future()
+        self._extended = loop.create_future()
+        torrent = self.fetcher.torrent
+        try:
+            self.transport, _ = await asyncio.wait_for(
+                loop.create_connection(lambda: PeerProtocol(self), self.peer.ip, self.peer.port),
+                timeout=PEER_CONNECT_TIMEOUT)
+            self.transport.write(struct.pack('>B19s8s20s20s', PROTOCOL_LEN, PROTOCOL, RESERVED,
+                                             torrent.info_hash, torrent.peer_id.encode('utf-8')))
+            handshake = await asyncio.wait_for(self._handshake, timeout=PEER_CONNECT_TIMEOUT)
+            if handshake[28:48] != torrent.info_hash or not supports_extensions(handshake):
+                return
+            self.transport.write(extension_handshake(torrent.port))
+            metadata_size = await asyncio.wait_for(self._extended, timeout=PEER_CONNECT_TIMEOUT)
+            if not self.fetcher.set_size(metadata_size):
+                return
+            while not self.fetcher.is_complete:
+                piece = self.fetcher.next_piece(self)
+                if piece is None:
+                    await asyncio.wait_for(asyncio.shield(self.fetcher.done), timeout=METADATA_REQUEST_TIMEOUT)
+                    continue
+                self._pieces[piece] = loop.create_future()
+                self.transport.write(metadata_message(self.extension_id, MetadataMessage.request, piece))
+                try:
+                    data = await asyncio.wait_for(self._pieces[piece], timeout=METADATA_REQUEST_TIMEOUT)
+                finally:
+                    self.fetcher.request_done(piece)
+                    del self._pieces[piece]
+                self.fetcher.piece_received(piece, data)
+        except asyncio.TimeoutError:
+            log.debug(f'peer={self.peer.peer_id} timed out sending metadata')
+        except (OSError, MetadataError) as e:
+            log.debug(f'peer={self.peer.peer_id} failed sending metadata: {e!r}')
+        finally:
+            self.close()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for future in (self._handshake, self._extended, *self._pieces.values()):
+            if future is not None and not future.done():
+                future.cancel()
+
+    def handshake_received(self, handshake: bytes):
+        if not self._handshake.done():
+            self._handshake.set_result(handshake)
+
+    def keep_alive_received(self):
+        pass
+
+    def message_received(self, message_id: int, payload: memoryview):
+        if message_id != PeerMessage.extended.value:
+            return
+        try:
+            extension_id, message, data = parse_extended(payload)
+        except (BencodeError, IndexError) as e:
+            log.debug(f'Invalid extended message from peer={self.peer.peer_id}: {e!r}')
+            self.close()
+            return
+        if extension_id == 0:
+            extensions = message.get(b'm')
+            self.extension_id = extensions.get(b'ut_metadata') if isinstance(extensions, dict) else None
+            if self._extended.done():
+                return
+            if not self.extension_id or not isinstance(message.get(b'metadata_size'), int):
+                self._extended.set_exception(MetadataError('Peer does not share metadata'))
+            else:
+                self._extended.set_result(message[b'metadata_size'])
+        elif extension_id == EXTENSION_IDS[b'ut_metadata']:
+            future = self._pieces.get(message.get(b'piece'))
+            if future is None or future.done():
+                return
+            if message.get(b'msg_type') == MetadataMessage.data.value:
+                future.set_result(bytes(data))
+            else:
+                future.set_exception(MetadataError(f'Peer rejected metadata piece {message.get(b"piece")}'))
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.transport = None
+        self.close()
+
+
+class MetadataFetcher:
+    """
+    Downloads the info dictionary of a torrent started from a magnet link,
+    with the BEP 9 ut_metadata extension.
+
+    Up to METADATA_PEERS peers are asked at once, each for a different
+    16 KiB piece; once every piece is requested, the missing ones are asked
+    to the idle peers too. The assembled dictionary is checked against the
+    info hash, and fetched again if it does not match.
+    """
+
+    def __init__(self, torrent: Torrent, peers: Iterable[Peer] = ()):
+        self.torrent = torrent
+        self.size = None
+        self.pieces: List[Optional[bytes]] = []
+        # Requests in flight per piece
+        self.requested: Dict[int, int] = {}
+        self.done = asyncio.get_running_loop().create_future()
+        # Every peer heard of, and the ones not tried yet
+        self.peers: List[Peer] = []
+        self._candidates: List[Peer] = []
+        self._seen: Set[Tuple[str, int]] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._changed = asyncio.Event()
+        self.add_peers(peers)
+
+    @property
+    def is_complete(self) -> bool:
+        return self.done.done()
+
+    def add_peers(self, peers: Iterable[Peer]):
+        for peer in peers:
+            if (peer.ip, peer.port) not in self._seen:
+                self._seen.add((peer.ip, peer.port))
+                self.peers.append(peer)
+                self._candidates.append(peer)
+        self._connect()
+
+    def _connect(self):
+        while self._candidates and len(self._tasks) < METADATA_PEERS and not self.is_complete:
+            task = asyncio.create_task(MetadataPeer(self, self._candidates.pop(0)).run())
+            self._tasks.add(task)
+            task.add_done_callback(self._peer_done)
+        self._changed.set()
+
+    def _peer_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._connect()
+
+    def set_size(self, size: int) -> bool:
+        """
+        Returns: whether `size`, announced by a peer, is usable
+        """
+        if not 0 < size <= MAX_METADATA_SIZE:
+            return False
+        if self.size is None:
+            self.size = size
+            self.pieces = [None] * ((size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE)
+        return size == self.size
+
+    def next_piece(self, peer: MetadataPeer) -> Optional[int]:
+        """
+        Returns: the missing piece with the fewest requests in flight, None
+        once all of them are in
+        """
+        missing = [i for i, piece in enumerate(self.pieces) if piece is None]
+        if not missing:
+            return None
+        piece = min(missing, key=lambda i: self.requested.get(i, 0))
+        self.requested[piece] = self.requested.get(piece, 0) + 1
+        return piece
+
+    def request_done(self, piece: int):
+        self.requested[piece] -= 1
+
+    def piece_received(self, piece: int, data: bytes):
+        expected = min(METADATA_PIECE_SIZE, self.size - piece * METADATA_PIECE_SIZE)
+        if len(data) != expected:
+            raise MetadataError(f'Metadata piece {piece} has {len(data)} bytes instead of {expected}')
+        if self.pieces[piece] is not None:
+            return
+        self.pieces[piece] = data
+        if any(piece is None for piece in self.pieces):
+            return
+        metadata = b''.join(self.pieces)
+        if hashlib.sha1(metadata).digest() == self.torrent.info_hash:
+            self.done.set_result(metadata)
+        else:
+            log.warning(f'Metadata of {self.torrent.info_hash.hex()} failed its hash check, fetching it again.')
+            self.pieces = [None] * len(self.pieces)
+
+    async def fetch(self, sources: Iterable[Awaitable[List[Peer]]] = ()) -> bytes:
+        """
+        Downloads the metadata from the peers given so far, and the ones
+        `sources` return, e.g. tracker announces or DHT lookups.
+
+        Returns: the verified info dictionary
+        """
+        searches = {asyncio.ensure_future(source) for source in sources}
+        for search in searches:
+            search.add_done_callback(self._search_done)
+        try:
+            while not self.is_complete:
+                if not self._tasks and not self._candidates and not searches:
+                    raise MetadataError(f'No peer sent the metadata of {self.torrent.info_hash.hex()}')
+                self._changed.clear()
+                changed = asyncio.ensure_future(self._changed.wait())
+                await asyncio.wait({changed, self.done, *self._tasks, *searches}, return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+                searches = {search for search in searches if not search.done()}
+            log.info(f'Fetched {self.size} bytes of metadata for {self.torrent.info_hash.hex()}')
+            return self.done.result()
+        finally:
+            for task in self._tasks | searches:
+                task.cancel()
+
+    def _search_done(self, search: asyncio.Future):
+        if search.cancelled():
+            return
+        if search.exception() is not None:
+            log.warning(f'Peer search for the metadata failed: {search.exception()!r}')
+            return
+        self.add_peers(search.result())
@@ -0,0 +1,158 @@
+import asyncio
+import ipaddress
+import socket
+import struct
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple
+
+import bencodepy
+
+from const import PEX_INTERVAL, PEX_MAX_PEERS, PEX_SEED_FLAG, PEX_REACHABLE_FLAG
+from log import get_logger
+from models.peer import Peer, from_bytes
+from torrent.connections import PeerSource
+
+if TYPE_CHECKING:
+    from torrent.client import Client, PeerClient
+
+log = get_logger(__name__)
+
+Addr = Tuple[str, int]
+
+
+def pack_peer(ip: str, port: int) -> Optional[bytes]:
+    """
+    Returns: the compact form of an address, 6 bytes for IPv4 and 18 for
+    IPv6, or None if `ip` is not an IP address
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    # Peers accepted on a dual-stack socket show up as IPv4-mapped addresses
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return address.packed + struct.pack('!H', port)
+
+
+def pack_peers(addrs: List[Addr]) -> bytes:
+    return b''.join(pack_peer(ip, port) for ip, port in addrs)
+
+
+def unpack_peers6(data: bytes) -> List[Peer]:
+    """
+    Returns: the peers of a compact IPv6 list, 18 bytes each
+    """
+    return [Peer(socket.inet_ntop(socket.AF_INET6, data[i:i + 16]), struct.unpack_from('!H', data, i + 16)[0],
+                 data[i:i + 18]) for i in range(0, len(data) - len(data) % 18, 18)]
+
+
+class PeerExchange:
+    """
+    Peer Exchange (BEP 11) with the connected peers which support ut_pex.
+
+    Every `PEX_INTERVAL` seconds each of them is told which peers we got
+    connected to or lost since its previous message, at most
+    `PEX_MAX_PEERS` of each. The first message goes out as soon as a peer
+    says it supports the extension, so a peer joining the swarm learns about
+    it within seconds. The peers we receive become connection candidates;
+    a peer sending messages more often than `PEX_INTERVAL` is ignored.
+    IPv6 peers travel in the added6 and dropped6 lists.
+    """
+
+    def __init__(self, client: 'Client'):
+        self.client = client
+        # Addresses last advertised to each peer
+        self._sent: Dict['PeerClient', Set[Addr]] = {}
+        self._received_at: Dict['PeerClient', float] = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PEX_INTERVAL)
+            for peer_client in list(self._sent):
+                self.send(peer_client)
+
+    def _connected(self) -> Dict[Addr, int]:
+        """
+        Returns: the listening address of the connected peers and their flags
+        """
+        connected = {}
+        for peer_client in self.client.peer_connections.values():
+            if peer_client.is_closed or peer_client.transport is None or not peer_client.listen_port:
+                continue
+            flags = PEX_REACHABLE_FLAG if peer_client.is_outgoing else 0
+            if peer_client.bitfield.all():
+                flags |= PEX_SEED_FLAG
+            connected[(peer_client.peer.ip, peer_client.listen_port)] = flags
+        return connected
+
+    def send(self, peer_client: 'PeerClient'):
+        if peer_client.is_closed or b'ut_pex' not in peer_client.extensions:
+            self.closed(peer_client)
+            return
+        connected = self._connected()
+        connected.pop((peer_client.peer.ip, peer_client.listen_port), None)
+        is_first = peer_client not in self._sent
+        sent = self._sent.get(peer_client, set())
+        added = [addr for addr in connected if addr not in sent][:PEX_MAX_PEERS]
+        dropped = [addr for addr in sent if addr not in connected][:PEX_MAX_PEERS]
+        self._sent[peer_client] = (sent | set(added)) - set(dropped)
+        if not added and not dropped and not is_first:
+            return
+        # IPv6 peers go in the lists of their own, with the 6 suffix
+        message = {key: bytearray() for key in (b'added', b'added.f', b'dropped', b'added6', b'added6.f', b'dropped6')}
+        for name, addrs in ((b'added', added), (b'dropped', dropped)):
+            for addr in addrs:
+                packed = pack_peer(*addr)
+                if packed is None:
+                    continue
+                key = name if len(packed) == 6 else name + b'6'
+                message[key] += packed
+                if name == b'added':
+                    message[key + b'.f'].append(connected[addr])
+        peer_client.send_extended(b'ut_pex', bencodepy.encode({key: bytes(value) for key, value in message.items()}))
+        log.debug(f'Sent {len(added)} added and {len(dropped)} dropped peers to peer={peer_client.peer.peer_id}')
+
+    def received(self, peer_client: 'PeerClient', message: Dict[bytes, Any]):
+        now = time.monotonic()
+        last = self._received_at.get(peer_client)
+        # Half the interval of slack, the first message may come early
+        if last is not None and now - last < PEX_INTERVAL / 2:
+            log.debug(f'Ignoring PEX flood from peer={peer_client.peer.peer_id}')
+            return
+        self._received_at[peer_client] = now
+        own = (peer_client.transport.get_extra_info('sockname')[0], self.client.torrent.port)
+        known = set(self._connected())
+        is_seeding = self.client.scheduler.is_complete
+        new = []
+        for key, size, unpack in ((b'added', 6, from_bytes), (b'added6', 18, unpack_peers6)):
+            added = message.get(key, b'')
+            flags = message.get(key + b'.f', b'')
+            if not isinstance(added, bytes) or not isinstance(flags, bytes):
+                continue
+            # Compact peers, ignoring a truncated last one
+            peers = unpack(added[:min(len(added) - len(added) % size, size * PEX_MAX_PEERS)])
+            for i, peer in enumerate(peers):
+                addr = peer.ip, peer.port
+                if addr == own or addr in known or not peer.port:
+                    continue
+                if is_seeding and i < len(flags) and flags[i] & PEX_SEED_FLAG:
+                    continue
+                new.append(peer)
+        if new:
+            log.info(f'PEX from peer={peer_client.peer.peer_id} brought {len(new)} peers.')
+            self.client.add_peers(new, PeerSource.pex)
+
+    def closed(self, peer_client: 'PeerClient'):
+        self._sent.pop(peer_client, None)
+        self._received_at.pop(peer_client, None)
@@ -0,0 +1,92 @@
+import math
+import time
+from typing import Dict, List, Optional, Tuple
+
+from const import BLOCK_SIZE, REQUEST_QUEUE_INITIAL, REQUEST_QUEUE_MIN, REQUEST_QUEUE_MAX
+
+# Smoothing factor for the round trip and rate averages
+EWMA_ALPHA = 0.2
+# Rate samples are taken over windows of this many seconds
+RATE_WINDOW = 1.0
+# Keep twice the bandwidth-delay product in flight, so that the queue is never
+# the bottleneck of the measured rate.
+QUEUE_GAIN = 2
+
+
+class RequestPipeline:
+    """
+    Tracks the outstanding block requests to a single peer.
+
+    The number of requests kept in flight follows the bandwidth-delay product
+    of the connection: the measured download rate times the smallest round
+    trip seen so far. The smallest round trip is used instead of the average
+    because the average grows with our own queue once the link is saturated.
+    """
+
+    def __init__(self, depth: int = REQUEST_QUEUE_INITIAL,
+                 min_depth: int = REQUEST_QUEUE_MIN, max_depth: int = REQUEST_QUEUE_MAX):
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth = max(min_depth, min(depth, max_depth))
+        # (piece index, block offset) -> time the request was sent
+        self.outstanding: Dict[Tuple[int, int], float] = {}
+
+        self.rtt: Optional[float] = None
+        self.min_rtt: Optional[float] = None
+        self.rate = 0.0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    @property
+    def free(self) -> int:
+        return self.depth - len(self.outstanding)
+
+    def sent(self, piece_index: int, offset: int):
+        self.outstanding[(piece_index, offset)] = time.monotonic()
+
+    def received(self, piece_index: int, offset: int, length: int) -> bool:
+        """
+        Records the arrival of a block.
+
+        Returns: whether the block was requested through this pipeline
+        """
+        sent_at = self.outstanding.pop((piece_index, offset), None)
+        if sent_at is None:
+            return False
+        now = time.monotonic()
+        sample = now - sent_at
+        self.rtt = sample if self.rtt is None else (1 - EWMA_ALPHA) * self.rtt + EWMA_ALPHA * sample
+        self.min_rtt = sample if self.min_rtt is None else min(self.min_rtt, sample)
+
+        self._window_bytes += length
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW:
+            sample_rate = self._window_bytes / elapsed
+            self.rate = sample_rate if not self.rate else (1 - EWMA_ALPHA) * self.rate + EWMA_ALPHA * sample_rate
+            self._window_start = now
+            self._window_bytes = 0
+            self._adjust()
+        return True
+
+    def cancel(self, piece_index: int, offset: int) -> bool:
+        """
+        Forgets a request without taking a sample from it.
+
+        Returns: whether the request was outstanding
+        """
+        return self.outstanding.pop((piece_index, offset), None) is not None
+
+    def _adjust(self):
+        bdp = self.rate * self.min_rtt
+        depth = math.ceil(QUEUE_GAIN * bdp / BLOCK_SIZE)
+        self.depth = max(self.min_depth, min(depth, self.max_depth))
+
+    def clear(self) -> List[Tuple[int, int]]:
+        """
+        Forgets every outstanding request.
+
+        Returns: the (piece index, block offset) pairs which were in flight
+        """
+        requests = list(self.outstanding)
+        self.outstanding.clear()
+        return requests
@@ -0,0 +1,138 @@
+import asyncio
+import struct
+from typing import Optional, Protocol
+
+from const import HANDSHAKE_LEN, MAX_MESSAGE_LENGTH, RECEIVE_BUFFER_SIZE
+from log import get_logger
+
+log = get_logger(__name__)
+
+LENGTH_PREFIX = struct.Struct('!I')
+
+
+class MessageHandler(Protocol):
+    def handshake_received(self, handshake: bytes):
+        ...
+
+    def message_received(self, message_id: int, payload: memoryview):
+        ...
+
+    def keep_alive_received(self):
+        ...
+
+    def connection_lost(self, exc: Optional[Exception]):
+        ...
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Frames the peer wire protocol straight out of a reusable receive buffer.
+
+    The transport reads into the buffer, every complete message is handed to
+    the handler as a memoryview of it, and the unparsed tail is moved to the
+    front only when the buffer runs out of space. Payloads are only valid
+    during the `message_received` call; handlers must copy what they keep.
+    The connection is closed on a length prefix above `max_length`, before
+    the buffer grows for it.
+    """
+
+    def __init__(self, handler: MessageHandler, buffer_size: int = RECEIVE_BUFFER_SIZE,
+                 max_length: int = MAX_MESSAGE_LENGTH):
+        self.handler = handler
+        self.max_length = max_length
+        self.transport: Optional[asyncio.Transport] = None
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        # Data between start and end is received but not parsed yet
+        self._start = 0
+        self._end = 0
+        # Bytes needed before the next message can be parsed
+        self._needed = HANDSHAKE_LEN
+        self._is_handshake_received = False
+
+        self._paused = False
+        self._drain_waiter: Optional[asyncio.Future] = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._start + self._needed > len(self._buffer) or self._end == len(self._buffer):
+            self._compact()
+        return self._view[self._end:]
+
+    def _compact(self):
+        pending = self._end - self._start
+        if self._needed > len(self._buffer):
+            # A message larger than the buffer, e.g. a big bitfield
+            buffer = bytearray(self._needed)
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer, self._view = buffer, memoryview(buffer)
+        else:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        view, start, end = self._view, self._start, self._end
+        if not self._is_handshake_received:
+            if end - start < HANDSHAKE_LEN:
+                return
+            self._is_handshake_received = True
+            self.handler.handshake_received(bytes(view[start:start + HANDSHAKE_LEN]))
+            start += HANDSHAKE_LEN
+            if self.transport is None or self.transport.is_closing():
+                return
+
+        while end - start >= 4:
+            (length,) = LENGTH_PREFIX.unpack_from(view, start)
+            if length > self.max_length:
+                log.warning(f'Closing connection sending a message of {length} bytes')
+                self._start = self._end = 0
+                self._needed = 4
+                self.transport.close()
+                return
+            if end - start - 4 < length:
+                break
+            if length == 0:
+                self.handler.keep_alive_received()
+            else:
+                self.handler.message_received(view[start + 4], view[start + 5:start + 4 + length])
+            start += 4 + length
+            if self.transport is None or self.transport.is_closing():
+                return
+
+        if start == end:
+            self._start = self._end = 0
+            self._needed = 4
+        else:
+            self._start = start
+            self._needed = 4 + (LENGTH_PREFIX.unpack_from(view, start)[0] if end - start >= 4 else 0)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.transport = None
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_exception(ConnectionError('Connection lost'))
+        self.handler.connection_lost(exc)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    async def drain(self):
+        """
+        Waits until the transport's write buffer is below its high-water mark.
+        """
+        if self.transport is None:
+            raise ConnectionError('Connection lost')
+        if not self._paused:
+            return
+        self._drain_waiter = asyncio.get_running_loop().create_future()
+        await self._drain_waiter
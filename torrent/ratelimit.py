@@ -0,0 +1,71 @@
+import asyncio
+import time
+from typing import Optional
+
+# Longest wait before a throttled transfer looks at its buckets again, so
+# that raising a limit takes effect quickly
+MAX_DELAY = 1.0
+
+
+class TokenBucket:
+    """
+    Limits a transfer rate, in bytes per second.
+
+    The bucket holds at most one second worth of tokens, which bounds the
+    bursts. A transfer may overdraw it: the next ones wait until the debt is
+    paid back. A rate of 0 means unlimited, which costs a single test.
+
+    Buckets form a chain, e.g. peer -> torrent -> session: a transfer goes
+    through only when every bucket up the chain allows it.
+    """
+
+    def __init__(self, rate: int = 0, parent: Optional['TokenBucket'] = None):
+        self.rate = rate
+        self.parent = parent
+        self.tokens = float(rate)
+        self._last = time.monotonic()
+
+    def set_rate(self, rate: int):
+        """
+        Changes the limit at runtime; 0 lifts it.
+        """
+        self._refill()
+        # Coming from unlimited, start with a full bucket
+        self.tokens = min(self.tokens, float(rate)) if self.rate else float(rate)
+        self.rate = rate
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.rate, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_consume(self, n: int) -> bool:
+        """
+        Returns: whether `n` bytes may be transferred right now
+        """
+        if self.rate:
+            self._refill()
+            if self.tokens <= 0:
+                return False
+        if self.parent is not None and not self.parent.try_consume(n):
+            return False
+        if self.rate:
+            self.tokens -= n
+        return True
+
+    def delay(self) -> float:
+        """
+        Returns: seconds until the chain allows a transfer again
+        """
+        delay = 0.0
+        if self.rate:
+            self._refill()
+            delay = max(0.0, -self.tokens / self.rate) + 0.001
+        if self.parent is not None:
+            delay = max(delay, self.parent.delay())
+        return min(delay, MAX_DELAY)
+
+    async def consume(self, n: int):
+        while not self.try_consume(n):
+            await asyncio.sleep(self.delay())
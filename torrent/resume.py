@@ -0,0 +1,79 @@
+import os
+from typing import List, Optional, Tuple
+
+import bencodepy
+from bitarray import bitarray
+
+from log import get_logger
+from torrent.storage import Storage
+
+log = get_logger(__name__)
+
+
+class ResumeData:
+    """
+    Completion state of a torrent, saved next to its data so that a restart
+    does not have to hash or download everything again.
+
+    Besides the bitfield of verified pieces it records the size and mtime of
+    every file, to tell which files were touched while we were not running.
+    """
+
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self.path = os.path.join(storage.path, f'.{storage.torrent.info_hash.hex()}.resume')
+
+    def _file_stats(self) -> List[Tuple[int, int]]:
+        stats = []
+        for path in self.storage.paths:
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_size, stat.st_mtime_ns))
+            except FileNotFoundError:
+                stats.append((-1, 0))
+        return stats
+
+    def save(self, have: bitarray):
+        """
+        Writes the resume file atomically: a crash leaves either the old or
+        the new one, never a torn file.
+        """
+        data = bencodepy.encode({
+            b'info-hash': self.storage.torrent.info_hash,
+            b'pieces': have.tobytes(),
+            b'files': [list(stat) for stat in self._file_stats()],
+        })
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        log.debug(f'Saved resume data for {have.count()} pieces.')
+
+    def load(self, piece_count: int) -> Optional[Tuple[bitarray, List[int]]]:
+        """
+        Reads the resume file.
+
+        Returns: the bitfield of pieces which were verified and the indices of
+        the files changed since, or None if there is no usable resume file
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = bencodepy.decode(f.read())
+            if data[b'info-hash'] != self.storage.torrent.info_hash:
+                log.warning(f'Resume file {self.path} belongs to another torrent, ignoring it.')
+                return None
+            have = bitarray(endian='big')
+            have.frombytes(data[b'pieces'])
+            saved = [tuple(stat) for stat in data[b'files']]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f'Invalid resume file {self.path}: {e}')
+            return None
+        if len(have) < piece_count or len(saved) != len(self.storage.paths):
+            log.warning(f'Resume file {self.path} does not match the torrent, ignoring it.')
+            return None
+        changed = [i for i, (old, new) in enumerate(zip(saved, self._file_stats())) if old != new]
+        return have[:piece_count], changed
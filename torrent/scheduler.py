@@ -0,0 +1,238 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+from bitarray import bitarray
+
+from const import STREAM_URGENT_TIME
+from log import get_logger
+from models.piece import DownloadInfo
+from torrent.availability import AvailabilityIndex, PickPolicy
+from torrent.files import FilePriority
+
+log = get_logger(__name__)
+
+
+class PieceScheduler:
+    """
+    Shared work queue of pieces for all the peer workers.
+
+    Every piece is either pending, assigned to exactly one peer or downloaded.
+    A worker takes the next pending piece its peer has, in the order given by
+    the pick policy, and hands it back with `release` if the peer dies or
+    turns out to be too slow.
+
+    Once no piece is pending any more the download is in endgame: workers
+    stop waiting for pieces and request the missing blocks of the assigned
+    ones from every peer which has them.
+
+    Pieces given a deadline, e.g. the ones right after the playhead of a
+    stream, are taken before any other, earliest deadline first. Once a
+    deadline is less than STREAM_URGENT_TIME away, the missing blocks of
+    its piece are requested from the other peers too, as in endgame,
+    instead of waiting for a slow peer to time out.
+
+    Pieces of skipped files are never taken, and the download is complete
+    once the wanted pieces are in; pieces of high priority files are taken
+    before the normal ones.
+    """
+
+    def __init__(self, info: DownloadInfo, availability: AvailabilityIndex,
+                 policy: PickPolicy = PickPolicy.rarest_first):
+        self.info = info
+        self.availability = availability
+        self.policy = policy
+        # Pieces downloaded and verified
+        self.have = info.completed
+        # Pieces to download, and the ones to download first
+        self.wanted = bitarray(len(self.have))
+        self.wanted.setall(1)
+        self.preferred = bitarray(len(self.have))
+        self.preferred.setall(0)
+        self._has_preferred = False
+        # Wanted pieces which are not downloaded yet, either pending or assigned
+        self.remaining = ~self.have
+        self.left = self.remaining.count()
+        self.assigned = set()
+        # Peer connections which sent blocks of each piece in flight, so they
+        # can be blamed if the piece fails its hash check.
+        self.contributors: Dict[int, Set[Any]] = defaultdict(set)
+        for index in self.have.search(1):
+            availability.withdraw(index)
+        self.downloaded = self.have.count()
+        # Monotonic time by which each piece should be downloaded
+        self.deadlines: Dict[int, float] = {}
+        # Workers waiting for a piece to become available
+        self._waiters: Set[asyncio.Future] = set()
+
+    @property
+    def is_complete(self) -> bool:
+        return self.left == 0
+
+    @property
+    def bytes_left(self) -> int:
+        """
+        Returns: the size of the wanted pieces not downloaded yet
+        """
+        last = len(self.remaining) - 1
+        left = self.left * self.info.piece_length
+        if self.remaining[last]:
+            left -= self.info.piece_length - self.info.piece_size(last)
+        return left
+
+    @property
+    def is_endgame(self) -> bool:
+        return not self.is_complete and len(self.assigned) >= self.left
+
+    def take(self, have: bitarray) -> Optional[int]:
+        """
+        Assigns the next pending piece out of the ones in `have` without
+        waiting.
+
+        Returns: the piece index or None if no such piece is pending right now
+        """
+        index = self._pick_deadline(have) if self.deadlines else None
+        if index is None and self._has_preferred:
+            index = self.availability.pick(have & self.preferred, self.policy)
+        if index is None:
+            index = self.availability.pick(have, self.policy)
+        if index is not None:
+            self.availability.withdraw(index)
+            self.assigned.add(index)
+            if self.is_endgame:
+                log.info(f'Entering endgame with {len(self.assigned)} pieces in flight.')
+                self.notify()
+        return index
+
+    def _pick_deadline(self, have: bitarray) -> Optional[int]:
+        wanted = self.availability.wanted
+        for index in sorted(self.deadlines, key=self.deadlines.get):
+            if wanted[index] and have[index]:
+                return index
+        return None
+
+    def set_priorities(self, priorities: Sequence[FilePriority]):
+        """
+        Sets the priority of every piece, see `FileIndex.piece_priorities`.
+        Pieces in flight are finished even if they are skipped now.
+        """
+        for index, priority in enumerate(priorities):
+            is_wanted = priority != FilePriority.skip
+            self.wanted[index] = is_wanted
+            self.preferred[index] = priority == FilePriority.high
+            if self.have[index] or index in self.assigned:
+                continue
+            self.remaining[index] = is_wanted
+            if is_wanted:
+                self.availability.restore(index)
+            else:
+                self.availability.withdraw(index)
+        self._has_preferred = self.preferred.any()
+        self.left = self.remaining.count()
+        log.info(f'{self.wanted.count()}/{self.info.piece_count} pieces wanted, {self.left} left.')
+        self.notify()
+
+    def set_deadline(self, index: int, deadline: float):
+        if not self.have[index]:
+            self.deadlines[index] = deadline
+
+    def clear_deadlines(self):
+        self.deadlines.clear()
+
+    def urgent(self, have: bitarray) -> List[int]:
+        """
+        Returns: the pieces in flight out of `have` whose deadline is less
+        than STREAM_URGENT_TIME away, or already passed
+        """
+        if not self.deadlines:
+            return []
+        limit = time.monotonic() + STREAM_URGENT_TIME
+        return [index for index, deadline in self.deadlines.items()
+                if deadline < limit and index in self.assigned and have[index] and not self.info.is_received(index)]
+
+    async def next_piece(self, have: bitarray) -> Optional[int]:
+        """
+        Waits for a piece out of the ones in `have` and assigns it.
+
+        Returns: the piece index or None if there is nothing left for this
+        peer, the download went into endgame or pieces this peer has are
+        close to their deadline
+        """
+        while not self.is_complete and not self.is_endgame:
+            index = self.take(have)
+            if index is not None:
+                return index
+            if self.urgent(have):
+                break
+            # Pieces in flight on other peers may still come back.
+            if not (self.remaining & have).any():
+                break
+            # Deadlines draw near without any notification
+            await self.wait(STREAM_URGENT_TIME / 2 if self.deadlines else None)
+        return None
+
+    async def wait(self, timeout: Optional[float] = None):
+        """
+        Waits until pieces are completed, released or announced by a peer,
+        or `timeout` seconds went by.
+        """
+        try:
+            await asyncio.wait_for(self.waiter(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def waiter(self) -> asyncio.Future:
+        """
+        Returns: a future resolved by the next `notify`, registered right
+        away so that no notification is missed; cancel it when done with it
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.add(waiter)
+        waiter.add_done_callback(self._waiters.discard)
+        return waiter
+
+    def add_contributor(self, index: int, peer_client: Any):
+        self.contributors[index].add(peer_client)
+
+    def complete(self, index: int):
+        if self.have[index]:
+            return
+        self.contributors.pop(index, None)
+        self.deadlines.pop(index, None)
+        self.assigned.discard(index)
+        self.availability.withdraw(index)
+        if self.remaining[index]:
+            self.remaining[index] = 0
+            self.left -= 1
+        self.have[index] = 1
+        self.downloaded += 1
+        log.debug(f'Downloaded piece={index} ({self.downloaded}/{self.info.piece_count})')
+        self.notify()
+
+    def release(self, index: int):
+        """
+        Puts a piece back in the queue so another peer can pick it up.
+        """
+        self.assigned.discard(index)
+        self.contributors.pop(index, None)
+        if self.have[index]:
+            return
+        log.info(f'Piece={index} returned to the queue')
+        self.info.reset(index)
+        if self.wanted[index]:
+            self.availability.restore(index)
+        elif self.remaining[index]:
+            # Skipped while it was in flight
+            self.remaining[index] = 0
+            self.left -= 1
+        self.notify()
+
+    def notify(self):
+        """
+        Wakes up the workers waiting for pieces, e.g. after a peer announced
+        new ones.
+        """
+        for waiter in list(self._waiters):
+            if not waiter.done():
+                waiter.set_result(None)
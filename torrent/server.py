@@ -0,0 +1,77 @@
+import asyncio
+from typing import Dict, Optional, TYPE_CHECKING
+
+from const import LISTEN_PORT
+from log import get_logger
+from models.peer import Peer
+from torrent.protocol import PeerProtocol
+
+if TYPE_CHECKING:
+    from torrent.client import Client
+
+log = get_logger(__name__)
+
+
+class PeerServer:
+    """
+    Accepts incoming peer connections and hands each one to the client of
+    the torrent its handshake asks for.
+    """
+
+    def __init__(self, port: int = LISTEN_PORT, host: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.clients: Dict[bytes, 'Client'] = {}
+        self.server = None
+
+    def register(self, client: 'Client'):
+        self.clients[client.torrent.info_hash] = client
+
+    def unregister(self, client: 'Client'):
+        self.clients.pop(client.torrent.info_hash, None)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(self._protocol_factory, self.host, self.port)
+        # The actual port when listening on port 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info(f'Listening for peers on port={self.port}')
+
+    def _protocol_factory(self) -> PeerProtocol:
+        connection = IncomingConnection(self)
+        connection.protocol = PeerProtocol(connection)
+        return connection.protocol
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+class IncomingConnection:
+    """
+    Handler of an accepted connection until its handshake is received.
+    """
+
+    def __init__(self, server: PeerServer):
+        self.server = server
+        self.protocol: Optional[PeerProtocol] = None
+
+    def handshake_received(self, handshake: bytes):
+        transport = self.protocol.transport
+        client = self.server.clients.get(handshake[28:48])
+        if client is None:
+            log.warning('Incoming connection for an unknown torrent, closing it.')
+            transport.close()
+            return
+        ip, port = transport.get_extra_info('peername')[:2]
+        client.accept(Peer(ip, port, handshake[48:68]), self.protocol, handshake)
+
+    def message_received(self, message_id: int, payload: memoryview):
+        pass
+
+    def keep_alive_received(self):
+        pass
+
+    def connection_lost(self, exc: Optional[Exception]):
+        pass
@@ -0,0 +1,204 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from const import AnnounceEvent, DOWNLOAD_PATH, LISTEN_PORT, MAX_CONNECTIONS, MAX_OPEN_FILES, PIECE_BUFFER_MEMORY, \
+    STREAM_PORT
+from dht.node import DHTNode
+from log import get_logger
+from models.magnet import parse_magnet
+from models.peer import Peer
+from models.torrent import Torrent
+from torrent.availability import PickPolicy
+from torrent.buffer import BufferPool
+from torrent.client import Client
+from torrent.files import FilePriority
+from torrent.hasher import PieceHasher
+from torrent.metadata import MetadataFetcher
+from torrent.ratelimit import TokenBucket
+from torrent.server import PeerServer
+from torrent.storage import FilePool
+from torrent.stream import StreamServer
+from torrent import tracker
+from torrent.tracker import TrackerClient
+
+log = get_logger(__name__)
+
+
+class Session:
+    """
+    Runs any number of torrents on one event loop.
+
+    The torrents share a single listening port, which routes incoming
+    handshakes by info hash, the disk thread and its file descriptors, the
+    hashing threads, the memory for piece buffers and the tracker sockets.
+    Peer connections and transfer rates are limited across all of them.
+
+    With `dht`, a DHT node on the same port as the peers finds peers for the
+    torrents as well as their trackers, or instead of them.
+    """
+
+    def __init__(self, path: str = DOWNLOAD_PATH, port: int = LISTEN_PORT, host: Optional[str] = None,
+                 max_connections: int = MAX_CONNECTIONS, download_rate: int = 0, upload_rate: int = 0,
+                 buffer_memory: int = PIECE_BUFFER_MEMORY, dht: bool = False):
+        self.path = path
+        self.clients: Dict[bytes, Client] = {}
+        self.server = PeerServer(port, host)
+        self.file_pool = FilePool(MAX_OPEN_FILES)
+        self.disk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+        self.hasher = PieceHasher()
+        self.buffers = BufferPool(buffer_memory)
+        self.download_limiter = TokenBucket(download_rate)
+        self.upload_limiter = TokenBucket(upload_rate)
+        self.max_connections = max_connections
+        self.connections = 0
+        self._tasks: Dict[bytes, asyncio.Task] = {}
+        self.dht = DHTNode(host=host or '0.0.0.0', state_path=os.path.join(path, '.dht.state')) if dht else None
+        self._dht_bootstrap = None
+        self.stream_server: Optional[StreamServer] = None
+
+    @property
+    def port(self) -> int:
+        return self.server.port
+
+    async def start(self):
+        await self.server.start()
+        if self.dht is not None:
+            self.dht.port = self.server.port
+            await self.dht.start()
+            self._dht_bootstrap = asyncio.create_task(self.dht.bootstrap())
+
+    async def serve_streams(self, host: str = '127.0.0.1', port: int = STREAM_PORT) -> StreamServer:
+        """
+        Starts the local HTTP server which streams the files of the torrents
+        while they download.
+
+        Returns: the server, with the port it listens on
+        """
+        if self.stream_server is None:
+            self.stream_server = StreamServer(self.clients, host, port)
+            await self.stream_server.start()
+        return self.stream_server
+
+    def set_rate_limits(self, download_rate: Optional[int] = None, upload_rate: Optional[int] = None):
+        """
+        Changes the global rate limits, in bytes per second; 0 lifts a limit
+        and None leaves it as is.
+        """
+        if download_rate is not None:
+            self.download_limiter.set_rate(download_rate)
+        if upload_rate is not None:
+            self.upload_limiter.set_rate(upload_rate)
+
+    def acquire_connection(self) -> bool:
+        """
+        Takes one of the session's connection slots.
+
+        Returns: whether a slot was free
+        """
+        if self.connections >= self.max_connections:
+            return False
+        self.connections += 1
+        return True
+
+    def release_connection(self):
+        self.connections -= 1
+
+    async def add(self, torrent: Torrent, peers: Optional[List[Peer]] = None,
+                  policy: PickPolicy = PickPolicy.rarest_first, announce: bool = True,
+                  file_priorities: Optional[List[FilePriority]] = None) -> Client:
+        """
+        Adds a torrent, restores what is already on disk and starts
+        downloading or seeding it in the background. Only the files not
+        skipped by `file_priorities` are downloaded.
+
+        Returns: the client of the torrent
+        """
+        if torrent.info_hash in self.clients:
+            return self.clients[torrent.info_hash]
+        client = Client(peers or [], torrent, policy, session=self, file_priorities=file_priorities)
+        self.clients[torrent.info_hash] = client
+        # Freshly allocated files are all holes, there is nothing to hash
+        if not await client.resume() and client.storage.had_data:
+            await client.check()
+        await client.listen(self.server)
+        self._tasks[torrent.info_hash] = asyncio.create_task(self._run(client, announce))
+        return client
+
+    async def add_magnet(self, uri: str, peers: Optional[List[Peer]] = None,
+                         policy: PickPolicy = PickPolicy.rarest_first, announce: bool = True) -> Client:
+        """
+        Adds a torrent from a magnet link. Its info dictionary is fetched
+        from the peers of the link and `peers`, and if `announce` from the
+        peers the trackers of the link and the DHT know of.
+
+        Returns: the client of the torrent, once the metadata is in
+        """
+        magnet = parse_magnet(uri)
+        if magnet.info_hash in self.clients:
+            return self.clients[magnet.info_hash]
+        torrent = Torrent.from_magnet(magnet)
+        torrent.port = self.port
+        fetcher = MetadataFetcher(torrent, (peers or []) + magnet.peers)
+        sources = []
+        if announce:
+            sources.append(self._tracker_peers(torrent))
+            if self.dht is not None:
+                sources.append(self._dht_peers(torrent))
+        torrent.set_metadata(await fetcher.fetch(sources))
+        return await self.add(torrent, fetcher.peers, policy, announce)
+
+    @staticmethod
+    async def _tracker_peers(torrent: Torrent) -> List[Peer]:
+        response = await TrackerClient(torrent).announce(AnnounceEvent.none)
+        return response.peers
+
+    async def _dht_peers(self, torrent: Torrent) -> List[Peer]:
+        await self.dht.ready.wait()
+        return await self.dht.get_peers(torrent.info_hash)
+
+    async def _run(self, client: Client, announce: bool):
+        try:
+            if announce:
+                await client.announce()
+            await client.connect()
+            if not client.scheduler.is_complete:
+                await client.download()
+        except Exception as e:
+            log.error(f'Torrent {client.torrent.info_hash.hex()} failed: {e!r}')
+
+    async def wait(self, info_hash: bytes):
+        """
+        Waits until the download of a torrent is over, and it is only seeded.
+        """
+        task = self._tasks.get(info_hash)
+        if task is not None:
+            await asyncio.shield(task)
+
+    def remove(self, info_hash: bytes):
+        client = self.clients.pop(info_hash, None)
+        if client is None:
+            return
+        task = self._tasks.pop(info_hash, None)
+        if task is not None:
+            task.cancel()
+        client.close()
+
+    async def close(self):
+        if self.stream_server is not None:
+            await self.stream_server.close()
+        clients = list(self.clients.values())
+        for info_hash in list(self.clients):
+            self.remove(info_hash)
+        # The stopped announces go out before the shared sockets close
+        await asyncio.gather(*(client.tracker.wait_closed() for client in clients if client.tracker is not None))
+        self.server.close()
+        if self.dht is not None:
+            if self._dht_bootstrap is not None:
+                self._dht_bootstrap.cancel()
+            self.dht.close()
+        self.hasher.close()
+        await tracker.close_shared_sockets()
+        self.disk_executor.submit(self.file_pool.close)
+        self.disk_executor.shutdown(wait=True)
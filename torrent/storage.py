@@ -0,0 +1,266 @@
+import asyncio
+import os
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+from typing import Dict, List, Optional, Set, Tuple
+
+from const import MAX_OPEN_FILES, READ_CACHE_SIZE
+from log import get_logger
+from models.torrent import Torrent
+
+log = get_logger(__name__)
+
+
+class FilePool:
+    """
+    Least recently used set of open file descriptors.
+
+    Only ever touched from the storage's disk thread, so it needs no locking.
+    """
+
+    def __init__(self, max_open: int = MAX_OPEN_FILES):
+        self.max_open = max_open
+        self._fds: OrderedDict[str, int] = OrderedDict()
+
+    def get(self, path: str) -> int:
+        fd = self._fds.get(path)
+        if fd is not None:
+            self._fds.move_to_end(path)
+            return fd
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._fds[path] = fd
+        if len(self._fds) > self.max_open:
+            _, oldest = self._fds.popitem(last=False)
+            os.close(oldest)
+        return fd
+
+    def discard(self, paths: List[str]):
+        for path in paths:
+            fd = self._fds.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+
+    def close(self):
+        while self._fds:
+            _, fd = self._fds.popitem()
+            os.close(fd)
+
+
+class Storage:
+    """
+    Maps the torrent's global byte offsets to its files on disk.
+
+    File boundaries are kept as a prefix sum so that an offset is resolved
+    with a binary search, and blocks spanning several files are split. The
+    actual reads and writes run on a single disk thread, against descriptors
+    kept open in a `FilePool`. Several storages may share the pool and the
+    disk thread.
+
+    Skipped files are not created. The parts of the pieces at their
+    boundaries with wanted files go to a partfile instead, which has a slot
+    of one piece for every piece spanning several files.
+    """
+
+    def __init__(self, torrent: Torrent, path: str, pool: Optional[FilePool] = None,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        self.torrent = torrent
+        self.path = path
+        self.paths = [os.path.join(path, file.path) for file in torrent.files]
+        self.lengths = [file.length for file in torrent.files]
+        # offsets[i] is the global offset at which file i starts
+        self.offsets = [0] + list(accumulate(self.lengths))[:-1]
+        # Files not to create, see `set_skipped`
+        self.skipped: Set[int] = set()
+        self._slots: Optional[Dict[int, int]] = None
+        # Whether any data was on disk before `allocate`
+        self.had_data = False
+        self._part_path: Optional[str] = None
+        self._is_shared = executor is not None
+        self.pool = pool or FilePool()
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk')
+
+    def allocate(self):
+        """
+        Creates the files with their final size; the space is left sparse.
+        """
+        self.had_data = any(os.path.exists(path) and os.path.getsize(path) for path in self.paths) or \
+            bool(self.skipped) and os.path.exists(self.part_path)
+        for index, (path, length) in enumerate(zip(self.paths, self.lengths)):
+            if index in self.skipped:
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.exists(path) or os.path.getsize(path) != length:
+                with open(path, 'ab') as f:
+                    f.truncate(length)
+
+    def spans(self, offset: int, length: int) -> List[Tuple[int, int, int]]:
+        """
+        Splits a range of the torrent along file boundaries.
+
+        Returns: (file index, offset within the file, length) for each file the range touches
+        """
+        spans = []
+        index = bisect_right(self.offsets, offset) - 1
+        while length > 0:
+            file_offset = offset - self.offsets[index]
+            n = min(length, self.lengths[index] - file_offset)
+            if n > 0:
+                spans.append((index, file_offset, n))
+                offset += n
+                length -= n
+            index += 1
+        return spans
+
+    @property
+    def part_path(self) -> str:
+        if self._part_path is None:
+            self._part_path = os.path.join(self.path, f'.{self.torrent.info_hash.hex()}.parts')
+        return self._part_path
+
+    @property
+    def slots(self) -> Dict[int, int]:
+        """
+        Returns: the slot in the partfile of each piece spanning several files
+        """
+        if self._slots is None:
+            piece_length = self.torrent.piece_length
+            pieces = {offset // piece_length for offset, length in zip(self.offsets[1:], self.lengths[1:])
+                      if length and offset % piece_length}
+            self._slots = {piece: slot for slot, piece in enumerate(sorted(pieces))}
+        return self._slots
+
+    def locate(self, offset: int, length: int) -> List[Tuple[str, int, int]]:
+        """
+        Splits a range of the torrent along file boundaries, sending the
+        parts of skipped files in boundary pieces to the partfile.
+
+        Returns: (path, offset within the file, length) for each file the range touches
+        """
+        if not self.skipped:
+            return [(self.paths[index], file_offset, n) for index, file_offset, n in self.spans(offset, length)]
+        piece_length = self.torrent.piece_length
+        located = []
+        for index, file_offset, n in self.spans(offset, length):
+            if index not in self.skipped:
+                located.append((self.paths[index], file_offset, n))
+                continue
+            # Only the first and last piece of a file may span other files
+            start = self.offsets[index] + file_offset
+            end = start + n
+            first_end = min(end, (start // piece_length + 1) * piece_length)
+            last_start = max(first_end, (end - 1) // piece_length * piece_length)
+            for lo, hi in ((start, first_end), (first_end, last_start), (last_start, end)):
+                if lo >= hi:
+                    continue
+                slot = self.slots.get(lo // piece_length)
+                if slot is None:
+                    located.append((self.paths[index], lo - self.offsets[index], hi - lo))
+                else:
+                    located.append((self.part_path, slot * piece_length + lo % piece_length, hi - lo))
+        return located
+
+    def write_sync(self, offset: int, data: bytes):
+        view = memoryview(data)
+        pos = 0
+        for path, file_offset, length in self.locate(offset, len(view)):
+            fd = self.pool.get(path)
+            start, end = pos, pos + length
+            while pos < end:
+                pos += os.pwrite(fd, view[pos:end], file_offset + pos - start)
+        log.debug(f'Wrote {len(view)} bytes at offset={offset}')
+
+    def read_sync(self, offset: int, length: int) -> bytes:
+        chunks = []
+        for path, file_offset, n in self.locate(offset, length):
+            fd = self.pool.get(path)
+            chunk = os.pread(fd, n, file_offset)
+            # The partfile only grows as far as its slots were written
+            chunks.append(chunk if len(chunk) == n else chunk.ljust(n, b'\0'))
+        return b''.join(chunks)
+
+    def set_skipped_sync(self, skipped: Set[int]):
+        """
+        Changes the files not to create. The boundary parts of the files
+        changing state move between them and the partfile, and the files not
+        skipped any more are created.
+        """
+        piece_length = self.torrent.piece_length
+        moves = []
+        for index in skipped ^ self.skipped:
+            source = self.part_path if index in self.skipped else self.paths[index]
+            if not self.lengths[index] or not os.path.exists(source):
+                continue
+            start, end = self.offsets[index], self.offsets[index] + self.lengths[index]
+            for piece in {start // piece_length, (end - 1) // piece_length}:
+                if piece in self.slots:
+                    lo, hi = max(start, piece * piece_length), min(end, (piece + 1) * piece_length)
+                    moves.append((lo, self.read_sync(lo, hi - lo)))
+        self.skipped = set(skipped)
+        self.allocate()
+        for offset, data in moves:
+            self.write_sync(offset, data)
+        log.info(f'Skipping {len(self.skipped)}/{len(self.paths)} files, moved {len(moves)} boundary parts.')
+
+    async def write(self, offset: int, data: bytes):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.write_sync, offset, data)
+
+    async def read(self, offset: int, length: int) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.read_sync, offset, length)
+
+    async def set_skipped(self, skipped: Set[int]):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.set_skipped_sync, skipped)
+
+    def close(self):
+        if self._is_shared:
+            paths = self.paths if self._part_path is None else self.paths + [self._part_path]
+            self.executor.submit(self.pool.discard, paths)
+            return
+        self.executor.submit(self.pool.close)
+        self.executor.shutdown(wait=True)
+
+
+class ReadCache:
+    """
+    Least recently used pieces read for uploading.
+
+    Peers request a piece block by block, so the whole piece is read on the
+    first request and its other blocks are served from memory. Concurrent
+    misses on the same piece share a single read.
+    """
+
+    def __init__(self, storage: Storage, max_bytes: int = READ_CACHE_SIZE):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._pieces: OrderedDict[int, asyncio.Future] = OrderedDict()
+
+    async def read(self, piece_index: int, begin: int, length: int) -> memoryview:
+        future = self._pieces.get(piece_index)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pieces[piece_index] = future
+            torrent = self.storage.torrent
+            try:
+                data = await self.storage.read(piece_index * torrent.piece_length, torrent.piece_size(piece_index))
+            except Exception as e:
+                del self._pieces[piece_index]
+                future.set_exception(e)
+                raise
+            future.set_result(data)
+            self.used += len(data)
+            self._evict()
+        else:
+            self._pieces.move_to_end(piece_index)
+        data = await future
+        return memoryview(data)[begin:begin + length]
+
+    def _evict(self):
+        # Reads still in flight are not counted yet, so they are left alone
+        for piece_index, future in list(self._pieces.items()):
+            if self.used <= self.max_bytes or len(self._pieces) <= 1:
+                break
+            if future.done():
+                del self._pieces[piece_index]
+                self.used -= len(future.result())
@@ -0,0 +1,171 @@
+import json
+import mimetypes
+import time
+from typing import TYPE_CHECKING, Dict, Mapping, Optional
+
+from aiohttp import web
+
+from const import STREAM_READAHEAD, STREAM_DEADLINE_STEP, STREAM_PORT, STREAM_CHUNK_SIZE
+from log import get_logger
+
+if TYPE_CHECKING:
+    from torrent.client import Client
+
+log = get_logger(__name__)
+
+
+class Stream:
+    """
+    Reads a torrent while it downloads, e.g. for a media player.
+
+    The pieces covering `readahead` bytes from the playhead get deadlines
+    STREAM_DEADLINE_STEP seconds apart, so the scheduler downloads them in
+    order and before any other piece. Every read moves the playhead to where
+    it starts, and waits until the pieces it covers are verified.
+    """
+
+    def __init__(self, client: 'Client', readahead: int = STREAM_READAHEAD):
+        self.client = client
+        self.readahead = readahead
+        # Piece under the playhead, None while nothing is read
+        self.playhead: Optional[int] = None
+        self.readers = 0
+
+    def seek(self, offset: int):
+        torrent = self.client.torrent
+        first = offset // torrent.piece_length
+        if first == self.playhead:
+            return
+        self.playhead = first
+        last = (min(offset + self.readahead, torrent.length) - 1) // torrent.piece_length
+        scheduler = self.client.scheduler
+        previous = dict(scheduler.deadlines)
+        scheduler.clear_deadlines()
+        now = time.monotonic()
+        for i, index in enumerate(range(first, max(first, last) + 1)):
+            # Pieces still ahead of the playhead keep their earlier deadline
+            deadline = now + (i + 1) * STREAM_DEADLINE_STEP
+            scheduler.set_deadline(index, min(deadline, previous.get(index, deadline)))
+        scheduler.notify()
+
+    def stop(self):
+        self.playhead = None
+        self.client.scheduler.clear_deadlines()
+
+    async def read(self, offset: int, length: int) -> bytes:
+        """
+        Returns: `length` bytes of the torrent at `offset`, once the pieces
+        they span are downloaded and verified
+        """
+        self.seek(offset)
+        piece_length = self.client.torrent.piece_length
+        first, last = offset // piece_length, (offset + length - 1) // piece_length
+        scheduler = self.client.scheduler
+        while not scheduler.have[first:last + 1].all():
+            await scheduler.wait()
+        return await self.client.storage.read(offset, length)
+
+
+class StreamServer:
+    """
+    Local HTTP server giving access to the files of torrents while they
+    download.
+
+    GET /<info hash> lists the files of a torrent, and
+    GET /<info hash>/<file index>[/<name>] serves one of them, answering
+    single Range requests with 206. Responses are sent piece by piece as
+    soon as each one is verified, moving the playhead of the torrent's
+    `Stream` along.
+    """
+
+    def __init__(self, clients: Mapping[bytes, 'Client'], host: str = '127.0.0.1', port: int = STREAM_PORT):
+        self.clients = clients
+        self.host = host
+        self.port = port
+        self.streams: Dict[bytes, Stream] = {}
+        app = web.Application()
+        app.add_routes([
+            web.get('/{info_hash}', self._list_files),
+            web.get('/{info_hash}/{index:\\d+}', self._serve_file),
+            web.get('/{info_hash}/{index:\\d+}/{name:.*}', self._serve_file),
+        ])
+        # Readers waiting for pieces are cancelled right away on close
+        self.runner = web.AppRunner(app, access_log=None, shutdown_timeout=0)
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        log.info(f'Streaming on http://{self.host}:{self.port}/')
+
+    async def close(self):
+        for stream in self.streams.values():
+            stream.stop()
+        await self.runner.cleanup()
+
+    def _client(self, request: web.Request) -> 'Client':
+        try:
+            client = self.clients.get(bytes.fromhex(request.match_info['info_hash']))
+        except ValueError:
+            client = None
+        if client is None or not client.torrent.has_metadata:
+            raise web.HTTPNotFound()
+        return client
+
+    async def _list_files(self, request: web.Request) -> web.Response:
+        client = self._client(request)
+        files = [{'index': i, 'path': file.path, 'length': file.length, 'url': f'/{request.match_info["info_hash"]}/{i}'}
+                 for i, file in enumerate(client.torrent.files)]
+        return web.Response(text=json.dumps(files), content_type='application/json')
+
+    async def _serve_file(self, request: web.Request) -> web.StreamResponse:
+        client = self._client(request)
+        index = int(request.match_info['index'])
+        if index >= len(client.torrent.files) or index in client.storage.skipped:
+            raise web.HTTPNotFound()
+        file = client.torrent.files[index]
+        try:
+            requested = request.http_range
+        except ValueError:
+            # Multiple or malformed ranges, the whole file is sent instead
+            requested = slice(None, None)
+        start, stop = requested.start, requested.stop
+        if start is not None and start < 0:
+            start = max(file.length + start, 0)
+        start = start or 0
+        stop = file.length if stop is None else min(stop, file.length)
+        headers = {'Accept-Ranges': 'bytes',
+                   'Content-Type': mimetypes.guess_type(file.path)[0] or 'application/octet-stream'}
+        if start >= stop and file.length:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{file.length}'})
+        is_partial = requested.start is not None or requested.stop is not None
+        if is_partial:
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{file.length}'
+        headers['Content-Length'] = str(stop - start)
+        response = web.StreamResponse(status=206 if is_partial else 200, headers=headers)
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+        stream = self.streams.get(client.torrent.info_hash)
+        if stream is None:
+            stream = self.streams[client.torrent.info_hash] = Stream(client)
+        stream.readers += 1
+        try:
+            await self._send(response, stream, client.storage.offsets[index] + start, stop - start)
+        finally:
+            stream.readers -= 1
+            if not stream.readers:
+                stream.stop()
+        await response.write_eof()
+        return response
+
+    @staticmethod
+    async def _send(response: web.StreamResponse, stream: Stream, offset: int, length: int):
+        piece_length = stream.client.torrent.piece_length
+        end = offset + length
+        while offset < end:
+            # Chunks end on piece boundaries, each goes out once its piece is in
+            n = min(end - offset, STREAM_CHUNK_SIZE, piece_length - offset % piece_length)
+            await response.write(await stream.read(offset, n))
+            offset += n
@@ -1,11 +1,13 @@
 import asyncio
 import random
+import socket
 import struct
+import time
 from abc import ABC, abstractmethod
-from asyncio import DatagramProtocol, BaseTransport, BaseProtocol
+from asyncio import DatagramProtocol
 from asyncio.exceptions import TimeoutError
 from struct import unpack
-from typing import Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from urllib.parse import urlencode
 from urllib.parse import urlparse
 
@@ -13,9 +15,12 @@ import aiohttp
 import bencodepy
 from yarl import URL
 
-from const import CHUNK_SIZE, ActionType
+from const import ActionType, AnnounceEvent, DEFAULT_ANNOUNCE_INTERVAL, MIN_ANNOUNCE_INTERVAL, \
+    TRACKER_TIMEOUT, UDP_TRACKER_TIMEOUT, UDP_TRACKER_RETRIES, UDP_CONNECTION_ID_LIFETIME, \
+    HTTP_TRACKER_CONNECTIONS, HTTP_TRACKER_CONNECTIONS_PER_HOST
 from log import get_logger
 from models import peer
+from models.peer import Peer
 from models.torrent import Torrent
 
 logger = get_logger(__name__)
@@ -77,6 +82,9 @@ class TrackerResponse:
         # where the peers field is a list of dictionaries and one where all
         # the peers are encoded in a single string
         peers = self.response[b'peers']
+        if type(peers) == list and peers and isinstance(peers[0], Peer):
+            # Already merged from several trackers
+            return peers
         if type(peers) == list:
             logger.debug('List of peers returned by tracker')
             peers = peer.from_dict(peers)
@@ -97,155 +105,409 @@ class TrackerResponse:
 
 
 class BaseTracker(ABC):
+    timeout: Optional[float] = TRACKER_TIMEOUT
+
+    def __init__(self, torrent: Torrent, url: str):
+        self.torrent = torrent
+        self.url = url
+
     @abstractmethod
-    async def announce(self) -> TrackerResponse:
+    async def announce(self, event: AnnounceEvent = AnnounceEvent.none) -> TrackerResponse:
         pass
 
 
-class HttpTracker(BaseTracker):
-    def __init__(self, torrent: Torrent):
-        self.torrent = torrent
+_http_session: Optional[aiohttp.ClientSession] = None
+_http_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def get_http_session() -> aiohttp.ClientSession:
+    """
+    Returns: the HTTP session of the running loop, shared by all the HTTP
+    trackers so that their connections are kept alive between announces
+    """
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        previous = _http_session
+        _http_session_loop = loop
+        connector = aiohttp.TCPConnector(limit=HTTP_TRACKER_CONNECTIONS,
+                                         limit_per_host=HTTP_TRACKER_CONNECTIONS_PER_HOST)
+        _http_session = aiohttp.ClientSession(connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=TRACKER_TIMEOUT))
+        # Left open by an earlier loop, replaced first so that concurrent announces share the new one
+        if previous is not None and not previous.closed:
+            await previous.close()
+    return _http_session
+
 
-    async def announce(self) -> TrackerResponse:
+class HttpTracker(BaseTracker):
+    async def announce(self, event: AnnounceEvent = AnnounceEvent.none) -> TrackerResponse:
         params = {
-            'uploaded': 0,
+            'uploaded': self.torrent.uploaded,
             'peer_id': self.torrent.peer_id,
-            'downloaded': 0,
-            'left': self.torrent.piece_length,
-            'port': 10000,
-            'info_hash': self.torrent.info_hash
+            'downloaded': self.torrent.downloaded,
+            'left': self.torrent.left,
+            'port': self.torrent.port,
+            'info_hash': self.torrent.info_hash,
+            'compact': 1,
         }
+        if event != AnnounceEvent.none:
+            params['event'] = event.name
         params_str = urlencode(params, safe='%')
 
-        async with aiohttp.ClientSession() as session:
-            url = f'{self.torrent.announce}?{params_str}'
-            async with session.get(URL(url, encoded=True)) as r:
-                announce_response = b''
-                while True:
-                    chunk = await r.content.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    announce_response += chunk
-                response = TrackerResponse(bencodepy.decode(announce_response))
-                return response
-
-
-class UdpTracker(DatagramProtocol, BaseTracker):
-    def __init__(self, torrent: Torrent):
-        self.torrent = torrent
+        # Private trackers put a passkey in the query string of the announce URL
+        separator = '&' if '?' in self.url else '?'
+        url = f'{self.url}{separator}{params_str}'
+        session = await get_http_session()
+        async with session.get(URL(url, encoded=True)) as r:
+            # Read into a single buffer, the peer list of non-compact responses can be large
+            announce_response = await r.read()
+        return TrackerResponse(bencodepy.decode(announce_response))
 
-        self.received_message = None
 
-        self.loop = asyncio.get_event_loop()
-        self.delivery_tracker = {}
-        self.transport = None
+class TrackerError(Exception):
+    pass
+
+
+class UdpTrackerProtocol(DatagramProtocol):
+    """
+    A single UDP socket shared by all the UDP trackers.
+
+    Replies are routed to the waiting request by their transaction ID, so
+    any number of announces and scrapes, to any number of trackers, can be
+    in flight at once. Connection IDs are cached per tracker address for
+    the minute BEP 15 allows.
+    """
 
     MAGIC_CONNECTION_ID = 0x41727101980
 
-    RESPONSE_HEADER_FMT = '!II'
-    RESPONSE_HEADER_LEN = struct.calcsize(RESPONSE_HEADER_FMT)
+    REQUEST_HEADER = struct.Struct('!QII')
+    RESPONSE_HEADER = struct.Struct('!II')
+
+    def __init__(self):
+        self.transport = None
+        self.transactions: Dict[int, asyncio.Future] = {}
+        self.connection_ids: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        self._connecting: Dict[Tuple[str, int], asyncio.Future] = {}
+        self.loop = asyncio.get_running_loop()
+        self._opened = asyncio.ensure_future(
+            self.loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0)))
+
+    async def open(self):
+        await self._opened
+
+    @property
+    def is_closed(self) -> bool:
+        return self.transport is not None and self.transport.is_closing()
 
     def connection_made(self, transport):
         self.transport = transport
 
+    def connection_lost(self, exc):
+        for future in self.transactions.values():
+            if not future.done():
+                future.set_exception(ConnectionError('UDP tracker socket closed'))
+        self.transactions.clear()
+
     def datagram_received(self, data, addr):
-        logger.info(f'Data received from {addr=}, yay!!!')
-        action, tid = struct.unpack('!II', data[:8])
-        self.received_message = data
-        if tid in self.delivery_tracker:
-            self.delivery_tracker[tid].set()
+        if len(data) < self.RESPONSE_HEADER.size:
+            return
+        action, tid = self.RESPONSE_HEADER.unpack_from(data)
+        future = self.transactions.get(tid)
+        if future is None or future.done():
+            logger.debug(f'Dropping UDP tracker reply with unknown transaction {tid} from {addr}')
+            return
+        if action == ActionType.error.value:
+            future.set_exception(TrackerError(bytes(data[self.RESPONSE_HEADER.size:]).decode(errors='replace')))
         else:
-            logger.warning('Invalid transaction ID received.')
-
-    async def announce(self):
-        tid = random.randint(0, 2 ** 32 - 1)
-        self.delivery_tracker[tid] = asyncio.Event()
-        request = pack(
-            'Q', UdpTracker.MAGIC_CONNECTION_ID,
-            'I', 0,
-            'I', tid,
-        )
-        logger.info(f'Sending UDP connect request, {tid=}.')
+            future.set_result(data)
+
+    def error_received(self, exc):
+        logger.debug(f'UDP tracker socket error: {exc!r}')
+
+    def _new_transaction(self) -> int:
+        while True:
+            tid = random.getrandbits(32)
+            if tid not in self.transactions:
+                return tid
+
+    async def _send(self, addr: Tuple[str, int], connection_id: int, action: ActionType, payload: bytes,
+                    timeout: float) -> bytes:
+        tid = self._new_transaction()
+        future = self.loop.create_future()
+        self.transactions[tid] = future
         try:
-            self.transport.sendto(request)
-            await asyncio.wait_for(self.delivery_tracker[tid].wait(), timeout=5)
-            del self.delivery_tracker[tid]
-        except TimeoutError as e:
-            logger.error('UDP connection timed out while waiting for reply!')
-            raise e
-        logger.info(f'UDP connection successful for {tid=}')
-
-        (connection_id,) = struct.unpack_from('!Q', self.received_message, UdpTracker.RESPONSE_HEADER_LEN)
-        request = pack(
-            'Q', connection_id,
-            'I', ActionType.announce.value,
-            'I', tid,
-            '20s', self.torrent.info_hash,
-            '20s', self.torrent.peer_id.encode('utf-8'),
-            'Q', 0,
-            'Q', self.torrent.piece_length,
-            'Q', 0,
-            'I', 2,  # event.value,
-            'I', 0,  # IP address: default
-            'I', random.randint(0, 2 ** 32 - 1),  # Key
-            'i', -1,  # numwant: default
-            'H', 10000,
+            self.transport.sendto(self.REQUEST_HEADER.pack(connection_id, action.value, tid) + payload, addr)
+            data = await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            del self.transactions[tid]
+        (received_action,) = struct.unpack_from('!I', data)
+        if received_action != action.value:
+            raise TrackerError(f'Expected {action.name} reply, got action {received_action}')
+        return data
+
+    async def _connect(self, addr: Tuple[str, int], timeout: float) -> int:
+        cached = self.connection_ids.get(addr)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+        # Requests made while connecting wait for the same connection ID
+        if addr not in self._connecting:
+            self._connecting[addr] = asyncio.ensure_future(self._fetch_connection_id(addr, timeout))
+            self._connecting[addr].add_done_callback(lambda _: self._connecting.pop(addr, None))
+        return await asyncio.shield(self._connecting[addr])
+
+    async def _fetch_connection_id(self, addr: Tuple[str, int], timeout: float) -> int:
+        data = await self._send(addr, self.MAGIC_CONNECTION_ID, ActionType.connect, b'', timeout)
+        (connection_id,) = struct.unpack_from('!Q', data, self.RESPONSE_HEADER.size)
+        self.connection_ids[addr] = connection_id, time.monotonic() + UDP_CONNECTION_ID_LIFETIME
+        return connection_id
+
+    async def request(self, addr: Tuple[str, int], action: ActionType, payload: bytes) -> bytes:
+        """
+        Sends `payload` under a valid connection ID, retransmitting on the
+        BEP 15 schedule until the tracker replies.
+
+        Returns: the reply, starting with its action and transaction ID
+        """
+        for n in range(UDP_TRACKER_RETRIES + 1):
+            timeout = UDP_TRACKER_TIMEOUT * 2 ** n
+            try:
+                connection_id = await self._connect(addr, timeout)
+                return await self._send(addr, connection_id, action, payload, timeout)
+            except TimeoutError:
+                logger.debug(f'No reply from UDP tracker {addr} after {timeout}s, retransmitting.')
+            except TrackerError:
+                # The connection ID may have been refused, get a new one next time
+                self.connection_ids.pop(addr, None)
+                raise
+        raise TimeoutError(f'UDP tracker {addr} did not reply')
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+_udp_protocol: Optional[UdpTrackerProtocol] = None
+
+
+async def get_udp_protocol() -> UdpTrackerProtocol:
+    """
+    Returns: the UDP tracker socket of the running loop, opened on first use
+    """
+    global _udp_protocol
+    if _udp_protocol is None or _udp_protocol.loop is not asyncio.get_running_loop() or _udp_protocol.is_closed:
+        _udp_protocol = UdpTrackerProtocol()
+    await _udp_protocol.open()
+    return _udp_protocol
+
+
+async def close_shared_sockets():
+    """
+    Closes the HTTP session and UDP socket shared by the trackers.
+    """
+    global _http_session, _udp_protocol
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+    if _udp_protocol is not None:
+        _udp_protocol.close()
+        _udp_protocol = None
+
+
+class UdpTracker(BaseTracker):
+    # Retransmissions already bound the request, see UdpTrackerProtocol
+    timeout = None
+
+    ANNOUNCE_REQUEST = struct.Struct('!20s20sQQQIIIiH')
+    ANNOUNCE_RESPONSE = struct.Struct('!3I')
+    SCRAPE_RESPONSE = struct.Struct('!3I')
+
+    def __init__(self, torrent: Torrent, url: str):
+        super().__init__(torrent, url)
+        self.addr = None
+
+    async def _resolve(self) -> Tuple[str, int]:
+        if self.addr is None:
+            host, port = parse_url(self.url)
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, family=socket.AF_INET,
+                                                                 type=socket.SOCK_DGRAM)
+            self.addr = infos[0][4]
+        return self.addr
+
+    async def announce(self, event: AnnounceEvent = AnnounceEvent.none) -> TrackerResponse:
+        protocol = await get_udp_protocol()
+        addr = await self._resolve()
+        payload = self.ANNOUNCE_REQUEST.pack(
+            self.torrent.info_hash,
+            self.torrent.peer_id.encode('utf-8'),
+            self.torrent.downloaded,
+            self.torrent.left,
+            self.torrent.uploaded,
+            event.value,
+            0,  # IP address: default
+            random.getrandbits(32),  # Key
+            -1,  # numwant: default
+            self.torrent.port,
         )
-        self.delivery_tracker[tid] = asyncio.Event()
-        self.transport.sendto(request)
-        await asyncio.wait_for(self.delivery_tracker[tid].wait(), timeout=500)
-        del self.delivery_tracker[tid]
-        logger.info(f'UDP announce successful for {tid=}')
-
-        fmt = '!3I'
-        interval, leech_count, seed_count = struct.unpack_from(fmt, self.received_message,
-                                                               UdpTracker.RESPONSE_HEADER_LEN)
-        compact_peer_list = self.received_message[UdpTracker.RESPONSE_HEADER_LEN + struct.calcsize(fmt):]
+        data = await protocol.request(addr, ActionType.announce, payload)
+        offset = UdpTrackerProtocol.RESPONSE_HEADER.size
+        interval, leech_count, seed_count = self.ANNOUNCE_RESPONSE.unpack_from(data, offset)
+        logger.info(f'UDP announce to {self.url} successful')
         return TrackerResponse({
             b'interval': interval,
             b'complete': seed_count,
             b'incomplete': leech_count,
-            b'peers': compact_peer_list
+            b'peers': bytes(data[offset + self.ANNOUNCE_RESPONSE.size:])
+        })
+
+    async def scrape(self) -> TrackerResponse:
+        """
+        Returns: the seeder and leecher counts of the torrent, without peers
+        """
+        protocol = await get_udp_protocol()
+        addr = await self._resolve()
+        data = await protocol.request(addr, ActionType.scrape, self.torrent.info_hash)
+        seed_count, completed, leech_count = self.SCRAPE_RESPONSE.unpack_from(
+            data, UdpTrackerProtocol.RESPONSE_HEADER.size)
+        return TrackerResponse({
+            b'complete': seed_count,
+            b'downloaded': completed,
+            b'incomplete': leech_count,
+            b'peers': b''
         })
 
 
-async def start_udp_tracker(torrent: Torrent) -> Tuple[BaseTransport, BaseProtocol]:
-    if torrent.announce_list:
-        url = random.choice(torrent.announce_list)
-        # so that we don't hit a bad tracker twice
-        torrent.announce_list.remove(url)
-    else:
-        url = torrent.announce
-    host, port = parse_url(url)
-    logger.info(f'Attempting UDP connection with {host=} {port=}.')
-    loop = asyncio.get_event_loop()
-    transport, proto = await loop.create_datagram_endpoint(lambda: UdpTracker(torrent), remote_addr=(host, port))
-    return transport, proto
+def create_tracker(torrent: Torrent, url: str) -> BaseTracker:
+    if url.startswith('udp'):
+        return UdpTracker(torrent, url)
+    return HttpTracker(torrent, url)
 
 
 class TrackerClient:
-    def __init__(self, torrent: Torrent):
+    """
+    Announces a torrent to all of its trackers.
+
+    Following BEP 12, the tiers of the announce list are contacted
+    concurrently; within a tier the trackers are tried in order and the one
+    which answers is moved to the front. The peers of each tier are passed
+    to `on_peers` as soon as it answers, and once started the torrent is
+    re-announced on the interval the trackers ask for.
+    """
+
+    def __init__(self, torrent: Torrent, on_peers: Optional[Callable[[List[Peer]], None]] = None):
         self.torrent = torrent
-        self.loop = asyncio.get_event_loop()
-
-    async def announce(self) -> TrackerResponse:
-        torrent = self.torrent
-        if torrent.announce.startswith('udp'):
-            while True:
-                transport, proto = await asyncio.create_task(start_udp_tracker(torrent))
-                logger.info('Started UDP tracker client.')
-                try:
-                    return await proto.announce()
-                except TimeoutError:
-                    pass
-        else:
-            return await HttpTracker(torrent).announce()
+        self.on_peers = on_peers
+        self.tiers = [[create_tracker(torrent, url) for url in tier] for tier in torrent.announce_list]
+        self.interval = DEFAULT_ANNOUNCE_INTERVAL
+        self._task = None
+        # Completed and stopped announces still being sent
+        self._events: Set[asyncio.Task] = set()
+        # Tiers which did not answer by the time their announce returned
+        self._tiers: Set[asyncio.Task] = set()
+
+    async def announce(self, event: AnnounceEvent = AnnounceEvent.started) -> TrackerResponse:
+        """
+        Announces to all the tiers at once, without waiting for the slower
+        ones: they keep going and pass their peers to `on_peers` when they
+        answer.
+
+        Returns: the merged responses of the first tiers to answer, or an
+        empty response if none did
+        """
+        responses: List[TrackerResponse] = []
+        tasks = set()
+        for tier in self.tiers:
+            task = asyncio.create_task(self._announce_tier(tier, event, responses))
+            self._tiers.add(task)
+            task.add_done_callback(self._tiers.discard)
+            tasks.add(task)
+        while tasks and not responses:
+            _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        response = self._merge(responses)
+        logger.info(f'{len(responses)}/{len(self.tiers)} tracker tiers answered first with '
+                    f'{len(response.peers)} peers.')
+        return response
+
+    async def _announce_tier(self, tier: List[BaseTracker], event: AnnounceEvent,
+                             responses: List[TrackerResponse]):
+        for i, tracker in enumerate(tier):
+            try:
+                response = await asyncio.wait_for(tracker.announce(event), timeout=tracker.timeout)
+            except Exception as e:
+                logger.warning(f'Announce to {tracker.url} failed: {e!r}')
+                continue
+            if response.failure:
+                logger.warning(f'Tracker {tracker.url} refused the announce: {response.failure}')
+                continue
+            tier.insert(0, tier.pop(i))
+            responses.append(response)
+            self._merge(responses)
+            if self.on_peers is not None and event != AnnounceEvent.stopped:
+                self.on_peers(response.peers)
+            return
+
+    def _merge(self, responses: List[TrackerResponse]) -> TrackerResponse:
+        """
+        Takes the shortest interval the tiers asked for so far.
+
+        Returns: the responses of the tiers merged into one
+        """
+        peers = {}
+        for response in responses:
+            for p in response.peers:
+                peers.setdefault((p.ip, p.port), p)
+        intervals = [response.interval for response in responses if response.interval]
+        self.interval = max(min(intervals, default=DEFAULT_ANNOUNCE_INTERVAL), MIN_ANNOUNCE_INTERVAL)
+        return TrackerResponse({
+            b'interval': self.interval,
+            b'complete': sum(response.complete for response in responses),
+            b'incomplete': sum(response.incomplete for response in responses),
+            b'peers': list(peers.values()),
+        })
+
+    def start(self):
+        """
+        Re-announces periodically from now on.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._reannounce())
+
+    async def _reannounce(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.announce(AnnounceEvent.none)
+
+    def completed(self):
+        self._send_event(AnnounceEvent.completed)
+
+    def close(self):
+        # Their peers would go to a closed torrent
+        for task in self._tiers:
+            task.cancel()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._send_event(AnnounceEvent.stopped)
+
+    def _send_event(self, event: AnnounceEvent):
+        task = asyncio.create_task(self.announce(event))
+        self._events.add(task)
+        task.add_done_callback(self._events.discard)
+
+    async def wait_closed(self):
+        """
+        Waits until the completed and stopped announces are sent, and the
+        tiers still announcing are done.
+        """
+        if self._events:
+            await asyncio.gather(*self._events, return_exceptions=True)
+        if self._tiers:
+            await asyncio.gather(*self._tiers, return_exceptions=True)
 
 
 def parse_url(url: str) -> Tuple[str, int]:
     parsed_url = urlparse(url)
-    host, port = parsed_url.netloc.split(':')
-    return host, int(port)
+    return parsed_url.hostname, parsed_url.port
 
 
 def _decode_port(port):
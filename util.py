@@ -1,4 +1,5 @@
 import random
+import time
 
 from const import CLIENT_ID, VERSION
 from log import get_logger
@@ -22,3 +23,28 @@ def generate_id() -> str:
     _id = f'-{CLIENT_ID}{VERSION}-{random_num}'
     log.info(f'Generated {_id}')
     return _id
+
+
+class RateMeter:
+    """
+    Exponentially weighted transfer rate, in bytes per second.
+    """
+
+    def __init__(self, window: float = 1.0, alpha: float = 0.2):
+        self.window = window
+        self.alpha = alpha
+        self.rate = 0.0
+        self.total = 0
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+
+    def add(self, n: int):
+        self.total += n
+        self._window_bytes += n
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed >= self.window:
+            sample = self._window_bytes / elapsed
+            self.rate = sample if not self.rate else (1 - self.alpha) * self.rate + self.alpha * sample
+            self._window_start = now
+            self._window_bytes = 0